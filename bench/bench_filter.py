@@ -0,0 +1,76 @@
+# Cost per path of deciding whether a path is excluded: the compiled
+# filters.PathFilter against trying every rule in turn with fnmatch, the
+# way a rule list is usually checked. The paths are synthetic, so no file
+# system is involved, and the rules are a typical project .gitignore
+# repeated --repeat times to show how each matcher grows with the number
+# of rules.
+#
+#   python bench/bench_filter.py [--paths N] [--repeat 1,10]
+import os
+import sys
+import time
+import fnmatch
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import sync
+from filters import PathFilter, parse_rule
+
+RULES = [
+    'node_modules/', '__pycache__/', '*.pyc', '*.o', '*.so', '/build/', '/dist/', '.cache/', '*.log',
+    '!important.log', 'coverage/', '.tox/', '*.egg-info/', 'docs/_build/', '**/tmp/*.swp', '.DS_Store',
+    'Thumbs.db', '*.[oa]', 'target/', '!target/keep/',
+]
+NAMES = ['main.py', 'util.c', 'util.o', 'README.md', 'server.log', 'important.log', 'index.js', 'data.json']
+DIRS = ['src', 'lib', 'node_modules', 'tests', 'tmp', 'docs', 'build', 'pkg']
+
+
+def synthetic_paths(count):
+    paths = []
+    for i in range(count):
+        depth = 1 + i % 5
+        parts = [DIRS[(i >> (3 * level)) % len(DIRS)] + ('' if level % 2 else str(level)) for level in range(depth)]
+        is_dir = i % 7 == 0
+        name = DIRS[i % len(DIRS)] if is_dir else NAMES[i % len(NAMES)]
+        paths.append((os.path.join(*parts, name), is_dir))
+    return paths
+
+
+def naive_excluded(rules, relpath, is_dir):
+    # Every rule with fnmatch, last match wins.
+    relpath = relpath.replace(os.sep, '/')
+    name = relpath.rpartition('/')[2]
+    result = False
+    for pattern, include, dir_only, anchored in rules:
+        if dir_only and not is_dir:
+            continue
+        if fnmatch.fnmatchcase(relpath if anchored else name, pattern):
+            result = not include
+    return result
+
+
+def timed(func, paths):
+    start = time.perf_counter()
+    excluded = sum(func(relpath, is_dir) for relpath, is_dir in paths)
+    return (time.perf_counter() - start) / len(paths) * 1e9, excluded
+
+
+def main():
+    count = int(sync.option_value(sys.argv, '--paths', 200000))
+    repeats = [int(n) for n in sync.option_value(sys.argv, '--repeat', '1,10').split(',')]
+    paths = synthetic_paths(count)
+    print(f"{count} paths")
+    print(f"{'rules':>6} {'compiled ns':>12} {'fnmatch ns':>11} {'excluded':>9}")
+    for repeat in repeats:
+        rules = RULES * repeat
+        path_filter = PathFilter(rules)
+        parsed = [rule for rule in map(parse_rule, rules) if rule is not None]
+        compiled, excluded = timed(path_filter.excluded, paths)
+        naive, naive_count = timed(lambda relpath, is_dir: naive_excluded(parsed, relpath, is_dir), paths)
+        # fnmatch's * also crosses "/", so the two can disagree on a few
+        # anchored patterns; both counts are shown.
+        print(f"{len(rules):6} {compiled:12.0f} {naive:11.0f} {excluded:5}/{naive_count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Hashing throughput of compute_file_digest per algorithm and worker count.
+# The tree is read once before timing, so the numbers are for data that is
+# already in the page cache (hashing cost, not disk speed).
+#
+#   python bench/bench_hash.py [files] [file_mib] [buffer_mib]
+import os
+import sys
+import time
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sync
+
+
+def make_tree(root, files, file_size):
+    os.makedirs(root)
+    block = os.urandom(1024 * 1024)
+    for i in range(files):
+        with open(os.path.join(root, f"f{i:05d}.dat"), 'wb') as f:
+            remaining = file_size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+
+
+def hash_tree(paths, algo, workers, bufsize):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda p: sync.compute_file_digest(p, algo, bufsize), paths))
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    file_size = int(sys.argv[2] if len(sys.argv) > 2 else 16) * 1024 * 1024
+    bufsize = int(sys.argv[3] if len(sys.argv) > 3 else 1) * 1024 * 1024
+    cpus = os.cpu_count() or 1
+    worker_counts = sorted({1, 2, 4, cpus, cpus * 2})
+
+    tmp = tempfile.mkdtemp(prefix='bench_hash_')
+    try:
+        root = os.path.join(tmp, 'tree')
+        make_tree(root, files, file_size)
+        paths = [os.path.join(root, name) for name in sorted(os.listdir(root))]
+        total = files * file_size
+        hash_tree(paths, 'md5', cpus, bufsize)
+
+        print(f"{files} files x {file_size // (1024 * 1024)} MiB, {bufsize // (1024 * 1024)} MiB buffer, {cpus} CPU(s)")
+        print(f"{'algorithm':10} {'workers':>7} {'seconds':>8} {'GB/s':>7}")
+        for algo in sync.HASH_ALGORITHMS:
+            for workers in worker_counts:
+                start = time.perf_counter()
+                hash_tree(paths, algo, workers, bufsize)
+                elapsed = time.perf_counter() - start
+                print(f"{algo:10} {workers:7d} {elapsed:8.3f} {total / elapsed / 1e9:7.2f}")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
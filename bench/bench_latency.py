@@ -0,0 +1,141 @@
+# Runs synchronize_directories against a stand-in for a network file
+# system: every file system call made through Python's os module, open()
+# and DirEntry.stat() first sleeps for a fixed round trip, as it would
+# wait for an NFS or SMB server. No FUSE or server is needed, and the
+# sleeps release the GIL just as real network waits do.
+#
+# Compares the plain sequential scan against the --io-depth pipeline, on a
+# rescan of trees that are already in sync (with a share of the files
+# touched, so their contents get compared) and on an initial copy.
+#
+#   python bench/bench_latency.py [--files N] [--per-dir N] [--latency MS]
+#       [--depths 8,32] [--touched PERCENT]
+import os
+import sys
+import time
+import shutil
+import builtins
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import sync
+from bench_scan import make_tree
+
+SLOW_CALLS = ('stat', 'lstat', 'scandir', 'listdir', 'open', 'mkdir', 'makedirs', 'remove', 'unlink', 'rmdir',
+              'replace', 'rename', 'link', 'utime', 'chmod')
+
+
+class SlowEntry:
+    def __init__(self, entry, delay):
+        self._entry = entry
+        self._delay = delay
+        self._stat = None
+        self.name = entry.name
+        self.path = entry.path
+
+    def stat(self, *, follow_symlinks=True):
+        # DirEntry caches its stat result, so only the first call waits.
+        if self._stat is None:
+            time.sleep(self._delay)
+            self._stat = self._entry.stat(follow_symlinks=follow_symlinks)
+        return self._stat
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+
+class SlowScandir:
+    def __init__(self, it, delay):
+        self._it = it
+        self._delay = delay
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._it.close()
+
+    def __iter__(self):
+        for entry in self._it:
+            yield SlowEntry(entry, self._delay)
+
+
+class LatencyShim:
+    # Context manager that adds delay seconds to every call in SLOW_CALLS.
+    def __init__(self, delay):
+        self.delay = delay
+        self.originals = {}
+
+    def __enter__(self):
+        for name in SLOW_CALLS:
+            if hasattr(os, name):
+                self.originals[(os, name)] = getattr(os, name)
+        self.originals[(builtins, 'open')] = builtins.open
+        for (module, name), func in self.originals.items():
+            setattr(module, name, self.slow(func, name == 'scandir'))
+        return self
+
+    def __exit__(self, *exc):
+        for (module, name), func in self.originals.items():
+            setattr(module, name, func)
+
+    def slow(self, func, wrap_entries):
+        delay = self.delay
+
+        def wrapper(*args, **kwargs):
+            time.sleep(delay)
+            result = func(*args, **kwargs)
+            return SlowScandir(result, delay) if wrap_entries else result
+        return wrapper
+
+
+def touch(root, percent):
+    # New mtimes with the same contents: each such file costs a content
+    # comparison but no copy.
+    future = time.time() + 10
+    for i, (dirpath, dirnames, filenames) in enumerate(os.walk(root)):
+        for j, name in enumerate(sorted(filenames)):
+            if (i * 7 + j) % 100 < percent:
+                os.utime(os.path.join(dirpath, name), (future, future))
+
+
+def timed_sync(source, dest, delay, **options):
+    with LatencyShim(delay):
+        start = time.perf_counter()
+        sync.synchronize_directories(source, dest, log_func=lambda message: None, **options)
+        return time.perf_counter() - start
+
+
+def main():
+    files = int(sync.option_value(sys.argv, '--files', 2000))
+    per_dir = int(sync.option_value(sys.argv, '--per-dir', 50))
+    delay = float(sync.option_value(sys.argv, '--latency', 1)) / 1000
+    depths = [int(depth) for depth in sync.option_value(sys.argv, '--depths', '8,32').split(',')]
+    percent = int(sync.option_value(sys.argv, '--touched', 5))
+
+    runs = [('sequential', {})] + [(f"io-depth {depth}", {'io_depth': depth, 'jobs': depth}) for depth in depths]
+    tmp = tempfile.mkdtemp(prefix='bench_latency_')
+    try:
+        source = os.path.join(tmp, 'source')
+        base = os.path.join(tmp, 'base')
+        make_tree(source, files, per_dir)
+        shutil.copytree(source, base)
+        touch(source, percent)
+        print(f"{files} files, {per_dir} per directory, {delay * 1000:g} ms per call, {percent}% touched")
+        print(f"{'run':14} {'rescan s':>9} {'copy s':>8}")
+        for name, options in runs:
+            synced = os.path.join(tmp, 'synced')
+            copied = os.path.join(tmp, 'copied')
+            shutil.copytree(base, synced)
+            rescan = timed_sync(source, synced, delay, **options)
+            copy = timed_sync(source, copied, delay, **options)
+            print(f"{name:14} {rescan:9.2f} {copy:8.2f}")
+            shutil.rmtree(synced)
+            shutil.rmtree(copied)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Memory per scanned file for the in-memory manifest: a list of
+# ManifestEntry tuples with a full path string each (how scan_tree used to
+# return a tree) against the column-based manifest.Manifest. The entries
+# are synthetic, so no file system is involved. Each representation is
+# built in its own process and its peak RSS, minus that of a process that
+# builds nothing, is reported per million files.
+#
+#   python bench/bench_manifest.py [--files N] [--per-dir N] [--depth N]
+import os
+import sys
+import json
+import time
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import sync
+from manifest import ManifestEntry, Manifest
+
+KINDS = ('none', 'tuples', 'compact')
+
+
+def synthetic_tree(files, per_dir, depth):
+    # (reldir, names) per directory, in manifest order, with realistic
+    # name lengths. Directories are nested depth levels deep.
+    for d in range(files // per_dir + 1):
+        parts = [f"dir{(d >> (4 * level)) % 16:02d}" for level in range(depth - 1)] + [f"project{d:07d}"]
+        names = [f"file-{i:05d}-report.txt" for i in range(min(per_dir, files - d * per_dir))]
+        if names:
+            yield os.path.join(*parts), names
+
+
+def build(kind, files, per_dir, depth):
+    now = time.time_ns()
+    if kind == 'tuples':
+        manifest = []
+        for reldir, names in synthetic_tree(files, per_dir, depth):
+            for i, name in enumerate(names):
+                # int() so every field is its own object, as with real stat results.
+                manifest.append(ManifestEntry(os.path.join(reldir, name), 'f', int(str(1000 + i)),
+                                              now - i, now // 1000 + len(manifest), now - i))
+    elif kind == 'compact':
+        manifest = Manifest()
+        for reldir, names in synthetic_tree(files, per_dir, depth):
+            parent = manifest.add_dir(reldir)
+            for i, name in enumerate(names):
+                manifest.append(parent, name, 'f', 1000 + i, now - i, now // 1000 + len(manifest), now - i)
+    else:
+        manifest = []
+    start = time.perf_counter()
+    count = sum(1 for entry in manifest)
+    return count, time.perf_counter() - start
+
+
+def child(args):
+    kind, files, per_dir, depth = json.loads(args)
+    start = time.perf_counter()
+    count, iterate = build(kind, files, per_dir, depth)
+    print(json.dumps({'build_seconds': time.perf_counter() - start - iterate, 'iterate_seconds': iterate,
+                      'count': count}))
+
+
+def run_child(kind, files, per_dir, depth):
+    command = [sys.executable, os.path.abspath(__file__), '--child', json.dumps([kind, files, per_dir, depth])]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    # wait4 instead of proc.wait() to get this child's own peak RSS.
+    _, status, usage = os.wait4(proc.pid, 0)
+    if os.waitstatus_to_exitcode(status):
+        raise RuntimeError(f"benchmark run for {kind} failed")
+    result = json.loads(output)
+    result['rss_kib'] = usage.ru_maxrss
+    return result
+
+
+def main():
+    if '--child' in sys.argv:
+        child(sync.option_value(sys.argv, '--child'))
+        return
+
+    files = int(sync.option_value(sys.argv, '--files', 1000000))
+    per_dir = int(sync.option_value(sys.argv, '--per-dir', 50))
+    depth = int(sync.option_value(sys.argv, '--depth', 4))
+    print(f"{files} files, {per_dir} per directory, {depth} levels deep")
+    print(f"{'manifest':9} {'MiB/1M files':>13} {'bytes/file':>11} {'build s':>8} {'iterate s':>10}")
+    results = {kind: run_child(kind, files, per_dir, depth) for kind in KINDS}
+    base = results['none']['rss_kib']
+    for kind in KINDS[1:]:
+        result = results[kind]
+        per_file = (result['rss_kib'] - base) * 1024 / max(files, 1)
+        print(f"{kind:9} {per_file * 1000000 / (1024 * 1024):13.1f} {per_file:11.1f} "
+              f"{result['build_seconds']:8.2f} {result['iterate_seconds']:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
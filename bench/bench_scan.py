@@ -0,0 +1,135 @@
+# Compares the old filecmp.dircmp based compare phase against the os.scandir
+# manifest scanner on an already synchronized tree, counting metadata
+# syscalls per file.
+#
+#   python bench/bench_scan.py [files] [files_per_dir]
+import os
+import sys
+import time
+import shutil
+import filecmp
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sync
+
+counts = {'calls': 0}
+
+
+class CountingEntry:
+    # Wraps a DirEntry so the first (uncached) stat() is counted as well.
+    def __init__(self, entry):
+        self._entry = entry
+        self._stat_done = False
+        self.name = entry.name
+        self.path = entry.path
+
+    def stat(self, *, follow_symlinks=True):
+        if not self._stat_done and os.name != 'nt':
+            counts['calls'] += 1
+            self._stat_done = True
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+
+class CountingScandir:
+    def __init__(self, it):
+        self._it = it
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._it.close()
+
+    def __iter__(self):
+        for entry in self._it:
+            yield CountingEntry(entry)
+
+
+def install_counters():
+    originals = {name: getattr(os, name) for name in ('stat', 'lstat', 'listdir', 'scandir')}
+
+    def counted(name):
+        func = originals[name]
+
+        def wrapper(*args, **kwargs):
+            counts['calls'] += 1
+            result = func(*args, **kwargs)
+            if name == 'scandir':
+                return CountingScandir(result)
+            return result
+        return wrapper
+
+    for name in originals:
+        setattr(os, name, counted(name))
+    return originals
+
+
+def remove_counters(originals):
+    for name, func in originals.items():
+        setattr(os, name, func)
+
+
+def make_tree(root, files, files_per_dir):
+    for i in range(files):
+        d = os.path.join(root, f"d{i // files_per_dir:05d}")
+        if i % files_per_dir == 0:
+            os.makedirs(d)
+        with open(os.path.join(d, f"f{i:07d}.dat"), 'wb') as f:
+            f.write(b'x' * (i % 512))
+
+
+def legacy_compare(src, dst):
+    # The compare half of the old compare_and_copy/copy_files recursion.
+    comp = filecmp.dircmp(src, dst)
+    for name in comp.left_only:
+        os.path.isdir(os.path.join(src, name))
+    for name in comp.common_files:
+        filecmp.cmp(os.path.join(src, name), os.path.join(dst, name), shallow=True)
+    for subdir in comp.common_dirs:
+        legacy_compare(os.path.join(src, subdir), os.path.join(dst, subdir))
+
+
+def manifest_compare(src, dst):
+    for left, right in sync.diff_manifests(sync.scan_tree(src), sync.scan_tree(dst)):
+        if left is not None and right is not None and left.type == 'f':
+            sync.Comparator(sync.default_tiers()).differ(left, right, None, None)
+
+
+def run(name, func, src, dst, files):
+    filecmp.clear_cache()
+    start = time.perf_counter()
+    func(src, dst)
+    elapsed = time.perf_counter() - start
+
+    filecmp.clear_cache()
+    counts['calls'] = 0
+    originals = install_counters()
+    try:
+        func(src, dst)
+    finally:
+        remove_counters(originals)
+    print(f"{name:10} {elapsed:8.3f}s  {counts['calls']:9d} syscalls  {counts['calls'] / files:6.2f} per file")
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    files_per_dir = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    tmp = tempfile.mkdtemp(prefix='bench_scan_')
+    try:
+        src = os.path.join(tmp, 'source')
+        dst = os.path.join(tmp, 'destination')
+        make_tree(src, files, files_per_dir)
+        shutil.copytree(src, dst)
+        print(f"{files} files in {files // files_per_dir} directories, trees already in sync")
+        run('dircmp', legacy_compare, src, dst, files)
+        run('scandir', manifest_compare, src, dst, files)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
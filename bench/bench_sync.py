@@ -0,0 +1,262 @@
+# End-to-end benchmark of synchronize_directories on seeded synthetic trees.
+# Each scenario tree is generated, copied to a destination, then churned
+# (a share of the source files modified, added and deleted), and every sync
+# mode is run on a fresh copy of that starting point in its own process.
+# Reports wall time, syscalls and peak RSS per run, and compares them with
+# a saved baseline.
+#
+#   python bench/bench_sync.py [--scenarios tiny,huge,deep,wide]
+#       [--modes default,use_content,purge,two_way,hverify] [--churn PERCENT]
+#       [--scale N] [--seed N] [--dir PATH] [--tmpfs]
+#       [--save-baseline FILE] [--baseline FILE] [--tolerance PERCENT]
+#
+# Syscalls are counted with strace -c when it is installed. Otherwise the
+# file system calls made through Python's os module and open() are
+# counted, which leaves out what happens inside C helpers such as sendfile.
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import builtins
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import sync
+from bench_scan import CountingScandir, counts
+
+MODES = {
+    'default': {},
+    'use_content': {'use_content': True},
+    'purge': {'purge': True},
+    'two_way': {'two_way': True},
+    'hverify': {'hverify': True},
+}
+
+COUNTED_CALLS = ('stat', 'lstat', 'scandir', 'listdir', 'open', 'mkdir', 'makedirs', 'remove', 'unlink',
+                 'rmdir', 'replace', 'rename', 'link', 'utime', 'chmod', 'copy_file_range', 'sendfile')
+
+
+def tiny_files(scale):
+    # Many small files in a few hundred directories.
+    for i in range(20000 * scale):
+        yield f"d{i // 100:04d}/f{i:06d}.txt", i % 1024
+
+
+def huge_files(scale):
+    for i in range(4 * scale):
+        yield f"big{i:02d}.bin", 64 * 1024 * 1024
+
+
+def deep_files(scale):
+    # Chains of 40 nested directories with a few files at every level.
+    for i in range(4000 * scale):
+        chain, depth = divmod(i // 5, 40)
+        yield os.path.join(f"c{chain:03d}", *(f"l{level:02d}" for level in range(depth)), f"f{i:06d}.dat"), 4096
+
+
+def wide_files(scale):
+    for i in range(20000 * scale):
+        yield f"wide/f{i:06d}.dat", 2048
+
+
+SCENARIOS = {'tiny': tiny_files, 'huge': huge_files, 'deep': deep_files, 'wide': wide_files}
+
+
+def write_file(path, size, rng):
+    # Random data for small files; large ones repeat a random 1 MiB block
+    # behind a random header, which is as costly to copy and hash but much
+    # cheaper to generate.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        if size <= 1024 * 1024:
+            f.write(rng.randbytes(size))
+            return
+        block = rng.randbytes(1024 * 1024)
+        f.write(rng.randbytes(4096))
+        remaining = size - 4096
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def make_tree(root, scenario, scale, seed):
+    rng = random.Random(seed)
+    files = []
+    for relpath, size in SCENARIOS[scenario](scale):
+        write_file(os.path.join(root, relpath), size, rng)
+        files.append((relpath, size))
+    return files
+
+
+def churn(root, files, percent, seed):
+    # Modifies, deletes and adds percent% of the files each. Modified files
+    # get an mtime in the future so same-tick writes are still detected.
+    rng = random.Random(seed + 1)
+    n = (len(files) * percent + 99) // 100
+    picked = rng.sample(files, min(len(files), 2 * n))
+    future = time.time() + 10
+    for relpath, size in picked[:n]:
+        path = os.path.join(root, relpath)
+        write_file(path, size, rng)
+        os.utime(path, (future, future))
+    for relpath, size in picked[n:]:
+        os.remove(os.path.join(root, relpath))
+    for i in range(n):
+        relpath, size = files[rng.randrange(len(files))]
+        write_file(os.path.join(root, os.path.dirname(relpath), f"new{i:06d}.dat"), size, rng)
+
+
+def install_counters():
+    originals = {}
+    for name in COUNTED_CALLS:
+        if hasattr(os, name):
+            originals[(os, name)] = getattr(os, name)
+    originals[(builtins, 'open')] = builtins.open
+
+    def counted(func):
+        def wrapper(*args, **kwargs):
+            counts['calls'] += 1
+            result = func(*args, **kwargs)
+            if func is originals.get((os, 'scandir')):
+                return CountingScandir(result)
+            return result
+        return wrapper
+
+    for (module, name), func in originals.items():
+        setattr(module, name, counted(func))
+
+
+def child(args):
+    # Runs one sync in this process and reports on stdout.
+    source, dest, options, count_calls = json.loads(args)
+    if count_calls:
+        install_counters()
+    start = time.perf_counter()
+    try:
+        sync.synchronize_directories(source, dest, log_func=lambda message: None, **options)
+    except sync.SyncError:
+        pass
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'seconds': elapsed, 'calls': counts['calls']}))
+
+
+def run_child(source, dest, options, count_calls=False, use_strace=False):
+    command = [sys.executable, os.path.abspath(__file__), '--child',
+               json.dumps([source, dest, options, count_calls])]
+    trace = None
+    if use_strace:
+        trace = dest + '.strace'
+        command = ['strace', '-f', '-c', '-o', trace] + command
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    # wait4 instead of proc.wait() to get this child's own peak RSS.
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise RuntimeError(f"benchmark run failed with exit code {proc.returncode}")
+    result = json.loads(output)
+    result['rss_kib'] = usage.ru_maxrss
+    if trace is not None:
+        with open(trace) as f:
+            total = [line for line in f if line.rstrip().endswith('total')]
+        result['calls'] = int(total[0].split()[2]) if total else None
+        os.remove(trace)
+    return result
+
+
+def measure(source, start_dest, work, options, use_strace):
+    # Timing and RSS from a plain run, syscalls from a second run on another
+    # fresh copy, so the counting does not skew the timing.
+    results = {}
+    for count_calls in (False, True):
+        dest = os.path.join(work, 'run')
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        shutil.copytree(start_dest, dest, symlinks=True)
+        result = run_child(source, dest, options, count_calls and not use_strace, count_calls and use_strace)
+        if count_calls:
+            results['calls'] = result['calls']
+        else:
+            results['seconds'] = result['seconds']
+            results['rss_kib'] = result['rss_kib']
+    shutil.rmtree(os.path.join(work, 'run'))
+    return results
+
+
+def compare_line(key, result, baseline, tolerance):
+    old = baseline.get(key)
+    if old is None:
+        return ''
+    parts = []
+    regressed = False
+    for field in ('seconds', 'calls', 'rss_kib'):
+        if old.get(field) and result.get(field) is not None:
+            change = (result[field] - old[field]) * 100 / old[field]
+            regressed = regressed or change > tolerance
+            parts.append(f"{field} {change:+.0f}%")
+    return "  vs baseline: " + ", ".join(parts) + ("  REGRESSION" if regressed else '')
+
+
+def main():
+    if '--child' in sys.argv:
+        child(sync.option_value(sys.argv, '--child'))
+        return
+
+    scenarios = sync.option_value(sys.argv, '--scenarios', ','.join(SCENARIOS)).split(',')
+    modes = sync.option_value(sys.argv, '--modes', ','.join(MODES)).split(',')
+    percent = int(sync.option_value(sys.argv, '--churn', 5))
+    scale = int(sync.option_value(sys.argv, '--scale', 1))
+    seed = int(sync.option_value(sys.argv, '--seed', 1))
+    tolerance = float(sync.option_value(sys.argv, '--tolerance', 10))
+    save_path = sync.option_value(sys.argv, '--save-baseline')
+    baseline_path = sync.option_value(sys.argv, '--baseline')
+    parent = sync.option_value(sys.argv, '--dir')
+    if parent is None and '--tmpfs' in sys.argv:
+        parent = '/dev/shm'
+    use_strace = shutil.which('strace') is not None
+
+    baseline = {}
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    results = {}
+    tmp = tempfile.mkdtemp(prefix='bench_sync_', dir=parent)
+    try:
+        print(f"churn {percent}%, scale {scale}, seed {seed}, "
+              f"syscalls counted with {'strace' if use_strace else 'Python wrappers'}")
+        print(f"{'scenario':9} {'mode':12} {'seconds':>8} {'syscalls':>9} {'peak RSS':>10}")
+        for scenario in scenarios:
+            source = os.path.join(tmp, 'source')
+            synced = os.path.join(tmp, 'synced')
+            empty = os.path.join(tmp, 'empty')
+            files = make_tree(source, scenario, scale, seed)
+            os.makedirs(empty)
+            runs = [('initial', source, empty, {})]
+            shutil.copytree(source, synced)
+            churn(source, files, percent, seed)
+            runs += [(mode, source, synced, MODES[mode]) for mode in modes]
+            for mode, src, start_dest, options in runs:
+                result = measure(src, start_dest, tmp, options, use_strace)
+                key = f"{scenario}/{mode}"
+                results[key] = result
+                calls = '-' if result['calls'] is None else result['calls']
+                print(f"{scenario:9} {mode:12} {result['seconds']:8.3f} {calls:>9} {result['rss_kib']:>7} KiB"
+                      + compare_line(key, result, baseline, tolerance))
+            for path in (source, synced, empty):
+                shutil.rmtree(path)
+    finally:
+        shutil.rmtree(tmp)
+
+    if save_path:
+        with open(save_path, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == "__main__":
+    main()
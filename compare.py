@@ -0,0 +1,151 @@
+import random
+
+from throttle import engaged
+
+BUFSIZE = 8 * 1024
+SAMPLE_BLOCK = 64 * 1024
+SAMPLE_COUNT = 8
+
+# Ways to tell whether two files of the same size have the same contents,
+# cheapest first. size, mtime and ctime only look at metadata and can only
+# tell that two files are the same; sample, content and hash read the
+# files and can only tell that they differ.
+COMPARE_STRATEGIES = ('size', 'mtime', 'ctime', 'sample', 'content', 'hash')
+SHORTCUTS = ('size', 'mtime', 'ctime')
+
+
+def parse_tiers(text):
+    tiers = [name.strip() for name in text.split(',') if name.strip()]
+    if not tiers:
+        raise ValueError("No compare strategy given")
+    for name in tiers:
+        if name not in COMPARE_STRATEGIES:
+            raise ValueError(f"Unknown compare strategy: {name} (choose from {', '.join(COMPARE_STRATEGIES)})")
+    return tiers
+
+
+def default_tiers(use_ctime=False, use_content=False):
+    # The rules of filecmp.cmp: equal mtimes are enough, otherwise compare
+    # the contents.
+    if use_content:
+        return ['content']
+    return ['ctime' if use_ctime else 'mtime', 'content']
+
+
+def same_contents(path1, path2, throttle=None, cancel=None):
+    throttle = engaged(throttle)
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        try:
+            while True:
+                if cancel is not None:
+                    cancel.check()
+                b1 = f1.read(BUFSIZE)
+                b2 = f2.read(BUFSIZE)
+                if throttle is not None and b1:
+                    throttle.read(len(b1), f1)
+                    throttle.read(len(b2), f2)
+                if b1 != b2:
+                    return False
+                if not b1:
+                    return True
+        finally:
+            if throttle is not None:
+                throttle.done(f1, f2)
+
+
+def sample_offsets(size, rng, block=SAMPLE_BLOCK, count=SAMPLE_COUNT):
+    # Head, tail and count random blocks in between.
+    offsets = {0, size - block}
+    offsets.update(rng.randrange(block, size - block) for _ in range(count))
+    return sorted(offsets)
+
+
+def same_samples(path1, path2, size, rng, block=SAMPLE_BLOCK, count=SAMPLE_COUNT, throttle=None, cancel=None):
+    if size <= (count + 2) * block:
+        return same_contents(path1, path2, throttle, cancel)
+    throttle = engaged(throttle)
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        for offset in sample_offsets(size, rng, block, count):
+            f1.seek(offset)
+            f2.seek(offset)
+            if throttle is not None:
+                throttle.read(block)
+                throttle.read(block)
+            if f1.read(block) != f2.read(block):
+                return False
+    return True
+
+
+class Comparator:
+    # Decides whether two scanned files differ by running the tiers in
+    # order until one of them is sure: a metadata shortcut that finds the
+    # files the same, or a content check that finds a difference. Files of
+    # different sizes always differ. When no tier is sure, the files are the
+    # same if the last tier run was a content check that passed, so
+    # "mtime,sample,hash" only samples files with changed mtimes and only
+    # hashes those whose samples match.
+    def __init__(self, tiers, mtime_window_ns=0, digest_func=None, cached_digests=False, seed=None, throttle=None,
+                 cancel=None):
+        self.tiers = tiers
+        self.mtime_window_ns = mtime_window_ns
+        self.digest_func = digest_func
+        # With a hash cache the content check compares digests, which are
+        # often already known, instead of reading both files.
+        self.cached_digests = cached_digests
+        # Sampled offsets change from run to run, so an edit a run misses
+        # is likely to be found by the next one.
+        self.seed = random.randrange(1 << 32) if seed is None else seed
+        self.throttle = throttle
+        # A events.CancelToken, checked while whole files are read.
+        self.cancel = cancel
+        checks = {
+            'size': self.same_size,
+            'mtime': self.same_mtime,
+            'ctime': self.same_ctime,
+            'sample': self.same_sample,
+            'content': self.same_content,
+            'hash': self.same_hash,
+        }
+        self.checks = [(name in SHORTCUTS, checks[name]) for name in tiers]
+
+    def differ(self, left, right, left_path, right_path):
+        if left.size != right.size:
+            return True
+        same = False
+        for shortcut, check in self.checks:
+            result = check(left, right, left_path, right_path)
+            if shortcut:
+                if result:
+                    return False
+            elif not result:
+                return True
+            same = not shortcut
+        return not same
+
+    def same_size(self, left, right, left_path, right_path):
+        return True
+
+    def same_mtime(self, left, right, left_path, right_path):
+        # FAT and many SMB servers keep mtimes to 2 seconds, so a copy
+        # there can look a little older or newer than its source.
+        return abs(left.mtime_ns - right.mtime_ns) <= self.mtime_window_ns
+
+    def same_ctime(self, left, right, left_path, right_path):
+        # Like mtime, but the right side must also have been written after
+        # the left side last changed. An edit that puts the old mtime back
+        # still moves the ctime, which cannot be set. On Windows st_ctime
+        # is the creation time, so this works out the same as mtime there.
+        # Both ctimes come from the scan, so this costs no extra stat.
+        return self.same_mtime(left, right, left_path, right_path) and left.ctime_ns <= right.ctime_ns
+
+    def same_sample(self, left, right, left_path, right_path):
+        rng = random.Random(self.seed ^ left.size)
+        return same_samples(left_path, right_path, left.size, rng, throttle=self.throttle, cancel=self.cancel)
+
+    def same_content(self, left, right, left_path, right_path):
+        if self.cached_digests:
+            return self.same_hash(left, right, left_path, right_path)
+        return same_contents(left_path, right_path, self.throttle, self.cancel)
+
+    def same_hash(self, left, right, left_path, right_path):
+        return self.digest_func(left_path) == self.digest_func(right_path)
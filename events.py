@@ -0,0 +1,43 @@
+import threading
+from collections import namedtuple
+
+# Events passed to the events callback of synchronize_directories. The
+# callback is called from the sync thread and from copy/hash workers, so it
+# has to be thread-safe and quick.
+
+# A phase starts: scan, compare, copy, delete or verify.
+PhaseEvent = namedtuple('PhaseEvent', 'phase')
+# A plan is about to be executed: number of steps, bytes to copy.
+PlanEvent = namedtuple('PlanEvent', 'steps size')
+# A plan.Operation finished; error is the OSError if it failed.
+StepEvent = namedtuple('StepEvent', 'op error')
+# A verified file: result is 'match', 'mismatch' or 'missing'.
+VerifyEvent = namedtuple('VerifyEvent', 'relpath result')
+# Only from iter_events: a log line, and the end of the run (error is the
+# exception it ended with, or None).
+LogEvent = namedtuple('LogEvent', 'message')
+DoneEvent = namedtuple('DoneEvent', 'error')
+
+
+class SyncCancelled(Exception):
+    def __init__(self):
+        super().__init__("Synchronization cancelled")
+
+
+class CancelToken:
+    # Set from any thread (a Cancel button); the sync checks it between
+    # directories and files and before every block it reads, and stops
+    # with SyncCancelled.
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise SyncCancelled()
@@ -0,0 +1,275 @@
+import os
+import shutil
+import hashlib
+import threading
+from queue import SimpleQueue
+
+# Bytes of source data that may wait in the queues of one destination.
+FANOUT_BUDGET = 64 * 1024 * 1024
+
+
+class Feed:
+    # One source file being read for several destinations: the queue of
+    # every destination waiting for it, and the ones still fed.
+    def __init__(self, indexes):
+        self.queues = {index: SimpleQueue() for index in indexes}
+        self.waiting = set(indexes)
+        self.attached = set(indexes)
+
+
+class FanOut:
+    # Shares source reads between the runs of a multi-destination sync,
+    # one run (thread) per destination. Each run registers the source files
+    # its plan copies. The first run to copy a file reads it and passes
+    # every block on to the queues of the other runs that copy it, which
+    # write it out from there, so the file is read and hashed once.
+    #
+    # The reader never waits for a writer: a destination whose queues hold
+    # more than budget bytes (a slow disk, or a run that has not got to the
+    # file yet) is cut off from the file with the offset and hash state
+    # reached so far, and reads the rest itself. A throttle.Throttle counts
+    # the shared read once and every destination's writes.
+    def __init__(self, count, bufsize, checkpoint_bytes, budget=FANOUT_BUDGET, throttle=None, cancel=None):
+        self.lock = threading.Lock()
+        self.barrier = threading.Barrier(count)
+        self.bufsize = bufsize
+        self.checkpoint_bytes = checkpoint_bytes
+        self.budget = budget
+        self.throttle = throttle
+        # An events.CancelToken, checked before every block read or written.
+        self.cancel = cancel
+        self.buffered = [0] * count
+        self.expected = {}
+        self.feeds = {}
+        self.gone = set()
+        # The runs' hash caches (hashcache.HashCache): a source digest one
+        # run works out goes into all of them, so the others' verification
+        # passes find it there instead of reading the file again.
+        self.caches = {}
+
+    def member(self, index):
+        return FanOutMember(self, index)
+
+    def register(self, index, srcs):
+        with self.lock:
+            for src in srcs:
+                self.expected.setdefault(src, set()).add(index)
+        # Copying starts once every run knows what it copies; if a run
+        # failed before getting here, the rest go on without waiting.
+        try:
+            self.barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+
+    def add_cache(self, index, cache):
+        with self.lock:
+            self.caches[index] = cache
+
+    def remove_cache(self, index):
+        # Before the cache is closed: nothing is put into it after this.
+        with self.lock:
+            self.caches.pop(index, None)
+
+    def put_digest(self, st, algo, digest):
+        with self.lock:
+            for cache in self.caches.values():
+                cache.put(st, algo, digest)
+
+    def abort(self):
+        self.barrier.abort()
+
+    def release(self, index):
+        # The run for index is over: stop queueing data for it.
+        with self.lock:
+            self.gone.add(index)
+            self.buffered[index] = 0
+            for src, feed in list(self.feeds.items()):
+                feed.queues.pop(index, None)
+                feed.waiting.discard(index)
+                feed.attached.discard(index)
+                if not feed.waiting:
+                    del self.feeds[src]
+
+    def copy(self, index, src, dst, algo=None, checkpoint=None):
+        # Copies src to dst with its metadata, like copy_file_hashed, and
+        # returns the hex digest when algo is given.
+        with self.lock:
+            feed = self.feeds.get(src)
+            if feed is not None and index in feed.waiting:
+                feed.waiting.discard(index)
+                if not feed.waiting:
+                    del self.feeds[src]
+                queue = feed.queues[index]
+            else:
+                # First to copy it; a file copied a second time (a retry)
+                # is read on its own.
+                queue = None
+                followers = self.expected.pop(src, set()) - self.gone - {index}
+                if followers and feed is None:
+                    feed = self.feeds[src] = Feed(followers)
+                else:
+                    feed = None
+        if queue is not None:
+            return self.follow(index, feed, queue, src, dst, checkpoint)
+        return self.lead(feed, src, dst, algo, checkpoint)
+
+    def check(self):
+        if self.cancel is not None:
+            self.cancel.check()
+
+    def checkpointed(self, fdst, offset, synced, checkpoint):
+        if checkpoint is not None and offset - synced >= self.checkpoint_bytes:
+            fdst.flush()
+            os.fsync(fdst.fileno())
+            checkpoint(offset)
+            return offset
+        return synced
+
+    def wrote(self, block, fdst):
+        if self.throttle is not None:
+            self.throttle.write(len(block), fdst)
+
+    def done(self, *files):
+        if self.throttle is not None:
+            for f in files:
+                if f.writable():
+                    f.flush()
+            self.throttle.done(*files)
+
+    def publish(self, feed, block, offset, digest):
+        with self.lock:
+            for index in list(feed.attached):
+                queue = feed.queues.get(index)
+                if queue is None:
+                    feed.attached.discard(index)
+                elif self.buffered[index] + len(block) > self.budget:
+                    feed.attached.discard(index)
+                    queue.put(('rest', offset, digest.copy() if digest is not None else None))
+                else:
+                    self.buffered[index] += len(block)
+                    queue.put(('data', block))
+
+    def close_feed(self, feed, message):
+        with self.lock:
+            for index in feed.attached:
+                queue = feed.queues.get(index)
+                if queue is None:
+                    continue
+                if message[0] == 'rest' and message[2] is not None:
+                    # Every follower goes on hashing with its own copy.
+                    queue.put(('rest', message[1], message[2].copy()))
+                else:
+                    queue.put(message)
+            feed.attached.clear()
+
+    def lead(self, feed, src, dst, algo, checkpoint):
+        digest = hashlib.new(algo) if algo else None
+        offset = 0
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                synced = 0
+                while block := fsrc.read(self.bufsize):
+                    self.check()
+                    if self.throttle is not None:
+                        self.throttle.read(len(block), fsrc)
+                    if feed is not None:
+                        self.publish(feed, block, offset, digest)
+                    if digest is not None:
+                        digest.update(block)
+                    offset += len(block)
+                    fdst.write(block)
+                    self.wrote(block, fdst)
+                    synced = self.checkpointed(fdst, offset, synced, checkpoint)
+                self.done(fsrc, fdst)
+            shutil.copystat(src, dst)
+        except BaseException:
+            # Whatever went wrong here, the others carry on by themselves.
+            if feed is not None:
+                self.close_feed(feed, ('rest', offset, digest))
+            raise
+        hexdigest = digest.hexdigest() if digest is not None else None
+        if feed is not None:
+            self.close_feed(feed, ('end', hexdigest))
+        return hexdigest
+
+    def follow(self, index, feed, queue, src, dst, checkpoint):
+        offset = 0
+        try:
+            with open(dst, 'wb') as fdst:
+                synced = 0
+                while True:
+                    self.check()
+                    message = queue.get()
+                    if message[0] == 'data':
+                        block = message[1]
+                        with self.lock:
+                            self.buffered[index] -= len(block)
+                        fdst.write(block)
+                        self.wrote(block, fdst)
+                        offset += len(block)
+                        synced = self.checkpointed(fdst, offset, synced, checkpoint)
+                    elif message[0] == 'end':
+                        hexdigest = message[1]
+                        break
+                    else:
+                        _, offset, digest = message
+                        fdst.seek(offset)
+                        fdst.truncate()
+                        with open(src, 'rb') as fsrc:
+                            fsrc.seek(offset)
+                            while block := fsrc.read(self.bufsize):
+                                self.check()
+                                if self.throttle is not None:
+                                    self.throttle.read(len(block), fsrc)
+                                if digest is not None:
+                                    digest.update(block)
+                                fdst.write(block)
+                                self.wrote(block, fdst)
+                                offset += len(block)
+                                synced = self.checkpointed(fdst, offset, synced, checkpoint)
+                            self.done(fsrc)
+                        hexdigest = digest.hexdigest() if digest is not None else None
+                        break
+                self.done(fdst)
+            shutil.copystat(src, dst)
+            return hexdigest
+        except BaseException:
+            # Stop the reader feeding this copy and give back what it had
+            # queued.
+            with self.lock:
+                feed.attached.discard(index)
+                while not queue.empty():
+                    message = queue.get()
+                    if message[0] == 'data':
+                        self.buffered[index] -= len(message[1])
+            raise
+
+
+class FanOutMember:
+    # What the run for one destination sees of a FanOut.
+    def __init__(self, fanout, index):
+        self.fanout = fanout
+        self.index = index
+        self.registered = False
+
+    def register(self, srcs):
+        self.registered = True
+        self.fanout.register(self.index, srcs)
+
+    def copy(self, src, dst, algo=None, checkpoint=None):
+        return self.fanout.copy(self.index, src, dst, algo, checkpoint)
+
+    def add_cache(self, cache):
+        self.fanout.add_cache(self.index, cache)
+
+    def remove_cache(self):
+        self.fanout.remove_cache(self.index)
+
+    def put_digest(self, st, algo, digest):
+        self.fanout.put_digest(st, algo, digest)
+
+    def release(self):
+        if not self.registered:
+            # Ended before its plan was ready; nobody should wait for it.
+            self.fanout.abort()
+        self.fanout.release(self.index)
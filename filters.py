@@ -0,0 +1,214 @@
+import os
+import re
+import copy
+import time
+import hashlib
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+AGE_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+GLOB_CHARS = '*?[\\'
+
+
+def parse_amount(text, units, what):
+    text = text.strip().lower()
+    unit = text[-1:] if text[-1:].isalpha() else ''
+    if unit not in units:
+        raise ValueError(f"Unknown {what} unit in {text!r} (use {', '.join(u for u in units if u)})")
+    try:
+        return float(text[:len(text) - len(unit)]) * units[unit]
+    except ValueError:
+        raise ValueError(f"Not a {what}: {text!r}") from None
+
+
+def parse_size(text):
+    # "500", "64k", "1.5G": bytes, in binary multiples.
+    return int(parse_amount(text, SIZE_UNITS, 'size'))
+
+
+def parse_age(text):
+    # "90", "30m", "12h", "7d", "2w": seconds.
+    return parse_amount(text, AGE_UNITS, 'age')
+
+
+def read_rules(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+def glob_regex(pattern):
+    # .gitignore wildcards: * and ? stay within one path component, [...]
+    # is a character class, "**/" is any number of leading directories and
+    # a trailing "/**" everything inside.
+    parts = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            whole = i == 0 or pattern[i - 1] == '/'
+            if whole and pattern[i + 2:i + 3] == '/':
+                parts.append('(?:.*/)?')
+                i += 3
+                continue
+            if whole and i + 2 == n:
+                parts.append('.*')
+                i += 2
+                continue
+            parts.append('[^/]*')
+            i += 2
+        elif c == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif c == '?':
+            parts.append('[^/]')
+            i += 1
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                parts.append(re.escape(c))
+                i += 1
+                continue
+            body = pattern[i + 1:j]
+            negate = body[:1] in ('!', '^')
+            if negate:
+                body = body[1:]
+            body = body.replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]')
+            parts.append(f"[^/{body}]" if negate else f"[{body}]")
+            i = j + 1
+        elif c == '\\' and i + 1 < n:
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(c))
+            i += 1
+    return ''.join(parts)
+
+
+def parse_rule(line):
+    # (pattern, include, dir_only, anchored) for a .gitignore line, or None
+    # for blank lines and comments. A pattern with a slash other than a
+    # trailing one is matched against the whole path from the root; the
+    # others against the last component at any depth.
+    if line.endswith('\\ '):
+        line = line[:-2].rstrip() + '\\ '
+    else:
+        line = line.rstrip()
+    if not line or line.startswith('#'):
+        return None
+    include = line.startswith('!')
+    if include:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    anchored = '/' in line
+    line = line.lstrip('/')
+    if not line:
+        return None
+    return line, include, dir_only, anchored
+
+
+class PathFilter:
+    # Include/exclude rules in .gitignore syntax, compiled once. The last
+    # rule that matches a path decides; an excluded directory is skipped as
+    # a whole, so nothing under it can be included again. Paths are relative
+    # to the synchronized trees.
+    #
+    # Size and age limits are separate: a file outside them is not copied,
+    # and its copy in the destination is not deleted or verified.
+    def __init__(self, rules=(), min_size=None, max_size=None, min_age=None, max_age=None, now=None):
+        parsed = [parse_rule(line) for line in rules]
+        self.rules = [rule for rule in parsed if rule is not None]
+        # Tells apart the directory snapshots of runs with different rules.
+        self.key = hashlib.md5(repr(self.rules).encode('utf-8', 'surrogateescape')).hexdigest()[:8]
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_age = min_age
+        self.max_age = max_age
+        self.count_ages_from(time.time() if now is None else now)
+        self.limited = any(limit is not None for limit in (min_size, max_size, min_age, max_age))
+        self.matchers = {False: self.compile(False), True: self.compile(True)}
+
+    def count_ages_from(self, now):
+        self.newest_ns = int((now - self.min_age) * 1e9) if self.min_age is not None else None
+        self.oldest_ns = int((now - self.max_age) * 1e9) if self.max_age is not None else None
+
+    def at(self, now):
+        # The same filter with the ages counted from now. One filter serves
+        # a whole watch session, but every run has to measure ages from its
+        # own start, or new files never get old enough for --min-age.
+        path_filter = copy.copy(self)
+        path_filter.count_ages_from(now)
+        return path_filter
+
+    def compile(self, for_dirs):
+        # Four lookups, each finding the last matching rule of its kind:
+        # plain names and "*.ext" patterns in dicts, the other patterns
+        # without a slash in one regex over the name, and the anchored ones
+        # in one regex over the path. The alternatives go last rule first,
+        # so the first one that matches is the one that counts.
+        names = {}
+        extensions = {}
+        name_patterns = []
+        path_patterns = []
+        for index, (pattern, include, dir_only, anchored) in enumerate(self.rules):
+            if dir_only and not for_dirs:
+                continue
+            if anchored:
+                path_patterns.append((index, glob_regex(pattern)))
+            elif not any(c in pattern for c in GLOB_CHARS):
+                names[pattern] = index
+            elif pattern.startswith('*.') and not any(c in pattern[2:] for c in GLOB_CHARS + '.'):
+                extensions[pattern[2:]] = index
+            else:
+                name_patterns.append((index, glob_regex(pattern)))
+        return names, extensions, self.alternatives(name_patterns), self.alternatives(path_patterns)
+
+    def alternatives(self, patterns):
+        # (regex, rule index of each group); group n is the pattern of rule
+        # indexes[n].
+        if not patterns:
+            return None
+        patterns = patterns[::-1]
+        regex = re.compile('|'.join(f"({regex})" for index, regex in patterns), re.DOTALL)
+        return regex, [None] + [index for index, regex in patterns]
+
+    def excluded(self, relpath, is_dir):
+        names, extensions, name_re, path_re = self.matchers[is_dir]
+        if os.sep != '/':
+            relpath = relpath.replace(os.sep, '/')
+        name = relpath.rpartition('/')[2]
+        best = names.get(name, -1)
+        if extensions:
+            stem, dot, extension = name.rpartition('.')
+            if dot and extensions.get(extension, -1) > best:
+                best = extensions[extension]
+        if name_re is not None:
+            match = name_re[0].fullmatch(name)
+            if match is not None and name_re[1][match.lastindex] > best:
+                best = name_re[1][match.lastindex]
+        if path_re is not None:
+            match = path_re[0].fullmatch(relpath)
+            if match is not None and path_re[1][match.lastindex] > best:
+                best = path_re[1][match.lastindex]
+        return best >= 0 and not self.rules[best][1]
+
+    def prunes(self, reldir):
+        # Whether reldir is in (or is) an excluded directory.
+        while reldir:
+            if self.excluded(reldir, True):
+                return True
+            reldir = os.path.dirname(reldir)
+        return False
+
+    def skipped(self, entry):
+        if not self.limited or entry is None or entry.type != 'f':
+            return False
+        return ((self.min_size is not None and entry.size < self.min_size) or
+                (self.max_size is not None and entry.size > self.max_size) or
+                (self.newest_ns is not None and entry.mtime_ns > self.newest_ns) or
+                (self.oldest_ns is not None and entry.mtime_ns < self.oldest_ns))
@@ -0,0 +1,87 @@
+import os
+import time
+import sqlite3
+import threading
+
+DEFAULT_MAX_ENTRIES = 1000000
+COMMIT_EVERY = 1000
+
+
+class HashCache:
+    # Remembers file digests keyed by (device, inode). A row is only trusted
+    # while the file's size and mtime_ns still match what was hashed, so an
+    # unchanged file is never read again. ctime_ns is checked too: copy2 can
+    # rewrite a file and put back the very same mtime, but not the ctime.
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, rehash=False):
+        self.max_entries = max_entries
+        self.stamp = time.time_ns()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.hits = []
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            " dev INTEGER, ino INTEGER, algo TEXT, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER,"
+            " digest TEXT, used INTEGER, PRIMARY KEY (dev, ino, algo))"
+        )
+        if rehash:
+            self.conn.execute("DELETE FROM digests")
+        self.conn.commit()
+
+    def get(self, st, algo):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, ctime_ns, digest FROM digests WHERE dev = ? AND ino = ? AND algo = ?",
+                (st.st_dev, st.st_ino, algo)
+            ).fetchone()
+            if row is None or row[:3] != (st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+                return None
+            self.hits.append((self.stamp, st.st_dev, st.st_ino, algo))
+            if len(self.hits) >= COMMIT_EVERY:
+                self.flush_hits()
+            return row[3]
+
+    def flush_hits(self):
+        # Marks the rows read since the last flush as used in this run, in
+        # batches, so a pass over millions of cached files holds at most
+        # COMMIT_EVERY of them. Called with the lock held.
+        self.conn.executemany(
+            "UPDATE digests SET used = ? WHERE dev = ? AND ino = ? AND algo = ?", self.hits
+        )
+        self.conn.commit()
+        self.pending = 0
+        self.hits = []
+
+    def put(self, st, algo, digest):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (st.st_dev, st.st_ino, algo, st.st_size, st.st_mtime_ns, st.st_ctime_ns, digest, self.stamp)
+            )
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.conn.commit()
+                self.pending = 0
+
+    def digest(self, path, algo, compute):
+        # Stat before reading: if the file changes while it is hashed, the
+        # stored mtime is already stale and the next run hashes it again.
+        st = os.stat(path)
+        digest = self.get(st, algo)
+        if digest is None:
+            digest = compute(path)
+            self.put(st, algo, digest)
+        return digest
+
+    def close(self):
+        with self.lock:
+            self.flush_hits()
+            # Least recently used rows go first once the cache is over its size.
+            excess = self.conn.execute("SELECT COUNT(*) FROM digests").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.conn.execute(
+                    "DELETE FROM digests WHERE rowid IN (SELECT rowid FROM digests ORDER BY used LIMIT ?)",
+                    (excess,)
+                )
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,57 @@
+import os
+import json
+import threading
+
+from snapshot import root_key
+
+
+class Journal:
+    # Append-only record of a running plan: the steps that are finished and
+    # how far large copies got. After a crash, --resume runs the saved plan
+    # again, minus the finished steps. A line lost with the crash only means
+    # that step is done once more.
+    def __init__(self, path, append=False):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.file.flush()
+
+    def done(self, op):
+        self.write(['done', op.op, os.path.abspath(op.dst)])
+
+    def checkpoint(self, dst, offset, st):
+        # The first offset bytes of dst's partial copy are on disk, copied
+        # from a source with this size and mtime.
+        self.write(['partial', os.path.abspath(dst), offset, st.st_size, st.st_mtime_ns])
+
+    def close(self):
+        self.file.close()
+
+
+def load_journal(path):
+    finished = set()
+    partials = {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn last line from the crash.
+                    break
+                if record[0] == 'done':
+                    finished.add((record[1], record[2]))
+                else:
+                    partials[record[1]] = tuple(record[2:])
+    except FileNotFoundError:
+        pass
+    return finished, partials
+
+
+def journal_paths(meta_dir, source):
+    key = root_key(source)
+    return (os.path.join(meta_dir, f"resume-{key}.plan"),
+            os.path.join(meta_dir, f"resume-{key}.journal"))
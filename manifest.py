@@ -0,0 +1,89 @@
+import os
+from array import array
+from collections import namedtuple
+
+# One record per directory entry. type is 'd' for directories, 'f' for
+# regular files and 'l' for symlinks, which are never followed; anything
+# else (sockets, fifos) is skipped the same way filecmp.dircmp used to leave
+# it in common_funny.
+ManifestEntry = namedtuple('ManifestEntry', 'relpath type size mtime_ns inode ctime_ns')
+
+INODE_MASK = (1 << 64) - 1
+
+
+def encode_name(name):
+    # Any str os.scandir returns round-trips, including the lone surrogates
+    # undecodable names become.
+    return name.encode('utf-8', 'surrogatepass')
+
+
+def decode_name(data):
+    return data.decode('utf-8', 'surrogatepass')
+
+
+class Manifest:
+    # A scanned tree, stored by column instead of as one ManifestEntry per
+    # entry. Each directory path is stored once; an entry keeps the index of
+    # its directory, its name in a shared byte buffer, and type, size,
+    # mtime_ns, inode and ctime_ns in typed arrays. That is about 50 bytes
+    # plus the name per entry, against about 380 for a ManifestEntry with
+    # its own path string and int objects. Iterating or indexing yields ManifestEntry
+    # records built on the fly.
+    #
+    # errors holds (relpath, OSError) for each directory that could not be
+    # listed and each entry that could not be stat'ed. What is under them is
+    # missing from the manifest without being gone from the tree.
+    __slots__ = ('dirs', 'parents', 'names', 'name_ends', 'types', 'sizes', 'mtimes', 'inodes', 'ctimes',
+                 'errors')
+
+    def __init__(self):
+        self.dirs = []
+        self.parents = array('I')
+        self.names = bytearray()
+        self.name_ends = array('Q')
+        self.types = bytearray()
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.inodes = array('Q')
+        self.ctimes = array('q')
+        self.errors = []
+
+    def add_dir(self, reldir):
+        self.dirs.append(reldir)
+        return len(self.dirs) - 1
+
+    def append(self, parent, name, type, size, mtime_ns, inode, ctime_ns):
+        self.parents.append(parent)
+        self.names += encode_name(name)
+        self.name_ends.append(len(self.names))
+        self.types.append(ord(type))
+        self.sizes.append(size)
+        self.mtimes.append(mtime_ns)
+        # Windows can report 128-bit file IDs; the low half is enough to
+        # group hard links.
+        self.inodes.append(inode & INODE_MASK)
+        self.ctimes.append(ctime_ns)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        start = self.name_ends[index - 1] if index else 0
+        name = decode_name(self.names[start:self.name_ends[index]])
+        reldir = self.dirs[self.parents[index]]
+        return ManifestEntry(os.path.join(reldir, name) if reldir else name, chr(self.types[index]),
+                             self.sizes[index], self.mtimes[index], self.inodes[index], self.ctimes[index])
+
+    def __iter__(self):
+        dirs, parents, names, types = self.dirs, self.parents, self.names, self.types
+        sizes, mtimes, inodes, ctimes = self.sizes, self.mtimes, self.inodes, self.ctimes
+        join = os.path.join
+        start = 0
+        for index, end in enumerate(self.name_ends):
+            name = decode_name(names[start:end])
+            start = end
+            reldir = dirs[parents[index]]
+            yield ManifestEntry(join(reldir, name) if reldir else name, chr(types[index]),
+                                sizes[index], mtimes[index], inodes[index], ctimes[index])
@@ -0,0 +1,61 @@
+from collections import defaultdict
+
+# Files at least this big are also matched by contents when their mtime
+# differs; for smaller ones reading both sides costs about as much as
+# copying.
+MOVE_CONTENT_MIN = 1024 * 1024
+# How many same-size files a new file is compared with at most.
+MOVE_CANDIDATES = 4
+# Duplicates smaller than this are not worth hashing.
+DEDUPE_MIN_SIZE = 64 * 1024
+
+
+class MoveCandidates:
+    # Files that are only in the destination, the ones a purge deletes,
+    # looked up for files that are only in the source. A rename keeps size
+    # and mtime, and the destination copy has the source's mtime, so those
+    # two are the key; large files are also tried by size alone, in case
+    # the move was a copy and delete that did not keep the mtime. Whether
+    # two files are really the same is left to the caller's same(right).
+    def __init__(self, comp, content_min=MOVE_CONTENT_MIN):
+        self.by_meta = defaultdict(list)
+        self.by_size = defaultdict(list)
+        self.moved = set()
+        for left, right in comp:
+            if left is None and right.type == 'f':
+                self.by_meta[(right.size, right.mtime_ns)].append(right)
+                if right.size >= content_min:
+                    self.by_size[right.size].append(right)
+
+    def match(self, left, same):
+        candidates = self.by_meta.get((left.size, left.mtime_ns), [])[:MOVE_CANDIDATES]
+        candidates += [right for right in self.by_size.get(left.size, [])[:MOVE_CANDIDATES]
+                       if right.mtime_ns != left.mtime_ns]
+        for right in candidates:
+            if right.relpath not in self.moved and same(right):
+                self.moved.add(right.relpath)
+                self.by_meta[(right.size, right.mtime_ns)].remove(right)
+                if right in self.by_size.get(right.size, ()):
+                    self.by_size[right.size].remove(right)
+                return right
+        return None
+
+
+def find_duplicates(ops, digest_func, min_size=DEDUPE_MIN_SIZE):
+    # Groups the copies of a plan by content: {dst of the first copy: [the
+    # other ops with the same data]}. Only files that share their size with
+    # another file in the plan are hashed.
+    by_size = defaultdict(list)
+    for op in ops:
+        if op.size >= min_size:
+            by_size[op.size].append(op)
+    duplicates = {}
+    for size, group in by_size.items():
+        if len(group) < 2:
+            continue
+        first = {}
+        for op in group:
+            original = first.setdefault(digest_func(op.src), op)
+            if original is not op:
+                duplicates.setdefault(original.dst, []).append(op)
+    return duplicates
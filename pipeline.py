@@ -0,0 +1,135 @@
+import os
+import time
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from manifest import Manifest
+
+DEFAULT_IO_DEPTH = 32
+# Directory listings read ahead of the one being added to a manifest, per
+# unit of depth.
+PREFETCH_PER_DEPTH = 4
+
+
+class ScanPipeline:
+    # Scans trees with many metadata requests in flight, for file systems
+    # where every call waits out a network round trip (NFS, SMB, FUSE).
+    # Reading directories and stat'ing their entries are separate stages,
+    # each with at most depth blocking calls running in a thread pool. The
+    # manifests come out exactly as scan_tree builds them: directories are
+    # added in manifest order while the listings of the ones coming up are
+    # read ahead, at most PREFETCH_PER_DEPTH * depth of them per tree, so
+    # memory stays bounded however wide the tree is.
+    #
+    # read_entries and entry_record are sync.py's, passed in the way
+    # watch.py gets scan_tree; path_filter is a filters.PathFilter. As with
+    # scan_tree, what cannot be read is listed in manifest.errors.
+    def __init__(self, read_entries, entry_record, depth=DEFAULT_IO_DEPTH, stats=None, cancel=None, path_filter=None):
+        self.read_entries = read_entries
+        self.entry_record = entry_record
+        self.depth = depth
+        self.stats = stats
+        self.cancel = cancel
+        self.path_filter = path_filter
+
+    def scan(self, roots):
+        # One manifest per root; the trees are scanned at the same time.
+        return asyncio.run(self.scan_all(roots))
+
+    async def scan_all(self, roots):
+        self.list_slots = asyncio.Semaphore(self.depth)
+        self.stat_slots = asyncio.Semaphore(self.depth)
+        with ThreadPoolExecutor(max_workers=2 * self.depth) as self.executor:
+            return await asyncio.gather(*(self.scan_tree(root) for root in roots))
+
+    async def call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def timed_stat(self, entry):
+        if self.stats is None:
+            return entry.stat(follow_symlinks=False)
+        start = time.perf_counter()
+        st = entry.stat(follow_symlinks=False)
+        self.stats.latency('stat', time.perf_counter() - start)
+        return st
+
+    async def stat_entry(self, entry, reldir, errors):
+        async with self.stat_slots:
+            try:
+                st = await self.call(self.timed_stat, entry)
+            except OSError as e:
+                if not isinstance(e, FileNotFoundError):
+                    errors.append((os.path.join(reldir, entry.name), e))
+                return None
+        return self.entry_record(entry, st)
+
+    async def listing(self, root, reldir, errors):
+        if self.cancel is not None:
+            self.cancel.check()
+        path = os.path.join(root, reldir) if reldir else root
+        async with self.list_slots:
+            entries = await self.call(partial(self.read_entries, path, path_filter=self.path_filter, reldir=reldir,
+                                              errors=errors))
+        if entries is None:
+            return None
+        records = []
+        it = iter(entries)
+
+        async def stat_worker():
+            for entry in it:
+                record = await self.stat_entry(entry, reldir, errors)
+                if record is not None:
+                    records.append(record)
+
+        await asyncio.gather(*(stat_worker() for _ in range(min(self.depth, len(entries)))))
+        return sorted(records)
+
+    async def scan_tree(self, root):
+        manifest = Manifest()
+        prefetched = {}
+        window = PREFETCH_PER_DEPTH * self.depth
+
+        def prefetch(reldir, children):
+            for child in children:
+                name, type = child[:2]
+                if len(prefetched) >= window:
+                    break
+                if type == 'd':
+                    relpath = os.path.join(reldir, name) if reldir else name
+                    prefetched[relpath] = asyncio.ensure_future(self.listing(root, relpath, manifest.errors))
+
+        async def take(reldir):
+            task = prefetched.pop(reldir, None)
+            children = await task if task is not None else await self.listing(root, reldir, manifest.errors)
+            if children:
+                prefetch(reldir, children)
+            return children
+
+        try:
+            children = await take('')
+            if not children:
+                return manifest
+            stack = [(manifest.add_dir(''), '', iter(children))]
+            while stack:
+                parent, reldir, it = stack[-1]
+                child = next(it, None)
+                if child is None:
+                    stack.pop()
+                    continue
+                name, type = child[:2]
+                manifest.append(parent, *child)
+                if type == 'd':
+                    relpath = os.path.join(reldir, name) if reldir else name
+                    children = await take(relpath)
+                    if children:
+                        stack.append((manifest.add_dir(relpath), relpath, iter(children)))
+            return manifest
+        finally:
+            for task in prefetched.values():
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # Fetch a failed read-ahead's error so asyncio does not
+                    # warn that it was never retrieved.
+                    task.exception()
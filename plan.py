@@ -0,0 +1,87 @@
+import os
+import json
+import zlib
+from collections import namedtuple, Counter
+
+# One step of a sync plan. op is one of mkdir, move, copy, update, delta,
+# link, clone, symlink, delete, rmtree or rmdir. src is where the data (or,
+# for mkdir, the directory times) comes from; a link points dst at target,
+# which the plan writes earlier, a clone copies target to dst within the
+# destination, a move renames target, an old destination file, to dst, and
+# a symlink makes dst a symlink with the same target as src.
+Operation = namedtuple('Operation', 'op src dst size target', defaults=(0, None))
+
+PLAN_VERSION = 1
+TRANSFER_OPS = ('copy', 'update', 'delta')
+DELETE_OPS = ('delete', 'rmtree', 'rmdir')
+
+PLAN_LABELS = (
+    ('mkdir', "{} director(ies) to create"),
+    ('move', "{} file(s) to move within the destination"),
+    ('copy', "{} file(s) to copy ({} bytes)"),
+    ('update', "{} file(s) to update ({} bytes)"),
+    ('delta', "{} file(s) to update block by block ({} bytes)"),
+    ('link', "{} file(s) to hard-link"),
+    ('clone', "{} file(s) to clone from a copy in the destination"),
+    ('symlink', "{} symlink(s) to copy"),
+    ('delete', "{} file(s) to delete"),
+    ('rmtree', "{} director(ies) to delete with their contents"),
+    ('rmdir', "{} empty director(ies) to delete"),
+)
+
+
+def write_plan(path, ops, source, dest):
+    # JSON Lines: a header, then one array per operation, so a plan with
+    # millions of steps can be written and read back one line at a time.
+    # Paths are stored absolute; a plan can be run from any directory.
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'version': PLAN_VERSION, 'source': os.path.abspath(source),
+                            'dest': os.path.abspath(dest)}) + '\n')
+        for op in ops:
+            op = op._replace(src=op.src and os.path.abspath(op.src), dst=os.path.abspath(op.dst),
+                             target=op.target and os.path.abspath(op.target))
+            f.write(json.dumps(list(op), separators=(',', ':')) + '\n')
+
+
+def read_plan(path):
+    # Yields the header first, then the operations.
+    with open(path, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('version') != PLAN_VERSION:
+            raise ValueError(f"{path} is not a sync plan this version can run")
+        yield header
+        for line in f:
+            if line.strip():
+                yield Operation(*json.loads(line))
+
+
+def plan_part(ops, index, count):
+    # Share of the plan for worker index out of count. Every worker creates
+    # all directories (that is idempotent); the other steps are spread by a
+    # hash of their path, keeping a link with the file it points to.
+    for op in ops:
+        if op.op == 'mkdir' or zlib.crc32(os.fsencode(op.target or op.dst)) % count == index:
+            yield op
+
+
+def summarize_plan(ops):
+    counts = Counter()
+    sizes = Counter()
+    for op in ops:
+        counts[op.op] += 1
+        sizes[op.op] += op.size
+    parts = [label.format(counts[op], sizes[op]) for op, label in PLAN_LABELS if counts[op]]
+    if not parts:
+        return "Plan: nothing to do"
+    total = sum(sizes[op] for op in TRANSFER_OPS)
+    return f"Plan: {', '.join(parts)}; {total} bytes to transfer"
+
+
+def format_operation(op):
+    if op.op in DELETE_OPS:
+        return f"{op.op} {op.dst}"
+    if op.op == 'link':
+        return f"link {op.dst} to {op.target}"
+    if op.op in ('move', 'clone'):
+        return f"{op.op} {op.target} to {op.dst}"
+    return f"{op.op} {op.src} to {op.dst}"
@@ -0,0 +1,107 @@
+import time
+import threading
+from collections import deque
+
+from stats import COPY_OPS
+from events import PhaseEvent, PlanEvent, StepEvent
+
+# How often the GUIs pull from a ProgressLog, and how many log lines their
+# log view keeps.
+FLUSH_INTERVAL_MS = 100
+LOG_VIEW_LINES = 1000
+
+
+def format_size(size):
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            return f"{size:.0f} {unit}" if unit == 'bytes' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class ProgressLog:
+    # Go-between for a sync running in a worker thread and a GUI. The sync
+    # only appends to a buffer, and the GUI drains it from a timer a few
+    # times per second, so 100k copied files mean a few UI updates per
+    # second instead of 100k queued events. At most max_pending lines wait
+    # between two drains; older ones are only in the log file, which gets
+    # every line. Counters come from the sync's events (pass self.event as
+    # its events callback).
+    def __init__(self, log_path=None, max_pending=LOG_VIEW_LINES):
+        self.lock = threading.Lock()
+        self.pending = deque(maxlen=max_pending)
+        self.skipped = 0
+        self.phase = None
+        self.steps = 0
+        self.done = 0
+        self.failed = 0
+        self.total = 0
+        self.copied = 0
+        self.started = None
+        self.log_path = log_path
+        self.file = open(log_path, 'w', encoding='utf-8', errors='replace') if log_path else None
+
+    def log(self, message):
+        with self.lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.skipped += 1
+            self.pending.append(message)
+            if self.file is not None:
+                self.file.write(message + '\n')
+
+    def event(self, event):
+        with self.lock:
+            if isinstance(event, PhaseEvent):
+                self.phase = event.phase
+            elif isinstance(event, PlanEvent):
+                self.steps += event.steps
+                self.total += event.size
+                if self.started is None:
+                    self.started = time.monotonic()
+            elif isinstance(event, StepEvent):
+                self.done += 1
+                if event.error is not None:
+                    self.failed += 1
+                elif event.op.op in COPY_OPS:
+                    self.copied += event.op.size
+
+    def drain(self):
+        with self.lock:
+            lines = list(self.pending)
+            self.pending.clear()
+            if self.skipped:
+                lines.insert(0, f"... {self.skipped} line(s) skipped, see {self.log_path or 'the log file'}")
+                self.skipped = 0
+        return lines
+
+    def status(self):
+        # Fraction done (by bytes, or by steps when there is nothing to
+        # copy) and a one-line summary with the rate and time left.
+        with self.lock:
+            phase, done, steps, failed, copied, total = (self.phase, self.done, self.steps, self.failed,
+                                                         self.copied, self.total)
+            elapsed = time.monotonic() - self.started if self.started is not None else 0
+        if total:
+            fraction = copied / total
+        else:
+            fraction = done / steps if steps else 0.0
+        rate = copied / elapsed if elapsed else 0
+        text = f"{done}/{steps} steps, {format_size(copied)} of {format_size(total)} copied, {format_size(rate)}/s"
+        if phase:
+            text = f"{phase.capitalize()}: {text}"
+        if failed:
+            text += f", {failed} failed"
+        if rate and total > copied:
+            text += f", about {format_duration((total - copied) / rate)} left"
+        return min(fraction, 1.0), text
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,218 @@
+import os
+import stat
+import errno
+import shutil
+from collections import Counter
+from concurrent.futures import wait, FIRST_COMPLETED
+
+# Threads removing files and directories in the delete phase.
+PURGE_JOBS = 8
+# A tree is split into about this many subtrees per thread, which the
+# threads then remove one each.
+SPLIT_PER_JOB = 4
+# Without these (Windows), trees are removed with shutil.rmtree.
+DIR_FD_SUPPORTED = ({os.open, os.unlink, os.rmdir} <= os.supports_dir_fd and os.scandir in os.supports_fd)
+# O_NOFOLLOW: a directory replaced by a symlink is not opened.
+OPEN_FLAGS = (os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0) |
+              getattr(os, 'O_CLOEXEC', 0))
+# The root of a tree may be a symlink; the user named it.
+ROOT_FLAGS = OPEN_FLAGS & ~getattr(os, 'O_NOFOLLOW', 0)
+
+
+class PurgeRefused(Exception):
+    pass
+
+
+def check_purge(doomed, total, limit, where):
+    # Refuses a run that would delete more than limit percent of the
+    # entries scanned in where: an empty or unmounted source looks exactly
+    # like one whose files were all deleted.
+    if limit is not None and total and doomed * 100 > limit * total:
+        raise PurgeRefused(f"Refusing to delete {doomed} of {total} entries in {where} "
+                           f"({doomed * 100 / total:.1f}%, the limit is {limit:g}%)")
+
+
+class PurgeDeferred(PurgeRefused):
+    # A run over some directories only would go over the limit; a full run
+    # has to look at the whole trees first.
+    pass
+
+
+class DeleteBudget:
+    # The limit for runs that only look at some directories (watch mode),
+    # which cannot tell what share of a tree they delete: the entries each
+    # tree had at the last full run, and how many have been deleted since.
+    def __init__(self):
+        self.totals = {}
+        self.deleted = Counter()
+
+    def reset(self, root, total):
+        self.totals[root] = total
+        self.deleted[root] = 0
+
+    def check(self, doomed, limit, root):
+        if limit is None or not doomed:
+            return
+        total = self.totals.get(root)
+        if not total or (self.deleted[root] + doomed) * 100 > limit * total:
+            raise PurgeDeferred(f"Deleting {doomed} more entries in {root} needs a full run to check the "
+                                f"limit of {limit:g}%")
+        self.deleted[root] += doomed
+
+
+def unlink_entry(name, dir_fd):
+    try:
+        os.unlink(name, dir_fd=dir_fd)
+    except FileNotFoundError:
+        pass
+
+
+def rmdir_entry(name, dir_fd):
+    try:
+        os.rmdir(name, dir_fd=dir_fd)
+    except FileNotFoundError:
+        pass
+
+
+def remove_entry(root, relpath, directory=False):
+    # os.remove (or os.rmdir) of relpath in the tree at root, opening every
+    # directory on the way relative to the one before it. A directory that
+    # was swapped for a symlink since the scan fails to open (ELOOP) instead
+    # of being walked through, so nothing outside the tree is removed.
+    if not DIR_FD_SUPPORTED:
+        path = os.path.join(root, relpath)
+        if directory:
+            os.rmdir(path)
+        else:
+            os.remove(path)
+        return
+    *dirs, name = relpath.split(os.sep)
+    fd = os.open(root, ROOT_FLAGS)
+    try:
+        for part in dirs:
+            parent = fd
+            fd = os.open(part, OPEN_FLAGS, dir_fd=parent)
+            os.close(parent)
+        if directory:
+            os.rmdir(name, dir_fd=fd)
+        else:
+            os.unlink(name, dir_fd=fd)
+    finally:
+        os.close(fd)
+
+
+def open_subdir(name, dir_fd):
+    # Descriptor of the directory name in dir_fd, or None if it is gone or
+    # is no longer a directory, in which case it is unlinked like a file.
+    # A symlink put in its place is removed, not followed.
+    try:
+        return os.open(name, OPEN_FLAGS, dir_fd=dir_fd)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        if e.errno not in (errno.ELOOP, errno.ENOTDIR):
+            raise
+    unlink_entry(name, dir_fd)
+    return None
+
+
+def clear_directory(fd):
+    # Unlinks everything in the open directory fd except subdirectories,
+    # whose names are returned. Every name is resolved relative to fd
+    # (unlinkat), never walked from the root.
+    with os.scandir(fd) as it:
+        entries = list(it)
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.name)
+        else:
+            unlink_entry(entry.name, fd)
+    return subdirs
+
+
+def remove_subtree(parent_fd, name, check=None):
+    # shutil.rmtree(name, dir_fd=parent_fd), depth first with one open
+    # directory per level.
+    fd = open_subdir(name, parent_fd)
+    if fd is None:
+        return
+    stack = [[parent_fd, name, fd, None]]
+    try:
+        while stack:
+            level = stack[-1]
+            parent, name, fd, subdirs = level
+            if subdirs is None:
+                if check is not None:
+                    check()
+                subdirs = level[3] = iter(clear_directory(fd))
+            child = next(subdirs, None)
+            if child is None:
+                stack.pop()
+                os.close(fd)
+                rmdir_entry(name, parent)
+                continue
+            child_fd = open_subdir(child, fd)
+            if child_fd is not None:
+                stack.append([fd, child, child_fd, None])
+    finally:
+        for parent, name, fd, subdirs in stack:
+            os.close(fd)
+
+
+def remove_tree(path, pool, jobs=PURGE_JOBS, check=None):
+    # shutil.rmtree with the work shared by the threads of pool. The top
+    # levels are cleared here, one level at a time, until there are enough
+    # subtrees to go round; each subtree is then removed by one thread,
+    # and the directories split here go last, deepest first. The calling
+    # thread only waits, so a pool thread never waits on another task.
+    if not stat.S_ISDIR(os.lstat(path).st_mode):
+        # A symlink (or file) put where the scan saw a directory: the link
+        # goes, what it points to stays.
+        os.unlink(path)
+        return
+    if not DIR_FD_SUPPORTED:
+        shutil.rmtree(path)
+        return
+    root = os.open(path, OPEN_FLAGS)
+    # (parent fd, name, fd) of the directories held open while the
+    # subtrees under them are removed.
+    opened = []
+    try:
+        subtrees = [(root, name) for name in clear_directory(root)]
+        while subtrees and len(subtrees) < jobs * SPLIT_PER_JOB:
+            level = []
+            for parent, name in subtrees:
+                fd = open_subdir(name, parent)
+                if fd is not None:
+                    opened.append((parent, name, fd))
+                    level.extend((fd, child) for child in clear_directory(fd))
+            subtrees = level
+            if check is not None:
+                check()
+        pending = {pool.submit(remove_subtree, parent, name, check) for parent, name in subtrees}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                if check is not None:
+                    check()
+        finally:
+            for future in pending:
+                future.cancel()
+            wait(pending)
+        for parent, name, fd in reversed(opened):
+            rmdir_entry(name, parent)
+    finally:
+        for parent, name, fd in opened:
+            os.close(fd)
+        os.close(root)
+    os.rmdir(path)
+
+
+def move_to_trash(path, target):
+    # One rename, however big the subtree is. Raises OSError (EXDEV) when
+    # target is on another filesystem.
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.rename(path, target)
@@ -1,20 +1,19 @@
 import os
-import filecmp
-import shutil
-import hashlib
+import sync
+from progress import ProgressLog, FLUSH_INTERVAL_MS, LOG_VIEW_LINES
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QLabel, QLineEdit, QPushButton, QCheckBox, QTextEdit, QFileDialog,
-    QMessageBox, QStyleFactory
+    QLabel, QLineEdit, QPushButton, QCheckBox, QPlainTextEdit, QProgressBar, QSpinBox,
+    QFileDialog, QMessageBox, QStyleFactory
 )
-from PySide6.QtCore import Qt, QThread, Signal
+from PySide6.QtCore import Qt, QThread, QTimer, Signal
 
 class SyncThread(QThread):
-    update_progress = Signal(str)
     sync_completed = Signal()
+    sync_cancelled = Signal()
     sync_error = Signal(str)
 
-    def __init__(self, source, dest, verbose, purge, forcecopy, use_content, two_way, hverify):
+    def __init__(self, source, dest, verbose, purge, forcecopy, use_content, two_way, hverify, progress, throttle=None):
         super().__init__()
         self.source = source
         self.dest = dest
@@ -24,119 +23,29 @@ class SyncThread(QThread):
         self.use_content = use_content
         self.two_way = two_way
         self.hverify = hverify
+        self.progress = progress
+        self.throttle = throttle
+        self.cancel = sync.CancelToken()
 
     def run(self):
+        # Log lines and events go into self.progress, which the window
+        # drains on a timer; no signal per file.
         try:
-            self.synchronize_directories(self.source, self.dest, self.verbose, self.purge, self.forcecopy, False, self.use_content, self.two_way, self.hverify, self.log)
+            self.synchronize_directories(self.source, self.dest, self.verbose, self.purge, self.forcecopy, False, self.use_content, self.two_way, self.hverify, self.progress.log)
             self.sync_completed.emit()
+        except sync.SyncCancelled:
+            self.sync_cancelled.emit()
         except Exception as e:
             self.sync_error.emit(str(e))
-
-    def log(self, message):
-        self.update_progress.emit(message)
+        finally:
+            self.progress.close()
 
     def synchronize_directories(self, source, dest, verbose, purge, forcecopy, use_ctime, use_content, two_way, hverify, log_func):
-        if not os.path.exists(dest):
-            os.makedirs(dest)
-            if verbose:
-                log_func(f"Created target directory: {dest}")
-
-        def compare_and_copy(src, dst, reverse=False):
-            comparison = filecmp.dircmp(src, dst)
-            copy_files(comparison, src, dst, reverse)
-            if purge:
-                delete_files(comparison, dst)
-
-        def copy_files(comp, src, dst, reverse):
-            for name in comp.left_only:
-                srcpath = os.path.join(src, name)
-                dstpath = os.path.join(dst, name)
-                if os.path.isdir(srcpath):
-                    shutil.copytree(srcpath, dstpath)
-                    if verbose:
-                        log_func(f"Copied directory: {srcpath} to {dstpath}")
-                else:
-                    shutil.copy2(srcpath, dstpath)
-                    if verbose:
-                        log_func(f"Copied file: {srcpath} to {dstpath}")
-
-            for name in comp.common_files:
-                srcpath = os.path.join(src, name)
-                dstpath = os.path.join(dst, name)
-                if forcecopy or not filecmp.cmp(srcpath, dstpath, shallow=not use_content):
-                    if reverse:
-                        shutil.copy2(dstpath, srcpath)
-                        if verbose:
-                            log_func(f"Updated file: {dstpath} to {srcpath}")
-                    else:
-                        shutil.copy2(srcpath, dstpath)
-                        if verbose:
-                            log_func(f"Updated file: {srcpath} to {dstpath}")
-
-            for subdir in comp.common_dirs:
-                compare_and_copy(os.path.join(src, subdir), os.path.join(dst, subdir), reverse)
-
-        def delete_files(comp, dst):
-            for name in comp.right_only:
-                dstpath = os.path.join(dst, name)
-                if os.path.isdir(dstpath):
-                    shutil.rmtree(dstpath)
-                    if verbose:
-                        log_func(f"Deleted directory: {dstpath}")
-                else:
-                    os.remove(dstpath)
-                    if verbose:
-                        log_func(f"Deleted file: {dstpath}")
-
-        def compute_file_md5(file_path):
-            md5_hash = hashlib.md5()
-            with open(file_path, 'rb') as f:
-                while chunk := f.read(8192):
-                    md5_hash.update(chunk)
-            return md5_hash.hexdigest()
-
-        def verify_md5(src, dst):
-            src_files = []
-            dst_files = []
-
-            for root, _, files in os.walk(src):
-                for name in files:
-                    src_files.append(os.path.relpath(os.path.join(root, name), src))
-
-            for root, _, files in os.walk(dst):
-                for name in files:
-                    dst_files.append(os.path.relpath(os.path.join(root, name), dst))
-
-            all_files = set(src_files + dst_files)
-            match = True
-
-            for file in all_files:
-                src_file = os.path.join(src, file)
-                dst_file = os.path.join(dst, file)
-
-                if os.path.exists(src_file) and os.path.exists(dst_file):
-                    src_md5 = compute_file_md5(src_file)
-                    dst_md5 = compute_file_md5(dst_file)
-                    if src_md5 != dst_md5:
-                        match = False
-                        log_func(f"MD5 mismatch for {file}: {src_md5} (source) vs {dst_md5} (destination)")
-                    else:
-                        log_func(f"MD5 match for {file}: {src_md5}")
-                else:
-                    match = False
-                    log_func(f"File {file} is not present in both source and destination")
-
-            if match:
-                log_func("All files are synchronized (MD5 hashes match).")
-            else:
-                log_func("Some files are not synchronized (MD5 hashes do not match).")
-
-        compare_and_copy(source, dest)
-        if two_way:
-            compare_and_copy(dest, source, reverse=True)
+        sync.synchronize_directories(source, dest, verbose=verbose, purge=purge, forcecopy=forcecopy, use_ctime=use_ctime,
+                                     use_content=use_content, two_way=two_way, hverify=hverify,
+                                     events=self.progress.event, cancel=self.cancel, throttle=self.throttle,
+                                     log_func=log_func)
 
-        if hverify:
-            verify_md5(source, dest)
 
 class SyncApp(QMainWindow):
     def __init__(self):
@@ -166,10 +75,34 @@ class SyncApp(QMainWindow):
         self.hverify_check = QCheckBox("Hash Verify")
         self.hverify_check.setChecked(True)
 
+        # Limits can be changed while a sync runs; 0 is no limit.
+        self.limit_label = QLabel("Limit MB/s:")
+        self.limit_spin = QSpinBox()
+        self.limit_spin.setRange(0, 100000)
+        self.iops_label = QLabel("Ops/s:")
+        self.iops_spin = QSpinBox()
+        self.iops_spin.setRange(0, 1000000)
+        self.idle_check = QCheckBox("Idle I/O")
+        self.throttle = None
+
         self.sync_button = QPushButton("Synchronize")
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setDisabled(True)
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 1000)
+        self.status_label = QLabel("")
 
-        self.progress_text = QTextEdit()
+        # Keeps only the last LOG_VIEW_LINES lines; the full log is in the
+        # log file.
+        self.progress_text = QPlainTextEdit()
         self.progress_text.setReadOnly(True)
+        self.progress_text.setMaximumBlockCount(LOG_VIEW_LINES)
+
+        self.progress = None
+        self.progress_timer = QTimer(self)
+        self.progress_timer.setInterval(FLUSH_INTERVAL_MS)
+        self.progress_timer.timeout.connect(self.flush_progress)
 
         source_layout = QVBoxLayout()
         source_layout.addWidget(self.source_label)
@@ -204,12 +137,27 @@ class SyncApp(QMainWindow):
         self.layout.addLayout(source_layout)
         self.layout.addLayout(dest_layout)
         self.layout.addLayout(checkboxes_layout)
-        self.layout.addWidget(self.sync_button)
+        throttle_layout = QHBoxLayout()
+        throttle_layout.addWidget(self.limit_label)
+        throttle_layout.addWidget(self.limit_spin)
+        throttle_layout.addWidget(self.iops_label)
+        throttle_layout.addWidget(self.iops_spin)
+        throttle_layout.addWidget(self.idle_check)
+        self.layout.addLayout(throttle_layout)
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addWidget(self.sync_button)
+        buttons_layout.addWidget(self.cancel_button)
+        self.layout.addLayout(buttons_layout)
+        self.layout.addWidget(self.progress_bar)
+        self.layout.addWidget(self.status_label)
         self.layout.addWidget(self.progress_text)
 
         self.source_button.clicked.connect(self.on_browse_source)
         self.dest_button.clicked.connect(self.on_browse_dest)
         self.sync_button.clicked.connect(self.on_sync)
+        self.cancel_button.clicked.connect(self.on_cancel)
+        self.limit_spin.valueChanged.connect(self.on_limits)
+        self.iops_spin.valueChanged.connect(self.on_limits)
 
         # Set a better theme for visibility
         QApplication.setStyle(QStyleFactory.create("Windows"))
@@ -243,23 +191,68 @@ class SyncApp(QMainWindow):
             QMessageBox.critical(self, "Error", "Please select both source and destination directories.")
             return
 
+        try:
+            log_dir = os.path.join(dest, sync.META_DIR)
+            os.makedirs(log_dir, exist_ok=True)
+            self.progress = ProgressLog(os.path.join(log_dir, 'sync.log'))
+        except OSError as e:
+            QMessageBox.critical(self, "Error", f"Cannot write to the destination directory: {e}")
+            return
+
         self.progress_text.clear()
+        self.progress_bar.setValue(0)
         self.sync_button.setDisabled(True)
 
-        self.sync_thread = SyncThread(source, dest, verbose, purge, forcecopy, use_content, two_way, hverify)
-        self.sync_thread.update_progress.connect(self.append_progress_text)
+        self.throttle = sync.Throttle(idle=self.idle_check.isChecked(), **self.limits())
+        self.sync_thread = SyncThread(source, dest, verbose, purge, forcecopy, use_content, two_way, hverify, self.progress, self.throttle)
         self.sync_thread.sync_completed.connect(self.sync_completed)
+        self.sync_thread.sync_cancelled.connect(self.sync_cancelled)
         self.sync_thread.sync_error.connect(self.sync_error)
         self.sync_thread.start()
-
-    def append_progress_text(self, message):
-        self.progress_text.append(message)
+        self.progress_timer.start()
+        self.cancel_button.setDisabled(False)
+
+    def limits(self):
+        rate = self.limit_spin.value() * 1024 * 1024
+        iops = self.iops_spin.value()
+        return dict(read_rate=rate, write_rate=rate, read_iops=iops, write_iops=iops)
+
+    def on_limits(self):
+        # Takes effect at the next block the running sync moves.
+        if self.throttle is not None:
+            self.throttle.set_limits(**self.limits())
+
+    def on_cancel(self):
+        # Stops at the next file or block; what was copied so far stays.
+        self.cancel_button.setDisabled(True)
+        self.sync_thread.cancel.cancel()
+
+    def flush_progress(self):
+        lines = self.progress.drain()
+        if lines:
+            self.progress_text.appendPlainText('\n'.join(lines))
+        fraction, text = self.progress.status()
+        self.progress_bar.setValue(int(fraction * 1000))
+        self.status_label.setText(text)
+
+    def finish_progress(self):
+        self.cancel_button.setDisabled(True)
+        self.progress_timer.stop()
+        self.flush_progress()
+        self.status_label.setText(f"{self.status_label.text()}. Full log: {self.progress.log_path}")
 
     def sync_completed(self):
+        self.finish_progress()
         QMessageBox.information(self, "Success", "Synchronization completed successfully!")
         self.sync_button.setDisabled(False)
 
+    def sync_cancelled(self):
+        self.finish_progress()
+        QMessageBox.information(self, "Cancelled", "Synchronization was cancelled.")
+        self.sync_button.setDisabled(False)
+
     def sync_error(self, error_message):
+        self.finish_progress()
         QMessageBox.critical(self, "Error", f"Synchronization failed: {error_message}")
         self.sync_button.setDisabled(False)
 
@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+from array import array
+
+from manifest import encode_name, decode_name
+
+# A directory whose mtime is this close to the start of the scan may still
+# change within the same timestamp tick, so its listing is not remembered.
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+# Bumped whenever a scan would list a directory differently; a snapshot
+# of another version is not used.
+SNAPSHOT_VERSION = 2
+
+LISTINGS_TABLE = ("CREATE TABLE listings (reldir BLOB PRIMARY KEY, mtime_ns INTEGER,"
+                  " names BLOB, types BLOB, sizes BLOB, mtimes BLOB, inodes BLOB, ctimes BLOB)")
+
+
+def pack_listing(children):
+    # The children of one directory by column, the way manifest.Manifest
+    # keeps them: names joined by NUL (which no name contains), one byte per
+    # type and little-endian arrays for the numbers.
+    names = b'\0'.join(encode_name(child[0]) for child in children)
+    types = bytes(ord(child[1]) for child in children)
+    columns = [array(typecode, (child[index] for child in children))
+               for index, typecode in ((2, 'q'), (3, 'q'), (4, 'Q'), (5, 'q'))]
+    if sys.byteorder == 'big':
+        for column in columns:
+            column.byteswap()
+    return (names, types) + tuple(column.tobytes() for column in columns)
+
+
+def unpack_listing(names, types, sizes, mtimes, inodes, ctimes):
+    columns = []
+    for typecode, data in (('q', sizes), ('q', mtimes), ('Q', inodes), ('q', ctimes)):
+        column = array(typecode)
+        column.frombytes(data)
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns.append(column)
+    names = [decode_name(name) for name in names.split(b'\0')] if types else []
+    if any(len(column) != len(types) for column in [names] + columns):
+        raise ValueError("Damaged listing")
+    return list(zip(names, map(chr, types), *columns))
+
+
+class TreeSnapshot:
+    # Directory listings from the previous run: for each reldir its mtime_ns
+    # and children, (name, type, size, mtime_ns, inode, ctime_ns) tuples.
+    # Adding, removing or renaming an entry moves the directory's mtime, so
+    # a directory whose mtime is unchanged can reuse its old listing.
+    #
+    # The file lives in the destination, which others may be able to write
+    # to, so it is an SQLite database of plain values, one row per directory
+    # with its children packed by column (pack_listing). Nothing is held in
+    # memory: a listing is read from the old file when a scan asks for it,
+    # and the listings of this run are written to a new file, which
+    # replaces the old one on save. With readonly (dry runs) no new file is
+    # written.
+    def __init__(self, path, rescan=False, readonly=False):
+        self.path = path
+        self.tmp = path + '.tmp'
+        self.start_ns = time.time_ns()
+        self.invalid = set()
+        self.old = None
+        self.new = None
+        if not rescan and os.path.exists(path):
+            try:
+                self.old = sqlite3.connect(path)
+                if self.old.execute("PRAGMA user_version").fetchone()[0] != SNAPSHOT_VERSION:
+                    raise sqlite3.DatabaseError("Old snapshot")
+                self.old.execute("SELECT reldir, mtime_ns, names, types, sizes, mtimes, inodes, ctimes FROM listings LIMIT 1")
+            except sqlite3.DatabaseError:
+                # Not a snapshot, or one in an older format.
+                self.old.close()
+                self.old = None
+        if not readonly:
+            if os.path.exists(self.tmp):
+                os.remove(self.tmp)
+            self.new = sqlite3.connect(self.tmp)
+            self.new.execute(f"PRAGMA user_version = {SNAPSHOT_VERSION}")
+            self.new.execute(LISTINGS_TABLE)
+
+    def lookup(self, reldir, mtime_ns):
+        if self.old is None or reldir in self.invalid:
+            return None
+        try:
+            row = self.old.execute(
+                "SELECT names, types, sizes, mtimes, inodes, ctimes FROM listings WHERE reldir = ? AND mtime_ns = ?",
+                (encode_name(reldir), mtime_ns)
+            ).fetchone()
+            return unpack_listing(*row) if row is not None else None
+        except (sqlite3.DatabaseError, ValueError, TypeError):
+            return None
+
+    def record(self, reldir, mtime_ns, children):
+        if self.new is not None and reldir not in self.invalid and mtime_ns < self.start_ns - RACY_WINDOW_NS:
+            self.new.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (encode_name(reldir), mtime_ns) + pack_listing(children))
+
+    def invalidate(self, reldir):
+        # Used for directories this run wrote into: an in-place update does
+        # not move the directory mtime, so the listing must not be trusted.
+        self.invalid.add(reldir)
+        if self.new is not None:
+            self.new.execute("DELETE FROM listings WHERE reldir = ?", (encode_name(reldir),))
+
+    def save(self):
+        self.new.commit()
+        self.new.close()
+        self.new = None
+        self.close()
+        os.replace(self.tmp, self.path)
+
+    def close(self):
+        # Without save, the listings of this run are dropped.
+        if self.old is not None:
+            self.old.close()
+            self.old = None
+        if self.new is not None:
+            self.new.close()
+            self.new = None
+            os.remove(self.tmp)
+
+
+def root_key(root):
+    # Short stable name for a tree, for per-tree files in the metadata folder.
+    return hashlib.md5(os.path.abspath(root).encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+
+
+def snapshot_path(meta_dir, root, variant=''):
+    suffix = f"-{variant}" if variant else ''
+    return os.path.join(meta_dir, f"snapshot-{root_key(root)}{suffix}.db")
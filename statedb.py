@@ -0,0 +1,44 @@
+import os
+import sqlite3
+
+from snapshot import root_key
+
+
+class SyncState:
+    # What every path looked like right after the last two-way sync:
+    # relpath -> (type, size, left_mtime_ns, right_mtime_ns). Comparing each
+    # side against this tells which side changed since then.
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " relpath TEXT PRIMARY KEY, type TEXT, size INTEGER,"
+            " left_mtime_ns INTEGER, right_mtime_ns INTEGER)"
+        )
+        self.entries = {row[0]: row[1:] for row in self.conn.execute("SELECT * FROM state")}
+        self.updates = {}
+
+    def get(self, relpath):
+        return self.entries.get(relpath)
+
+    def set(self, relpath, value):
+        self.updates[relpath] = value
+
+    def remove(self, relpath):
+        self.updates[relpath] = None
+
+    def save(self):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?)",
+            ((relpath,) + value for relpath, value in self.updates.items() if value is not None)
+        )
+        self.conn.executemany(
+            "DELETE FROM state WHERE relpath = ?",
+            ((relpath,) for relpath, value in self.updates.items() if value is None)
+        )
+        self.conn.commit()
+        self.conn.close()
+
+
+def state_path(meta_dir, source):
+    return os.path.join(meta_dir, f"state-{root_key(source)}.db")
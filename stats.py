@@ -0,0 +1,126 @@
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from collections import Counter
+
+COPY_OPS = ('copy', 'update', 'delta')
+
+
+class RunStats:
+    # Timings and counters for one or more runs: wall time per phase (scan,
+    # compare, copy, delete, verify), files and bytes per kind of step, and
+    # latency histograms with power-of-two microsecond buckets. Safe to
+    # update from the copy and hash worker threads.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.phases = Counter()
+        self.counts = Counter()
+        self.sizes = Counter()
+        self.latencies = {}
+        self.errors = 0
+        self.extra = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] += elapsed
+
+    def count(self, op, size=0):
+        with self.lock:
+            self.counts[op] += 1
+            self.sizes[op] += size
+
+    def latency(self, kind, seconds):
+        bucket = int(seconds * 1000000).bit_length()
+        with self.lock:
+            hist = self.latencies.get(kind)
+            if hist is None:
+                hist = self.latencies[kind] = {'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': Counter()}
+            hist['count'] += 1
+            hist['total'] += seconds
+            hist['max'] = max(hist['max'], seconds)
+            hist['buckets'][bucket] += 1
+
+    @contextmanager
+    def timed(self, kind):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latency(kind, time.perf_counter() - start)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        copied = sum(self.sizes[op] for op in COPY_OPS)
+        copy_time = self.phases['copy']
+        latencies = {}
+        for kind, hist in self.latencies.items():
+            latencies[kind] = {
+                'count': hist['count'],
+                'total_seconds': hist['total'],
+                'mean_seconds': hist['total'] / hist['count'],
+                'max_seconds': hist['max'],
+                # Upper bound of each bucket in microseconds -> calls.
+                'histogram_us': {str(1 << bucket): n for bucket, n in sorted(hist['buckets'].items())},
+            }
+        report = {
+            'elapsed_seconds': elapsed,
+            'phases_seconds': dict(self.phases),
+            'operations': {op: {'files': n, 'bytes': self.sizes[op]} for op, n in self.counts.items()},
+            'bytes_copied': copied,
+            'copy_bytes_per_second': copied / copy_time if copy_time else None,
+            'errors': self.errors,
+            'latency': latencies,
+        }
+        report.update(self.extra)
+        return report
+
+    def summary(self):
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+        copied = sum(self.sizes[op] for op in COPY_OPS)
+        rate = copied / self.phases['copy'] / (1024 * 1024) if self.phases['copy'] else 0
+        return f"Timings: {phases or 'none'}; {copied} bytes copied at {rate:.1f} MiB/s"
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write('\n')
+
+
+@contextmanager
+def instrument(stats, report_path=None, profile_path=None, trace_memory=False, top=10):
+    # Optional extras around a run: cProfile output for pstats/snakeviz,
+    # tracemalloc's peak and biggest allocation sites (added to the report),
+    # and the JSON report itself. All written even if the run fails.
+    profiler = cProfile.Profile() if profile_path else None
+    if trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield stats
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            sites = tracemalloc.take_snapshot().statistics('lineno')[:top]
+            tracemalloc.stop()
+            stats.extra['memory'] = {
+                'current_bytes': current,
+                'peak_bytes': peak,
+                'top_allocations': [{'site': str(site.traceback), 'bytes': site.size, 'blocks': site.count}
+                                    for site in sites],
+            }
+        if report_path:
+            stats.write(report_path)
@@ -38,7 +38,7 @@ class SyncApp:
         tk.Checkbutton(self.root, text="Verbose", variable=self.verbose).grid(row=2, column=0, sticky=tk.W)
         tk.Checkbutton(self.root, text="Purge", variable=self.purge).grid(row=2, column=1, sticky=tk.W)
         tk.Checkbutton(self.root, text="Force Copy", variable=self.forcecopy).grid(row=3, column=0, sticky=tk.W)
-        tk.Checkbutton(self.root, text="Use Creation Time", variable=self.use_ctime).grid(row=3, column=1, sticky=tk.W)
+        tk.Checkbutton(self.root, text="Use Change Time (ctime)", variable=self.use_ctime).grid(row=3, column=1, sticky=tk.W)
         tk.Checkbutton(self.root, text="Use Content", variable=self.use_content).grid(row=4, column=0, sticky=tk.W)
         tk.Checkbutton(self.root, text="Two-way Sync", variable=self.twoway_sync).grid(row=4, column=1, sticky=tk.W)
         tk.Checkbutton(self.root, text="Hash Verify", variable=self.hash_verify).grid(row=5, column=0, sticky=tk.W)
@@ -69,8 +69,8 @@ class SyncApp:
             "forcecopy": self.forcecopy.get(),
             "use_ctime": self.use_ctime.get(),
             "use_content": self.use_content.get(),
-            "two_way_sync": self.twoway_sync.get(),
-            "hash_verify": self.hash_verify.get()
+            "two_way": self.twoway_sync.get(),
+            "hverify": self.hash_verify.get()
         }
         
         try:
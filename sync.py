@@ -1,140 +1,1868 @@
-
 import os
 import sys
-import filecmp
+import stat
 import shutil
+import errno
 import hashlib
+import threading
+import time
+import itertools
+from collections import namedtuple, deque, Counter
+from queue import Queue, Full
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from hashcache import HashCache, DEFAULT_MAX_ENTRIES
+from snapshot import TreeSnapshot, snapshot_path
+from watch import make_watcher, wait_for_changes, MAX_PENDING_DIRS
+from statedb import SyncState, state_path
+from journal import Journal, load_journal, journal_paths
+from stats import RunStats, instrument
+from events import PhaseEvent, PlanEvent, StepEvent, VerifyEvent, LogEvent, DoneEvent, SyncCancelled, CancelToken
+from manifest import ManifestEntry, Manifest
+from compare import Comparator, parse_tiers, default_tiers
+from pipeline import ScanPipeline
+from fanout import FanOut
+from moves import MoveCandidates, find_duplicates
+from filters import PathFilter, read_rules, parse_size, parse_age
+from throttle import Throttle, engaged
+from purge import PURGE_JOBS, PurgeRefused, PurgeDeferred, DeleteBudget, check_purge, remove_entry, remove_tree, move_to_trash
+from plan import Operation, TRANSFER_OPS, DELETE_OPS, write_plan, read_plan, plan_part, summarize_plan, format_operation
+
+CopyTask = namedtuple('CopyTask', 'size srcpath dstpath action')
+
+COPY_BUFSIZE = 1024 * 1024
+HASH_BUFSIZE = 1024 * 1024
+COPY_RANGE_CHUNK = 64 * 1024 * 1024
+FICLONE = 0x40049409
+DELTA_BLOCK_SIZE = 128 * 1024
+DELTA_THRESHOLD = 64 * 1024 * 1024
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha256', 'blake2b')
+CONFLICT_POLICIES = ('newer', 'source', 'dest', 'skip')
+DEDUPE_MODES = ('clone', 'link')
+
+# Per-destination state (hash cache and friends) lives here and is never
+# synchronized, purged or verified.
+META_DIR = '.sandirsync'
+# Copies in progress are written under this suffix and renamed into place
+# when complete; scans skip them.
+PARTIAL_SUFFIX = '.sandirsync-part'
+# Everything else is synchronized, .git and __pycache__ included, as
+# shutil.copytree used to copy them; --exclude leaves them out.
+IGNORED_NAMES = [META_DIR]
+# Deleted entries go here in trash mode, one folder per run.
+TRASH_DIR = os.path.join(META_DIR, 'trash')
+
+
+def manifest_key(relpath):
+    # Sort so that a directory is followed directly by its whole subtree:
+    # "a/b" must come before "a.txt", which a plain string sort gets wrong.
+    return relpath.replace(os.sep, '\0')
+
+
+def vanished(error):
+    # Deleted (or replaced by a file) since its parent was listed, which is
+    # not an error: the entry is simply gone.
+    return isinstance(error, (FileNotFoundError, NotADirectoryError))
+
+
+def read_entries(path, ignore=IGNORED_NAMES, path_filter=None, reldir='', errors=None):
+    # The DirEntry objects a scan looks at, not stat'ed yet. Entries the
+    # filter excludes are dropped here, before they cost a stat call, and a
+    # directory dropped here is never read. A directory that cannot be read
+    # is added to errors.
+    try:
+        it = os.scandir(path)
+    except OSError as e:
+        if errors is not None and not vanished(e):
+            errors.append((reldir, e))
+        return None
+    with it:
+        entries = [entry for entry in it if entry.name not in ignore and not entry.name.endswith(PARTIAL_SUFFIX)]
+    if path_filter is not None and path_filter.rules:
+        entries = [entry for entry in entries
+                   if not path_filter.excluded(os.path.join(reldir, entry.name), entry_is_dir(entry))]
+    return entries
+
+
+def entry_is_dir(entry):
+    try:
+        return entry.is_dir(follow_symlinks=False)
+    except OSError:
+        return False
+
+
+def entry_record(entry, st):
+    # st is from lstat: a symlink is a leaf entry of its own, whatever it
+    # points to, so a scan never walks out of its tree through one.
+    if stat.S_ISDIR(st.st_mode):
+        return (entry.name, 'd', 0, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+    if stat.S_ISREG(st.st_mode):
+        return (entry.name, 'f', st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+    if stat.S_ISLNK(st.st_mode):
+        return (entry.name, 'l', st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+    return None
+
+
+def list_directory(path, ignore=IGNORED_NAMES, stats=None, path_filter=None, reldir='', errors=None):
+    entries = read_entries(path, ignore, path_filter, reldir, errors)
+    if entries is None:
+        return None
+    children = []
+    for entry in entries:
+        try:
+            # DirEntry caches the stat result, so this is the only
+            # metadata lookup an entry ever costs.
+            if stats is None:
+                st = entry.stat(follow_symlinks=False)
+            else:
+                start = time.perf_counter()
+                st = entry.stat(follow_symlinks=False)
+                stats.latency('stat', time.perf_counter() - start)
+        except OSError as e:
+            if errors is not None and not vanished(e):
+                errors.append((os.path.join(reldir, entry.name), e))
+            continue
+        record = entry_record(entry, st)
+        if record is not None:
+            children.append(record)
+    return children
+
+
+def scan_tree(root, ignore=IGNORED_NAMES, snapshot=None, base='', recursive=True, stats=None, cancel=None, path_filter=None):
+    # Depth-first with every listing sorted by name, which is manifest order
+    # (see walk_tree), so the entries go straight into a compact Manifest
+    # and nothing has to be sorted afterwards. What cannot be read ends up
+    # in manifest.errors.
+    manifest = Manifest()
+    errors = manifest.errors
+
+    def listing(reldir, mtime_ns):
+        # mtime_ns is None when it is not known to be current, i.e. the
+        # parent listing came from the snapshot.
+        if cancel is not None:
+            cancel.check()
+        path = os.path.join(root, reldir) if reldir else root
+        children = None
+        if snapshot is not None:
+            if mtime_ns is None:
+                try:
+                    mtime_ns = os.lstat(path).st_mtime_ns
+                except OSError as e:
+                    if not vanished(e):
+                        errors.append((reldir, e))
+                    return None, False
+            children = snapshot.lookup(reldir, mtime_ns)
+        fresh = children is None
+        failed = len(errors)
+        if fresh:
+            children = list_directory(path, ignore, stats, path_filter, reldir, errors)
+            if children is None:
+                return None, False
+        # A listing with entries missing must not be reused.
+        if snapshot is not None and len(errors) == failed:
+            snapshot.record(reldir, mtime_ns, children)
+        return sorted(children), fresh
+
+    children, fresh = listing(base, None)
+    if not children:
+        return manifest
+    stack = [(manifest.add_dir(base), base, iter(children), fresh)]
+    while stack:
+        parent, reldir, it, fresh = stack[-1]
+        child = next(it, None)
+        if child is None:
+            stack.pop()
+            continue
+        name, type, size, mtime_ns = child[:4]
+        manifest.append(parent, *child)
+        if type == 'd' and recursive:
+            relpath = os.path.join(reldir, name) if reldir else name
+            children, child_fresh = listing(relpath, mtime_ns if fresh else None)
+            if children:
+                stack.append((manifest.add_dir(relpath), relpath, iter(children), child_fresh))
+    return manifest
+
+
+def walk_tree(root, ignore=IGNORED_NAMES, stats=None, cancel=None, path_filter=None):
+    # Lazy scan_tree: yields the entries in manifest order while walking, so
+    # only the listings of the directories on the current path are held.
+    # Sorting each listing by name is enough, as long as a directory's
+    # subtree is walked right after the directory itself.
+    children = list_directory(root, ignore, stats, path_filter)
+    if children is None:
+        return
+    stack = [('', iter(sorted(children)))]
+    while stack:
+        reldir, it = stack[-1]
+        child = next(it, None)
+        if child is None:
+            stack.pop()
+            continue
+        name, type = child[:2]
+        relpath = os.path.join(reldir, name) if reldir else name
+        yield ManifestEntry(relpath, *child[1:])
+        if type == 'd':
+            if cancel is not None:
+                cancel.check()
+            children = list_directory(os.path.join(root, relpath), ignore, stats, path_filter, relpath)
+            if children:
+                stack.append((relpath, iter(sorted(children))))
+
+
+def diff_manifests(left, right):
+    # Single merge pass over two sorted manifests (Manifests, lists or
+    # walk_tree generators). Yields (left, right) pairs where the missing side is None.
+    left = iter(left)
+    right = iter(right)
+    lentry = next(left, None)
+    rentry = next(right, None)
+    while lentry is not None and rentry is not None:
+        lkey = manifest_key(lentry.relpath)
+        rkey = manifest_key(rentry.relpath)
+        if lkey == rkey:
+            yield lentry, rentry
+            lentry = next(left, None)
+            rentry = next(right, None)
+        elif lkey < rkey:
+            yield lentry, None
+            lentry = next(left, None)
+        else:
+            yield None, rentry
+            rentry = next(right, None)
+    while lentry is not None:
+        yield lentry, None
+        lentry = next(left, None)
+    while rentry is not None:
+        yield None, rentry
+        rentry = next(right, None)
+
+
+class TreeDiff:
+    # diff_manifests of two scanned trees that can be iterated more than
+    # once without holding all the pairs: every pass merges them again.
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def __iter__(self):
+        return diff_manifests(self.left, self.right)
+
+
+class KindsMatched:
+    # A comparison without what is under a path that is a directory on one
+    # side and a file or symlink on the other. The pair itself stays, but
+    # nothing is copied into, or deleted from, a tree that does not go on
+    # on the other side, so a symlink is never written or deleted through.
+    def __init__(self, comparison):
+        self.comparison = comparison
+
+    def __iter__(self):
+        blocked = None
+        for left, right in self.comparison:
+            relpath = (left or right).relpath
+            if blocked is not None:
+                # Manifest order keeps a subtree right after its directory.
+                if relpath.startswith(blocked):
+                    continue
+                blocked = None
+            if left is not None and right is not None and left.type != right.type and 'd' in (left.type, right.type):
+                blocked = relpath + os.sep
+            yield left, right
+
+
+def diff_directory(left_root, right_root, reldir, expand_right=False, cancel=None, path_filter=None, errors=None):
+    # diff_manifests for a single directory: its own entries, plus the whole
+    # subtree of any directory that exists only on the left and so has to
+    # be copied in full (and, with expand_right, only on the right). What
+    # could not be read on either side is added to errors as (root,
+    # relpath, error).
+    comparison = []
+
+    def scan(root, **options):
+        manifest = scan_tree(root, cancel=cancel, path_filter=path_filter, **options)
+        if errors is not None:
+            errors.extend((root, relpath, e) for relpath, e in manifest.errors)
+        return manifest
+
+    left = scan(left_root, base=reldir, recursive=False)
+    right = scan(right_root, base=reldir, recursive=False)
+    for left_entry, right_entry in diff_manifests(left, right):
+        comparison.append((left_entry, right_entry))
+        if right_entry is None and left_entry.type == 'd':
+            comparison.extend((entry, None) for entry in scan(left_root, base=left_entry.relpath))
+        elif left_entry is None and right_entry.type == 'd' and expand_right:
+            comparison.extend((None, entry) for entry in scan(right_root, base=right_entry.relpath))
+    return comparison
+
+
+def real_dir(path):
+    try:
+        return stat.S_ISDIR(os.lstat(path).st_mode)
+    except OSError:
+        return False
+
+
+def existing_parent(reldir, *roots):
+    # Closest ancestor of reldir (or reldir itself) that is a directory
+    # under every root, with no symlink on the way there.
+    found = ''
+    for name in reldir.split(os.sep) if reldir else ():
+        relpath = os.path.join(found, name) if found else name
+        if not all(real_dir(os.path.join(root, relpath)) for root in roots):
+            break
+        found = relpath
+    return found
+
+
+_buffers = threading.local()
+
+
+def read_buffer(size):
+    # One reusable buffer per thread, so hashing does not allocate a fresh
+    # bytes object for every block it reads.
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = _buffers.buf = bytearray(size)
+    return buf
+
+
+def compute_file_digest(file_path, algo='md5', bufsize=HASH_BUFSIZE, throttle=None, cancel=None):
+    # hashlib drops the GIL while it hashes a large buffer, so this scales
+    # across threads. cancel (a CancelToken) is checked before every block.
+    throttle = engaged(throttle)
+    digest = hashlib.new(algo)
+    buf = read_buffer(bufsize)
+    view = memoryview(buf)
+    with open(file_path, 'rb') as f:
+        while n := f.readinto(buf):
+            if cancel is not None:
+                cancel.check()
+            if throttle is not None:
+                throttle.read(n, f)
+            digest.update(view[:n])
+        if throttle is not None:
+            throttle.done(f)
+    return digest.hexdigest()
+
+
+def imap_bounded(pool, func, items, limit):
+    # Like pool.map, but keeps at most limit calls in flight instead of
+    # submitting every item up front.
+    pending = deque()
+    for item in items:
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+        pending.append(pool.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
 
-def synchronize_directories(source, dest, verbose=False, purge=False, forcecopy=False, use_ctime=False, use_content=False, two_way=False, hverify=False):
-    if not os.path.exists(dest):
+def copy_file_hashed(src, dst, algo='md5', bufsize=COPY_BUFSIZE, offset=0, checkpoint=None, throttle=None, cancel=None):
+    # Hashes the source from the same buffer that is written out, so a
+    # verified copy reads it only once. sendfile/copy_file_range never hand
+    # the data to user space, so they are only used (by shutil.copy2) when
+    # no digest is wanted and nothing is throttled. A copy can pick up at
+    # offset, keeping what dst already holds before it; with checkpoint, dst
+    # is flushed to disk every CHECKPOINT_BYTES and checkpoint(offset) is
+    # called. algo may be None. cancel is checked before every block.
+    throttle = engaged(throttle)
+    digest = hashlib.new(algo) if algo else None
+    buf = read_buffer(bufsize)
+    view = memoryview(buf)
+    with open(src, 'rb') as fsrc, open(dst, 'r+b' if offset else 'wb') as fdst:
+        if offset:
+            remaining = offset
+            while digest is not None and remaining and (n := fdst.readinto(view[:min(remaining, bufsize)])):
+                digest.update(view[:n])
+                remaining -= n
+            fdst.seek(offset)
+            fdst.truncate()
+            fsrc.seek(offset)
+        synced = offset
+        while n := fsrc.readinto(buf):
+            if cancel is not None:
+                cancel.check()
+            if throttle is not None:
+                throttle.read(n, fsrc)
+            if digest is not None:
+                digest.update(view[:n])
+            fdst.write(view[:n])
+            if throttle is not None:
+                throttle.write(n, fdst)
+            offset += n
+            if checkpoint is not None and offset - synced >= CHECKPOINT_BYTES:
+                fdst.flush()
+                os.fsync(fdst.fileno())
+                checkpoint(offset)
+                synced = offset
+        if throttle is not None:
+            fdst.flush()
+            throttle.done(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return digest.hexdigest() if digest is not None else None
+
+
+def partial_path(path):
+    # A fixed-length name derived from the target's, so it fits wherever the
+    # target's name does and an interrupted copy is found again on resume.
+    head, name = os.path.split(path)
+    return os.path.join(head, '.' + hashlib.md5(os.fsencode(name)).hexdigest()[:16] + PARTIAL_SUFFIX)
+
+
+def copy_symlink(src, dst):
+    # The link itself, pointing where the source's does; what it points to
+    # is neither read nor written.
+    tmppath = partial_path(dst)
+    try:
+        os.remove(tmppath)
+    except FileNotFoundError:
+        pass
+    os.symlink(os.readlink(src), tmppath)
+    try:
+        os.replace(tmppath, dst)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+
+def link_differs(src, dst):
+    try:
+        return os.readlink(src) != os.readlink(dst)
+    except OSError:
+        return True
+
+
+def resume_offset(partial, st, path):
+    # Where an interrupted copy to path can continue: the last checkpoint,
+    # if the source is unchanged since and the partial copy still has it.
+    if partial is None:
+        return 0
+    offset, size, mtime_ns = partial
+    try:
+        if (size, mtime_ns) == (st.st_size, st.st_mtime_ns) and os.path.getsize(path) >= offset:
+            return offset
+    except OSError:
+        pass
+    return 0
+
+
+def clone_file(src, dst, unsupported, throttle=None, cancel=None):
+    # Copy within one filesystem. A reflink (FICLONE) shares the data blocks
+    # on btrfs/XFS and friends; copy_file_range at least keeps the data in
+    # the kernel (and lets NFS copy on the server). Methods that fail with
+    # "not supported" are added to the unsupported set so the rest of the
+    # run skips straight past them. Throttled, copy_file_range moves one
+    # COPY_BUFSIZE at a time. cancel is checked between the pieces.
+    throttle = engaged(throttle)
+    chunk = COPY_RANGE_CHUNK if throttle is None else COPY_BUFSIZE
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        done = False
+        if fcntl is not None and 'ficlone' not in unsupported:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                done = True
+            except OSError:
+                unsupported.add('ficlone')
+        if not done and hasattr(os, 'copy_file_range') and 'copy_file_range' not in unsupported:
+            try:
+                while n := os.copy_file_range(fsrc.fileno(), fdst.fileno(), chunk):
+                    if cancel is not None:
+                        cancel.check()
+                    if throttle is not None:
+                        throttle.read(n, fsrc)
+                        throttle.write(n, fdst)
+                done = True
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP) or fdst.tell():
+                    raise
+                unsupported.add('copy_file_range')
+        if not done:
+            while block := fsrc.read(COPY_BUFSIZE):
+                if cancel is not None:
+                    cancel.check()
+                if throttle is not None:
+                    throttle.read(len(block), fsrc)
+                fdst.write(block)
+                if throttle is not None:
+                    throttle.write(len(block), fdst)
+        if throttle is not None:
+            fdst.flush()
+            throttle.done(fsrc, fdst)
+    shutil.copystat(src, dst)
+
+
+def send_file(src, dst, cancel):
+    # shutil.copy2 for a run that can be cancelled: copy2 hands the whole
+    # file to one sendfile call, this one COPY_RANGE_CHUNK at a time, with
+    # cancel checked in between. The data still never enters Python.
+    if not hasattr(os, 'sendfile'):
+        copy_file_hashed(src, dst, None, cancel=cancel)
+        return
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        offset = 0
+        try:
+            while n := os.sendfile(fdst.fileno(), fsrc.fileno(), offset, COPY_RANGE_CHUNK):
+                offset += n
+                cancel.check()
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP) or offset:
+                raise
+            fdst.truncate(0)
+            offset = None
+    if offset is None:
+        # Not supported between these files.
+        copy_file_hashed(src, dst, None, cancel=cancel)
+        return
+    shutil.copystat(src, dst)
+
+
+def delta_copy(src, dst, block_size=DELTA_BLOCK_SIZE, algo=None, throttle=None, cancel=None):
+    # Brings an existing dst up to date with src by rewriting only the
+    # blocks that differ, in place. Both files are local, so the blocks are
+    # compared directly instead of through rsync's rolling checksums, which
+    # only pay off when the destination's data is on the other end of a
+    # network link. Returns the number of bytes written and, if algo is
+    # given, the digest of src.
+    throttle = engaged(throttle)
+    digest = hashlib.new(algo) if algo else None
+    written = 0
+    offset = 0
+    with open(src, 'rb') as fsrc, open(dst, 'r+b') as fdst:
+        while block := fsrc.read(block_size):
+            if cancel is not None:
+                cancel.check()
+            if throttle is not None:
+                throttle.read(len(block), fsrc)
+            if digest is not None:
+                digest.update(block)
+            old = fdst.read(len(block))
+            if throttle is not None and old:
+                throttle.read(len(old), fdst)
+            if old != block:
+                fdst.seek(offset)
+                fdst.write(block)
+                if throttle is not None:
+                    throttle.write(len(block), fdst)
+                written += len(block)
+            offset += len(block)
+        fdst.truncate(offset)
+        if throttle is not None:
+            fdst.flush()
+            throttle.done(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return written, digest.hexdigest() if digest is not None else None
+
+
+def changed_since(entry, base, mtime_index):
+    # base is a SyncState value; mtime_index picks the side's mtime in it.
+    if entry is None or base is None:
+        return (entry is None) != (base is None)
+    if entry.type != base[0]:
+        return True
+    # A directory's mtime moves whenever its contents do, so only its
+    # existence counts.
+    if entry.type == 'd':
+        return False
+    return entry.size != base[1] or entry.mtime_ns != base[mtime_index]
+
+
+def already_copied(src, dst):
+    # copy2 and copystat carry the source's mtime over to the copy, so a copy
+    # with the same size and mtime_ns is finished.
+    try:
+        src_st = os.stat(src)
+        dst_st = os.stat(dst)
+    except OSError:
+        return False
+    return src_st.st_size == dst_st.st_size and src_st.st_mtime_ns == dst_st.st_mtime_ns
+
+
+def three_way_action(left, right, base, same, purge=False, policy='newer'):
+    left_changed = changed_since(left, base, 2)
+    right_changed = changed_since(right, base, 3)
+    if left is None and right is None:
+        return 'forget'
+    if not left_changed and not right_changed:
+        return 'none'
+    if not right_changed:
+        if left is None:
+            return 'delete_right' if purge else 'to_left'
+        return 'to_right'
+    if not left_changed:
+        if right is None:
+            return 'delete_left' if purge else 'to_right'
+        return 'to_left'
+
+    # Changed on both sides since the last sync.
+    if left is not None and right is not None and same(left, right):
+        return 'record'
+    # A deletion never wins over a modification.
+    if left is None:
+        return 'to_left'
+    if right is None:
+        return 'to_right'
+    if left.type != right.type or policy == 'skip':
+        return 'conflict'
+    if policy == 'source':
+        return 'to_right'
+    if policy == 'dest':
+        return 'to_left'
+    return 'to_right' if left.mtime_ns >= right.mtime_ns else 'to_left'
+
+
+class SyncError(Exception):
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} file operation(s) failed")
+        self.errors = errors
+
+
+def run_copy_tasks(tasks, jobs=1, verbose=False, log_func=print, copy_func=shutil.copy2):
+    # Largest files go first so one big file picked up at the end does not
+    # leave the other workers idle. Only a few tasks per worker are queued at
+    # a time to keep memory flat on huge plans.
+    tasks = sorted(tasks, key=lambda t: t.size, reverse=True)
+    jobs = max(1, jobs)
+    errors = []
+    pending = {}
+
+    def collect(done):
+        for future in done:
+            task = pending.pop(future)
+            try:
+                future.result()
+            except OSError as e:
+                errors.append((task.srcpath, e))
+                log_func(f"Failed to copy {task.srcpath} to {task.dstpath}: {e}")
+            else:
+                if verbose:
+                    log_func(f"{task.action}: {task.srcpath} to {task.dstpath}")
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for task in tasks:
+            if len(pending) >= jobs * 4:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            pending[pool.submit(copy_func, task.srcpath, task.dstpath)] = task
+        collect(wait(pending).done)
+    return errors
+
+
+def synchronize_directories(source, dest, verbose=False, purge=False, forcecopy=False, use_ctime=False, use_content=False, two_way=False, hverify=False, jobs=1, cache=True, rehash=False, cache_size=DEFAULT_MAX_ENTRIES, trust_copy=False, hash_algo='md5', hash_jobs=None, hash_bufsize=HASH_BUFSIZE, incremental=False, rescan=False, only_dirs=None, conflict='newer', delta=False, delta_threshold=DELTA_THRESHOLD, block_size=DELTA_BLOCK_SIZE, hard_links=False, compare_tiers=None, mtime_window=0, io_depth=0, detect_moves=False, dedupe=None, path_filter=None, throttle=None, max_delete=None, trash=False, purge_jobs=PURGE_JOBS, delete_budget=None, dry_run=False, plan_out=None, plan=None, resume=False, stats=None, events=None, cancel=None, source_manifest=None, fanout=None, log_func=print):
+    if isinstance(dest, (list, tuple)):
+        options = dict(locals())
+        for name in ('source', 'dest', 'source_manifest', 'fanout'):
+            del options[name]
+        return synchronize_to_many(source, dest, **options)
+    errors = []
+    hash_cache = None
+    snapshots = {}
+    delta_stats = []
+    clone_unsupported = set()
+    meta_dir = os.path.join(dest, META_DIR)
+    trash_dir = os.path.join(TRASH_DIR, time.strftime('%Y%m%d-%H%M%S'))
+    resume_plan, journal_path = journal_paths(meta_dir, source)
+    journal = None
+    partials = {}
+    # Per-entry stat timings only when the caller asked for statistics;
+    # the phase times and counters are cheap enough to keep anyway.
+    scan_stats = stats
+    if stats is None:
+        stats = RunStats()
+
+    def emit(event):
+        if events is not None:
+            events(event)
+
+    def tree_of(path):
+        # (root, relpath) of path in its tree; in two-way runs, deletions
+        # happen on both sides.
+        for root in (dest, source):
+            try:
+                relpath = os.path.relpath(path, root)
+            except ValueError:
+                # Another drive (Windows).
+                continue
+            # Not a name like "..stale", which only starts like one.
+            if relpath != os.pardir and not relpath.startswith(os.pardir + os.sep):
+                return root, relpath
+        raise ValueError(f"{path} is in neither tree")
+
+    def trash_path(path):
+        # Where path goes in trash mode: the same place under the trash of
+        # its tree.
+        root, relpath = tree_of(path)
+        return os.path.join(root, trash_dir, relpath)
+
+    def check_cancel():
+        if cancel is not None:
+            cancel.check()
+
+    def phase(name):
+        emit(PhaseEvent(name))
+        return stats.phase(name)
+
+    # A dry run only reads: nothing is created in the destination, and the
+    # hash cache and saved state are only used if they already exist.
+    if not os.path.exists(dest) and not dry_run:
         os.makedirs(dest)
         if verbose:
-            print(f"Created target directory: {dest}")
-
-    def compare_and_copy(src, dst, reverse=False):
-        comparison = filecmp.dircmp(src, dst)
-        copy_files(comparison, src, dst, reverse)
-        if purge:
-            delete_files(comparison, dst)
-
-    def copy_files(comp, src, dst, reverse):
-        for name in comp.left_only:
-            srcpath = os.path.join(src, name)
-            dstpath = os.path.join(dst, name)
-            if os.path.isdir(srcpath):
-                shutil.copytree(srcpath, dstpath)
-                if verbose:
-                    print(f"Copied directory: {srcpath} to {dstpath}")
+            log_func(f"Created target directory: {dest}")
+
+    same_fs = os.path.isdir(dest) and os.stat(source).st_dev == os.stat(dest).st_dev
+
+    if compare_tiers is None:
+        compare_tiers = default_tiers(use_ctime, use_content)
+    elif isinstance(compare_tiers, str):
+        compare_tiers = parse_tiers(compare_tiers)
+
+    if cache and (hverify or use_content or 'hash' in compare_tiers) and (not dry_run or os.path.isdir(meta_dir)):
+        os.makedirs(meta_dir, exist_ok=True)
+        hash_cache = HashCache(os.path.join(meta_dir, 'hashes.db'), max_entries=cache_size, rehash=rehash)
+        if fanout is not None:
+            fanout.add_cache(hash_cache)
+
+    # Excluded files are neither scanned, copied, deleted nor verified.
+    filtered = path_filter is not None and bool(path_filter.rules)
+    if path_filter is not None and path_filter.limited:
+        path_filter = path_filter.at(time.time())
+
+    def skipped(entry):
+        # Outside the size and age limits.
+        return path_filter is not None and path_filter.skipped(entry)
+
+    if only_dirs is not None:
+        if filtered:
+            only_dirs = [reldir for reldir in only_dirs if not path_filter.prunes(reldir)]
+        only_dirs = sorted({existing_parent(reldir, source, dest) for reldir in only_dirs}, key=manifest_key)
+
+    # Snapshots describe whole trees, so partial runs neither use nor
+    # update them.
+    if incremental and only_dirs is None:
+        if not dry_run:
+            os.makedirs(meta_dir, exist_ok=True)
+        for root in (source, dest) if source_manifest is None else (dest,):
+            # Listings are saved filtered, so other rules need other snapshots.
+            snapshots[root] = TreeSnapshot(snapshot_path(meta_dir, root, path_filter.key if filtered else ''),
+                                           rescan=rescan, readonly=dry_run)
+
+    def written(root, reldir):
+        snapshot = snapshots.get(root)
+        if snapshot is not None:
+            snapshot.invalidate(reldir)
+
+    hash_name = hash_algo.upper()
+    hash_jobs = hash_jobs or os.cpu_count() or 1
+
+    def compute_digest(file_path):
+        check_cancel()
+        with stats.timed('hash'):
+            return compute_file_digest(file_path, hash_algo, hash_bufsize, throttle, cancel)
+
+    def file_digest(file_path):
+        if hash_cache is None:
+            return compute_digest(file_path)
+        if fanout is None or not file_path.startswith(source_prefix):
+            return hash_cache.digest(file_path, hash_algo, compute_digest)
+        # The other destinations' runs verify against source files too, so
+        # a new digest goes into their caches as well.
+        st = os.stat(file_path)
+        digest = hash_cache.get(st, hash_algo)
+        if digest is None:
+            digest = compute_digest(file_path)
+            fanout.put_digest(st, hash_algo, digest)
+        return digest
+
+    source_prefix = os.path.join(source, '')
+    comparator = Comparator(compare_tiers, int(mtime_window * 1000000000), file_digest, hash_cache is not None,
+                            throttle=throttle, cancel=cancel)
+
+    def copied(st, srcpath, dstpath, digest):
+        # The digests are found again in the hash cache, which is on disk,
+        # so memory use does not grow with the number of files copied.
+        # Without the cache, verify_md5 reads both files again.
+        if hash_cache is None:
+            return
+        if fanout is not None:
+            fanout.put_digest(st, hash_algo, digest)
+        else:
+            hash_cache.put(st, hash_algo, digest)
+        # With trust_copy the digest of what was written stands in for the
+        # destination's, so verify_md5 does not read the new copy back.
+        if trust_copy:
+            hash_cache.put(os.stat(dstpath), hash_algo, digest)
+
+    def delta_update(srcpath, dstpath):
+        st = os.stat(srcpath)
+        written_bytes, digest = delta_copy(srcpath, dstpath, block_size, hash_algo if hverify else None, throttle, cancel)
+        delta_stats.append((dstpath, st.st_size, written_bytes))
+        if verbose:
+            log_func(f"Delta update of {dstpath}: rewrote {written_bytes} of {st.st_size} bytes")
+        if digest is not None:
+            copied(st, srcpath, dstpath, digest)
+
+    def checkpoint(key, offset, st):
+        # The partial copy is on disk up to offset, so this is a good place
+        # to stop when cancelled; --resume picks it up from here.
+        journal.checkpoint(key, offset, st)
+        check_cancel()
+
+    def copy_file(srcpath, dstpath, block_update=False):
+        # Rewritten in place; if that is interrupted, the target's mtime
+        # still differs and the next run updates it again. A target with
+        # other hard links (--dedupe link, --hard-links) is copied in full
+        # instead, as writing into it would change the other names too.
+        if block_update and os.stat(dstpath).st_nlink < 2:
+            delta_update(srcpath, dstpath)
+            return
+        # Written next to the target under a temporary name and renamed over
+        # it when complete, so an interrupted run never leaves a half-written
+        # file in its place. Large copies are checkpointed in the journal
+        # and kept when interrupted, so --resume can continue them.
+        tmppath = partial_path(dstpath)
+        st = os.stat(srcpath)
+        resumable = journal is not None and not same_fs and st.st_size >= CHECKPOINT_BYTES
+        key = os.path.abspath(dstpath)
+        offset = resume_offset(partials.get(key), st, tmppath) if resumable else 0
+        digest = None
+        try:
+            if fanout is not None and not same_fs and not offset:
+                # Read once for all destinations that copy this file.
+                digest = fanout.copy(srcpath, tmppath, hash_algo if hverify else None,
+                                     (lambda offset: checkpoint(key, offset, st)) if resumable else None)
+            elif resumable:
+                digest = copy_file_hashed(srcpath, tmppath, hash_algo if hverify else None, offset=offset,
+                                          checkpoint=lambda offset: checkpoint(key, offset, st), throttle=throttle,
+                                          cancel=cancel)
+            elif same_fs:
+                clone_file(srcpath, tmppath, clone_unsupported, throttle, cancel)
+            elif hverify or engaged(throttle) is not None:
+                digest = copy_file_hashed(srcpath, tmppath, hash_algo if hverify else None, throttle=throttle,
+                                          cancel=cancel)
+            elif cancel is not None:
+                send_file(srcpath, tmppath, cancel)
             else:
-                shutil.copy2(srcpath, dstpath)
-                if verbose:
-                    print(f"Copied file: {srcpath} to {dstpath}")
-
-        for name in comp.common_files:
-            srcpath = os.path.join(src, name)
-            dstpath = os.path.join(dst, name)
-            if forcecopy or not filecmp.cmp(srcpath, dstpath, shallow=not use_content):
-                if reverse:
-                    shutil.copy2(dstpath, srcpath)
-                    if verbose:
-                        print(f"Updated file: {dstpath} to {srcpath}")
+                shutil.copy2(srcpath, tmppath)
+            os.replace(tmppath, dstpath)
+        except BaseException:
+            if not resumable:
+                try:
+                    os.remove(tmppath)
+                except OSError:
+                    pass
+            raise
+        if digest is not None:
+            copied(st, srcpath, dstpath, digest)
+
+    # Paths in either tree that could not be read. What is missing from a
+    # listing there is not known to be gone, so nothing at or under them is
+    # copied, moved or deleted; the run reports them as failed.
+    unreadable = set()
+
+    def unread(root, relpath, error):
+        path = os.path.join(root, relpath) if relpath else root
+        unreadable.add(relpath)
+        errors.append((path, error))
+        log_func(f"Failed to read {path}: {error}")
+
+    def under_unreadable(relpath):
+        while True:
+            if relpath in unreadable:
+                return True
+            if not relpath:
+                return False
+            relpath = os.path.dirname(relpath)
+
+    def readable(comparison):
+        if not unreadable:
+            return comparison
+        return [pair for pair in comparison if not under_unreadable((pair[0] or pair[1]).relpath)]
+
+    def scanned(src, dst, left, right):
+        for root, manifest in ((src, left), (dst, right)):
+            for relpath, e in manifest.errors:
+                unread(root, relpath, e)
+        return TreeDiff(left, right)
+
+    def update_op(size):
+        # Block updates only pay off for large files.
+        return 'delta' if delta and size >= delta_threshold else 'update'
+
+    def compare(src, dst, expand_right=False):
+        with phase('scan'):
+            if only_dirs is None and source_manifest is not None and src == source:
+                # Scanned once for all destinations.
+                if io_depth and not snapshots:
+                    right, = ScanPipeline(read_entries, entry_record, io_depth, scan_stats, cancel, path_filter).scan([dst])
                 else:
-                    shutil.copy2(srcpath, dstpath)
-                    if verbose:
-                        print(f"Updated file: {srcpath} to {dstpath}")
+                    right = scan_tree(dst, snapshot=snapshots.get(dst), stats=scan_stats, cancel=cancel,
+                                      path_filter=path_filter)
+                return scanned(src, dst, source_manifest, right)
+            if only_dirs is None and io_depth and not snapshots:
+                left, right = ScanPipeline(read_entries, entry_record, io_depth, scan_stats, cancel, path_filter).scan([src, dst])
+                return scanned(src, dst, left, right)
+            if only_dirs is None:
+                left = scan_tree(src, snapshot=snapshots.get(src), stats=scan_stats, cancel=cancel,
+                                 path_filter=path_filter)
+                right = scan_tree(dst, snapshot=snapshots.get(dst), stats=scan_stats, cancel=cancel,
+                                  path_filter=path_filter)
+                return scanned(src, dst, left, right)
+            comparison = []
+            failures = []
+            for reldir in only_dirs:
+                comparison.extend(diff_directory(src, dst, reldir, expand_right, cancel, path_filter, failures))
+            for root, relpath, e in failures:
+                unread(root, relpath, e)
+            return comparison
 
-        for subdir in comp.common_dirs:
-            compare_and_copy(os.path.join(src, subdir), os.path.join(dst, subdir), reverse)
+    def sync_one_way(src, dst):
+        # With a filter, a purged directory is emptied entry by entry (see
+        # plan_deletes), so the entries of new ones are needed too; with
+        # max_delete, they are counted.
+        comparison = KindsMatched(readable(compare(src, dst, expand_right=filtered or (purge and max_delete is not None))))
+        with phase('compare'):
+            # Only files a purge would delete can be moved into place.
+            moves = MoveCandidates(comparison) if detect_moves and purge else None
+            ops = plan_copies(comparison, src, dst, moves)
+            if dedupe:
+                ops = dedupe_copies(ops)
+            if purge:
+                ops.extend(plan_deletes(comparison, dst, moves))
+        run_plan(ops)
 
-    def delete_files(comp, dst):
-        for name in comp.right_only:
-            dstpath = os.path.join(dst, name)
-            if os.path.isdir(dstpath):
-                shutil.rmtree(dstpath)
-                if verbose:
-                    print(f"Deleted directory: {dstpath}")
+    def judged(comp, src, dst):
+        # (left, right, differ) for each pair, where differ tells whether
+        # two files need copying. With io_depth that many comparisons run
+        # at once, as one that has to stat or read the files costs network
+        # round trips too.
+        def judge(pair):
+            left, right = pair
+            if not forcecopy and left is not None and right is not None and left.type == right.type == 'l':
+                return left, right, link_differs(os.path.join(src, left.relpath), os.path.join(dst, right.relpath))
+            if forcecopy or left is None or right is None or left.type != 'f' or right.type != 'f':
+                return left, right, None
+            return left, right, comparator.differ(left, right, os.path.join(src, left.relpath),
+                                                  os.path.join(dst, right.relpath))
+
+        if not io_depth:
+            yield from map(judge, comp)
+            return
+        with ThreadPoolExecutor(max_workers=io_depth) as pool:
+            yield from imap_bounded(pool, judge, comp, io_depth * 4)
+
+    def plan_copies(comp, src, dst, moves=None):
+        ops = []
+        link_targets = {}
+        if hard_links:
+            inode_counts = Counter(left.inode for left, right in comp if left is not None and left.type == 'f')
+
+        def same_data(left, right, srcpath):
+            # Two files at different paths with the same size and mtime can
+            # still differ (extracted archives, coarse timestamps), so a
+            # move needs the same contents, whatever the compare tiers say.
+            return comparator.same_content(left, right, srcpath, os.path.join(dst, right.relpath))
+
+        def link_target(srcpath, dstpath):
+            # First destination path seen for a source hard-link group; the
+            # other members become links to it instead of separate copies.
+            st = os.stat(srcpath)
+            if st.st_nlink < 2:
+                return None
+            return link_targets.setdefault((st.st_dev, st.st_ino), dstpath)
+
+        for left, right, differ in judged(comp, src, dst):
+            if left is None or skipped(left):
+                continue
+            srcpath = os.path.join(src, left.relpath)
+            dstpath = os.path.join(dst, left.relpath)
+            linked = hard_links and left.type == 'f' and inode_counts[left.inode] > 1
+            if right is None:
+                written(dst, os.path.dirname(left.relpath))
+                if left.type == 'd':
+                    ops.append(Operation('mkdir', srcpath, dstpath))
+                    written(dst, left.relpath)
+                elif left.type == 'l':
+                    ops.append(Operation('symlink', srcpath, dstpath))
+                else:
+                    target = link_target(srcpath, dstpath) if linked else None
+                    if target is not None and target != dstpath:
+                        ops.append(Operation('link', srcpath, dstpath, 0, target))
+                    elif moves is not None and (moved := moves.match(left, lambda right: same_data(
+                            left, right, srcpath))) is not None:
+                        written(dst, os.path.dirname(moved.relpath))
+                        ops.append(Operation('move', srcpath, dstpath, 0, os.path.join(dst, moved.relpath)))
+                    else:
+                        ops.append(Operation('copy', srcpath, dstpath, left.size))
+            elif left.type == 'f' and right.type == 'f':
+                if linked:
+                    link_target(srcpath, dstpath)
+                if forcecopy or differ:
+                    written(dst, os.path.dirname(left.relpath))
+                    ops.append(Operation(update_op(left.size), srcpath, dstpath, left.size))
+            elif 'd' in (left.type, right.type):
+                if left.type != right.type:
+                    # See KindsMatched.
+                    log_func(f"Left as is, a directory on one side only: {dstpath}")
+            elif left.type == 'l':
+                # Replaces a file, or a link pointing elsewhere.
+                if forcecopy or differ or right.type != 'l':
+                    written(dst, os.path.dirname(left.relpath))
+                    ops.append(Operation('symlink', srcpath, dstpath))
+            else:
+                # A file where the destination has a symlink: the copy
+                # replaces the link and leaves what it points to alone.
+                written(dst, os.path.dirname(left.relpath))
+                ops.append(Operation('copy', srcpath, dstpath, left.size))
+        return ops
+
+    def dedupe_copies(ops):
+        # Files copied more than once in this run with the same contents:
+        # the first is copied from the source, the others are cloned from
+        # it (or hard-linked to it) within the destination.
+        kinds = ('copy',) if dedupe == 'link' else ('copy', 'update')
+        duplicates = find_duplicates([op for op in ops if op.op in kinds], file_digest)
+        if not duplicates:
+            return ops
+        targets = {op.dst: original for original, group in duplicates.items() for op in group}
+        return [op._replace(op=dedupe, size=0, target=targets[op.dst]) if op.dst in targets else op for op in ops]
+
+    def check_deletes(root, doomed, total):
+        # A partial run only sees some directories, so it counts against
+        # the size of the tree at the last full run (delete_budget); without
+        # one, any deletion needs a full run.
+        if only_dirs is None:
+            check_purge(doomed, total, max_delete, root)
+            if delete_budget is not None:
+                delete_budget.reset(root, total)
+        else:
+            (delete_budget or DeleteBudget()).check(doomed, max_delete, root)
+
+    def plan_deletes(comp, dst, moves=None):
+        ops = []
+        deleted_dir = None
+        doomed = 0
+        total = 0
+        for left, right in comp:
+            if right is not None:
+                total += 1
+            if left is not None:
+                continue
+            if moves is not None and right.relpath in moves.moved:
+                continue
+            doomed += 1
+            if right.type == 'd':
+                written(dst, right.relpath)
+            if deleted_dir is not None and right.relpath.startswith(deleted_dir):
+                continue
+            written(dst, os.path.dirname(right.relpath))
+            dstpath = os.path.join(dst, right.relpath)
+            if right.type == 'd' and filtered:
+                # rmtree would take the excluded files in it along; rmdir
+                # leaves a directory that still holds some.
+                ops.append(Operation('rmdir', None, dstpath))
+            elif right.type == 'd':
+                ops.append(Operation('rmtree', None, dstpath))
+                deleted_dir = right.relpath + os.sep
             else:
-                os.remove(dstpath)
+                ops.append(Operation('delete', None, dstpath))
+        check_deletes(dst, doomed, total)
+        return ops
+
+    def sync_two_way(src, dst):
+        # One combined scan of both trees; each path is then compared with
+        # its state after the previous run to see which side changed.
+        path = state_path(meta_dir, source)
+        if not dry_run:
+            os.makedirs(meta_dir, exist_ok=True)
+        state = SyncState(path if os.path.isdir(meta_dir) else ':memory:')
+        ops = []
+        dir_paths = {}
+        targets = {}
+        deleted = {}
+        # Entries seen and entries to delete, per side.
+        totals = Counter()
+        doomed = Counter()
+
+        def same(left, right):
+            if left.type != right.type:
+                return False
+            srcpath = os.path.join(src, left.relpath)
+            dstpath = os.path.join(dst, right.relpath)
+            if left.type == 'l':
+                return not link_differs(srcpath, dstpath)
+            return left.type == 'd' or not comparator.differ(left, right, srcpath, dstpath)
+
+        comparison = KindsMatched(readable(compare(src, dst, expand_right=True)))
+        with phase('compare'):
+            for left, right in comparison:
+                if skipped(left) or skipped(right):
+                    continue
+                if left is not None and right is not None and left.type != right.type and 'd' in (left.type, right.type):
+                    # A directory cannot be replaced by a copy; what is
+                    # under it is left alone too (see KindsMatched).
+                    log_func(f"Conflict, left as is: {os.path.join(src, left.relpath)} and {os.path.join(dst, right.relpath)}")
+                    continue
+                totals[src] += left is not None
+                totals[dst] += right is not None
+                relpath = (left or right).relpath
+                action = three_way_action(left, right, state.get(relpath), same, purge, conflict)
+                if action == 'none' and forcecopy and left.type == 'f':
+                    action = 'to_right'
+                if action == 'none':
+                    continue
+                if action == 'forget':
+                    state.remove(relpath)
+                elif action == 'record':
+                    state.set(relpath, (left.type, left.size, left.mtime_ns, right.mtime_ns))
+                elif action == 'conflict':
+                    log_func(f"Conflict, left as is: {os.path.join(src, relpath)} and {os.path.join(dst, relpath)}")
+                elif action in ('to_right', 'to_left'):
+                    to_right = action == 'to_right'
+                    entry, other = (left, right) if to_right else (right, left)
+                    from_root, to_root = (src, dst) if to_right else (dst, src)
+                    frompath = os.path.join(from_root, relpath)
+                    topath = os.path.join(to_root, relpath)
+                    written(to_root, os.path.dirname(relpath))
+                    if entry.type == 'd':
+                        written(to_root, relpath)
+                        dir_paths[topath] = relpath
+                        ops.append(Operation('mkdir', frompath, topath))
+                    elif entry.type == 'l':
+                        targets[topath] = (relpath, to_right, entry)
+                        ops.append(Operation('symlink', frompath, topath))
+                    else:
+                        targets[topath] = (relpath, to_right, entry)
+                        op = update_op(entry.size) if other is not None and other.type == 'f' else 'copy'
+                        ops.append(Operation(op, frompath, topath, entry.size))
+                else:
+                    root = dst if action == 'delete_right' else src
+                    doomed[root] += 1
+                    written(root, os.path.dirname(relpath))
+                    path = os.path.join(root, relpath)
+                    deleted[path] = relpath
+                    ops.append(Operation('rmdir' if (left or right).type == 'd' else 'delete', None, path))
+
+        for root in (src, dst):
+            check_deletes(root, doomed[root], totals[root])
+
+        def done(op):
+            if op.op == 'mkdir':
+                state.set(dir_paths[op.dst], ('d', 0, 0, 0))
+            elif op.op in DELETE_OPS:
+                state.remove(deleted[op.dst])
+            else:
+                relpath, to_right, entry = targets[op.dst]
+                # The copy of a symlink has a time of its own.
+                st = os.lstat(op.dst)
+                if to_right:
+                    state.set(relpath, (entry.type, entry.size, entry.mtime_ns, st.st_mtime_ns))
+                else:
+                    state.set(relpath, (entry.type, entry.size, st.st_mtime_ns, entry.mtime_ns))
+
+        run_plan(ops, done)
+        if not dry_run:
+            state.save()
+
+    def run_plan(ops, done=None):
+        if plan_out:
+            write_plan(plan_out, ops, source, dest)
+        if dry_run or verbose:
+            log_func(summarize_plan(ops))
+        if dry_run:
+            if verbose:
+                for op in ops:
+                    log_func(format_operation(op))
+            return
+        if ops:
+            start_journal(ops)
+        execute_plan(ops, done)
+
+    def start_journal(ops, append=False):
+        nonlocal journal
+        if not append:
+            os.makedirs(meta_dir, exist_ok=True)
+            write_plan(resume_plan, ops, source, dest)
+        journal = Journal(journal_path, append)
+
+    def resumed_plan():
+        # What the interrupted run still had to do: its saved plan minus the
+        # steps its journal marks as finished.
+        nonlocal partials
+        if not os.path.exists(resume_plan):
+            log_func("No interrupted run to resume")
+            return None
+        finished, partials = load_journal(journal_path)
+        ops = read_plan(resume_plan)
+        next(ops)
+        ops = [op for op in ops if (op.op, op.dst) not in finished]
+        log_func(f"Resuming interrupted run: {len(ops)} step(s) left")
+        start_journal(ops, append=True)
+        # The resumed steps do not say which directories they write to.
+        for snapshot in snapshots.values():
+            snapshot.close()
+        snapshots.clear()
+        return ops
+
+    def execute_plan(ops, done=None, rerun=False):
+        # Directories first, then files moved within the destination, then
+        # file contents, then links and clones of the written files and
+        # symlinks, then deletions. With rerun (a saved plan being run
+        # again), files that already match their source's size and mtime are
+        # taken as copied by the earlier attempt. The steps are all held
+        # until the run ends, at about 400 bytes each with their paths (see
+        # "Memory use" in the README).
+        mkdirs = []
+        moves = []
+        transfers = {}
+        links = []
+        symlinks = []
+        deletions = []
+        for op in ops:
+            if op.op == 'mkdir':
+                mkdirs.append(op)
+            elif op.op == 'symlink':
+                symlinks.append(op)
+            elif op.op == 'move':
+                moves.append(op)
+            elif op.op in TRANSFER_OPS:
+                transfers[op.dst] = op
+            elif op.op in ('link', 'clone'):
+                links.append(op)
+            else:
+                deletions.append(op)
+        emit(PlanEvent(len(mkdirs) + len(moves) + len(transfers) + len(links) + len(symlinks) + len(deletions),
+                       sum(op.size for op in transfers.values())))
+        if fanout is not None:
+            # Clones and block updates do not read the source through it.
+            fanout.register([] if same_fs else [op.src for op in transfers.values() if op.op != 'delta'])
+
+        def failed(op, error):
+            errors.append((op.src or op.dst, error))
+            emit(StepEvent(op, error))
+
+        def finish(op):
+            stats.count(op.op, op.size)
+            emit(StepEvent(op, None))
+            if journal is not None:
+                journal.done(op)
+            if done is not None:
+                done(op)
+
+        with phase('copy'):
+            # Plan order puts every directory ahead of its children.
+            for op in mkdirs:
+                check_cancel()
+                try:
+                    os.makedirs(op.dst, exist_ok=True)
+                except OSError as e:
+                    failed(op, e)
+                    log_func(f"Failed to create directory {op.dst}: {e}")
+                    continue
+                finish(op)
+                if verbose:
+                    log_func(f"Copied directory: {op.src} to {op.dst}")
+
+            def local_step(op):
+                # Steps that reuse data already in the destination.
+                if op.op == 'move':
+                    if rerun and not os.path.exists(op.target) and already_copied(op.src, op.dst):
+                        return
+                    os.replace(op.target, op.dst)
+                    shutil.copystat(op.src, op.dst)
+                elif op.op == 'clone':
+                    if rerun and already_copied(op.src, op.dst):
+                        return
+                    partial = partial_path(op.dst)
+                    try:
+                        clone_file(op.target, partial, clone_unsupported, throttle, cancel)
+                        shutil.copystat(op.src, partial)
+                        os.replace(partial, op.dst)
+                    except BaseException:
+                        if os.path.exists(partial):
+                            os.remove(partial)
+                        raise
+                elif not (rerun and os.path.exists(op.dst) and os.path.samefile(op.target, op.dst)):
+                    os.link(op.target, op.dst)
+
+            def run_local(ops, messages):
+                for op in ops:
+                    check_cancel()
+                    try:
+                        local_step(op)
+                    except OSError:
+                        # Copy it from the source after all. A file that could
+                        # not be moved stays where it was until the next purge.
+                        local_errors = run_copy_tasks([CopyTask(0, op.src, op.dst, "Copied file")], 1, verbose, log_func, copy_file)
+                        if local_errors:
+                            errors.extend(local_errors)
+                            emit(StepEvent(op, local_errors[0][1]))
+                        else:
+                            finish(op)
+                        continue
+                    finish(op)
+                    if verbose:
+                        log_func(messages[op.op].format(src=op.target, dst=op.dst))
+
+            run_local(moves, {'move': "Moved file: {src} to {dst}"})
+
+            def copy_step(op):
+                try:
+                    copy_file(op.src, op.dst, op.op == 'delta')
+                except FileNotFoundError:
+                    # In two-way runs: the directory was deleted on this side
+                    # while a file in it changed on the other side; the
+                    # change wins.
+                    if os.path.isdir(os.path.dirname(op.dst)):
+                        raise
+                    os.makedirs(os.path.dirname(op.dst))
+                    copy_file(op.src, op.dst, op.op == 'delta')
+
+            def transfer(srcpath, dstpath):
+                check_cancel()
+                op = transfers[dstpath]
+                if not (rerun and already_copied(srcpath, dstpath)):
+                    try:
+                        with stats.timed('copy'):
+                            copy_step(op)
+                    except OSError as e:
+                        # run_copy_tasks logs it and collects it in errors.
+                        emit(StepEvent(op, e))
+                        raise
+                finish(op)
+
+            tasks = [CopyTask(op.size, op.src, op.dst, "Copied file" if op.op == 'copy' else "Updated file")
+                     for op in transfers.values()]
+            errors.extend(run_copy_tasks(tasks, jobs, verbose, log_func, transfer))
+
+            # Links and clones go last, once the file they copy has been
+            # written.
+            run_local(links, {'link': "Linked file: {dst} to {src}", 'clone': "Cloned file: {src} to {dst}"})
+
+            for op in symlinks:
+                check_cancel()
+                try:
+                    if not (rerun and os.path.islink(op.dst) and not link_differs(op.src, op.dst)):
+                        copy_symlink(op.src, op.dst)
+                except OSError as e:
+                    failed(op, e)
+                    log_func(f"Failed to copy link {op.src} to {op.dst}: {e}")
+                    continue
+                finish(op)
                 if verbose:
-                    print(f"Deleted file: {dstpath}")
+                    log_func(f"Copied link: {op.src} to {op.dst}")
+
+            # Directory times have to be set after their contents are written.
+            for op in reversed(mkdirs):
+                if os.path.isdir(op.dst):
+                    shutil.copystat(op.src, op.dst)
+
+        def deleted(op, moved=False):
+            finish(op)
+            if verbose:
+                kind = 'file' if op.op == 'delete' else 'directory'
+                log_func(f"Moved {kind} to trash: {op.dst}" if moved else f"Deleted {kind}: {op.dst}")
 
-    def compute_file_md5(file_path):
-        md5_hash = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            while chunk := f.read(8192):
-                md5_hash.update(chunk)
-        return md5_hash.hexdigest()
+        def remove(op):
+            # Files and whole trees; in trash mode both are one rename.
+            check_cancel()
+            if trash:
+                try:
+                    move_to_trash(op.dst, trash_path(op.dst))
+                    return op, None, True
+                except FileNotFoundError:
+                    return op, None, False
+                except OSError:
+                    # Another filesystem; delete it after all.
+                    pass
+            try:
+                with stats.timed('delete'):
+                    if op.op == 'rmtree':
+                        remove_tree(op.dst, pool, purge_jobs, check_cancel)
+                    else:
+                        remove_entry(*tree_of(op.dst))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                return op, e, False
+            return op, None, False
+
+        with phase('delete'), ThreadPoolExecutor(max_workers=purge_jobs) as pool:
+            # Files go in parallel; each tree is cleared by all the threads
+            # at once, driven from here so that no pool thread waits on
+            # another.
+            files = [op for op in deletions if op.op == 'delete']
+            trees = [op for op in deletions if op.op == 'rmtree']
+            results = imap_bounded(pool, remove, files, purge_jobs * 4)
+            for op, error, moved in itertools.chain(results, map(remove, trees)):
+                if error is not None:
+                    failed(op, error)
+                    log_func(f"Failed to delete {op.dst}: {error}")
+                else:
+                    deleted(op, moved)
+            # Children come after their directory in plan order, so going
+            # backwards empties a directory before it is removed.
+            for op in reversed([op for op in deletions if op.op == 'rmdir']):
+                check_cancel()
+                try:
+                    with stats.timed('delete'):
+                        remove_entry(*tree_of(op.dst), directory=True)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    if e.errno in (errno.ENOTEMPTY, errno.EEXIST):
+                        # Something in it was kept or is not synchronized.
+                        continue
+                    failed(op, e)
+                    log_func(f"Failed to delete {op.dst}: {e}")
+                    continue
+                deleted(op)
 
     def verify_md5(src, dst):
-        src_files = []
-        dst_files = []
-
-        for root, _, files in os.walk(src):
-            for name in files:
-                src_files.append(os.path.relpath(os.path.join(root, name), src))
-
-        for root, _, files in os.walk(dst):
-            for name in files:
-                dst_files.append(os.path.relpath(os.path.join(root, name), dst))
-
-        all_files = set(src_files + dst_files)
-        match = True
-
-        for file in all_files:
-            src_file = os.path.join(src, file)
-            dst_file = os.path.join(dst, file)
-
-            if os.path.exists(src_file) and os.path.exists(dst_file):
-                src_md5 = compute_file_md5(src_file)
-                dst_md5 = compute_file_md5(dst_file)
-                if src_md5 != dst_md5:
-                    match = False
-                    print(f"MD5 mismatch for {file}: {src_md5} (source) vs {dst_md5} (destination)")
-                else: 
-                    print(f"MD5 match for {file}: {src_md5}")
-            else:
-                match = False
-                print(f"File {file} is not present in both source and destination")
+        # Both trees are walked lazily and merged in manifest order, so memory
+        # use does not grow with the number of files, and results are
+        # reported as they come in.
+        counts = Counter()
 
-        if match:
-            print("All files are synchronized (MD5 hashes match).")
+        def hash_pair(pair):
+            check_cancel()
+            left, right = pair
+            if left is None or right is None or left.type != right.type:
+                return (left or right).relpath, None, None
+            return (left.relpath, file_digest(os.path.join(src, left.relpath)),
+                    file_digest(os.path.join(dst, right.relpath)))
+
+        pairs = (pair for pair in diff_manifests(walk_tree(src, stats=scan_stats, cancel=cancel, path_filter=path_filter),
+                                                 walk_tree(dst, stats=scan_stats, cancel=cancel, path_filter=path_filter))
+                 if 'f' in (pair[0] and pair[0].type, pair[1] and pair[1].type)
+                 and not (skipped(pair[0]) or skipped(pair[1])))
+
+        with ThreadPoolExecutor(max_workers=hash_jobs) as pool:
+            for file, src_digest, dst_digest in imap_bounded(pool, hash_pair, pairs, hash_jobs * 4):
+                if src_digest is None:
+                    counts['missing'] += 1
+                    emit(VerifyEvent(file, 'missing'))
+                    log_func(f"File {file} is not present in both source and destination")
+                elif src_digest != dst_digest:
+                    counts['mismatch'] += 1
+                    emit(VerifyEvent(file, 'mismatch'))
+                    log_func(f"{hash_name} mismatch for {file}: {src_digest} (source) vs {dst_digest} (destination)")
+                else:
+                    counts['match'] += 1
+                    emit(VerifyEvent(file, 'match'))
+                    log_func(f"{hash_name} match for {file}: {src_digest}")
+
+        log_func(f"Verified {sum(counts.values())} file(s): {counts['match']} match, "
+                 f"{counts['mismatch']} mismatch, {counts['missing']} missing on one side")
+        if counts['mismatch'] or counts['missing']:
+            log_func(f"Some files are not synchronized ({hash_name} hashes do not match).")
+        else:
+            log_func(f"All files are synchronized ({hash_name} hashes match).")
+
+    try:
+        if resume and plan is None:
+            plan = resumed_plan()
+        if plan is not None:
+            execute_plan(plan, rerun=True)
+        elif two_way:
+            sync_two_way(source, dest)
         else:
-            print("Some files are not synchronized (MD5 hashes do not match).")
+            sync_one_way(source, dest)
+
+        if hverify and not dry_run:
+            with phase('verify'):
+                verify_md5(source, dest)
+
+        if not dry_run:
+            for snapshot in snapshots.values():
+                snapshot.save()
+    finally:
+        if hash_cache is not None:
+            if fanout is not None:
+                fanout.remove_cache()
+            hash_cache.close()
+        if journal is not None:
+            journal.close()
+        for snapshot in snapshots.values():
+            snapshot.close()
+
+    # A finished run has nothing left to resume.
+    if journal is not None and not errors:
+        os.remove(resume_plan)
+        os.remove(journal_path)
 
-    compare_and_copy(source, dest)
+    stats.errors += len(errors)
+    if verbose and not dry_run:
+        log_func(stats.summary())
+
+    if delta_stats:
+        total = sum(size for _, size, _ in delta_stats)
+        rewritten = sum(written_bytes for _, _, written_bytes in delta_stats)
+        log_func(f"Delta transfer: {len(delta_stats)} file(s), rewrote {rewritten} of {total} bytes, saved {total - rewritten} bytes")
+
+    if errors:
+        raise SyncError(errors)
+
+
+def synchronize_to_many(source, dests, two_way=False, only_dirs=None, plan=None, plan_out=None, resume=False,
+                        io_depth=0, dry_run=False, cancel=None, log_func=print, **options):
+    # One-way sync of source to several destinations, each in its own
+    # thread with its own plan, journal and hash cache. The source is
+    # scanned once, and a file several destinations need is read (and
+    # hashed) once and handed to each of them through a FanOut.
     if two_way:
-        compare_and_copy(dest, source, reverse=True)
+        raise ValueError("Two-way sync works with one destination only")
+    if plan is not None or plan_out:
+        raise ValueError("A saved plan is for one destination only")
+    source_manifest = None
+    path_filter = options.get('path_filter')
+    if only_dirs is None and not resume:
+        if io_depth:
+            source_manifest, = ScanPipeline(read_entries, entry_record, io_depth, options.get('stats'), cancel,
+                                            path_filter).scan([source])
+        else:
+            source_manifest = scan_tree(source, stats=options.get('stats'), cancel=cancel, path_filter=path_filter)
+    cancel = cancel or CancelToken()
+    fanout = None if dry_run else FanOut(len(dests), COPY_BUFSIZE, CHECKPOINT_BYTES, throttle=options.get('throttle'),
+                                         cancel=cancel)
+    results = [None] * len(dests)
+
+    def run(index, dest):
+        member = fanout.member(index) if fanout is not None else None
+        try:
+            synchronize_directories(source, dest, only_dirs=only_dirs, resume=resume, io_depth=io_depth,
+                                    dry_run=dry_run, cancel=cancel, log_func=log_func,
+                                    source_manifest=source_manifest, fanout=member, **options)
+        except BaseException as e:
+            results[index] = e
+        finally:
+            if member is not None:
+                member.release()
 
-    if hverify:
-        verify_md5(source, dest)
+    threads = [threading.Thread(target=run, args=(index, dest)) for index, dest in enumerate(dests)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        cancel.cancel()
+        for thread in threads:
+            thread.join()
+        raise
 
+    # Failed file operations of all destinations together; anything else
+    # is raised as it is.
+    errors = []
+    for result in results:
+        if isinstance(result, SyncError):
+            errors.extend(result.errors)
+        elif result is not None:
+            raise result
+    if errors:
+        raise SyncError(errors)
+
+
+def iter_events(source, dest, max_pending=1000, **options):
+    # Runs synchronize_directories in a background thread and yields its
+    # events, its log lines as LogEvents and finally a DoneEvent. The queue
+    # is bounded, so a slow consumer slows the sync down instead of piling
+    # up events. Leaving the loop early cancels the run.
+    cancel = options.pop('cancel', None) or CancelToken()
+    options.pop('log_func', None)
+    queue = Queue(max_pending)
+
+    def put(event):
+        while True:
+            try:
+                queue.put(event, timeout=0.1)
+                return
+            except Full:
+                if cancel.cancelled:
+                    return
+
+    def run():
+        error = None
+        try:
+            synchronize_directories(source, dest, events=put, cancel=cancel,
+                                    log_func=lambda message: put(LogEvent(message)), **options)
+        except Exception as e:
+            error = e
+        put(DoneEvent(error))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            event = queue.get()
+            yield event
+            if isinstance(event, DoneEvent):
+                return
+    finally:
+        cancel.cancel()
+        thread.join()
+
+
+def watch_directories(source, dest, debounce=0.2, poll_interval=None, log_func=print, **options):
+    # Full sync once, then only the directories the watchers report. The
+    # verification pass is part of the initial sync only. The full runs
+    # also size the trees for the --max-delete checks of the partial ones.
+    options['delete_budget'] = DeleteBudget()
+    try:
+        synchronize_directories(source, dest, log_func=log_func, **options)
+    except (SyncError, PurgeRefused) as e:
+        log_func(str(e))
+    options['hverify'] = False
+    roots = [source, dest] if options.get('two_way') else [source]
+    watchers = [make_watcher(root, IGNORED_NAMES, scan_tree, diff_manifests, poll_interval, log_func) for root in roots]
+    log_func(f"Watching {', '.join(roots)} for changes")
+    # A file changed less than --min-age ago is skipped by the run that sees
+    # the change, so its directory is synced again once that much time has
+    # passed: directory (None for the whole tree) -> time.monotonic() when due.
+    path_filter = options.get('path_filter')
+    min_age = path_filter.min_age if path_filter is not None else None
+    later = {}
+    try:
+        while True:
+            changed = wait_for_changes(watchers, debounce, until=min(later.values()) if later else None)
+            now = time.monotonic()
+            due = {reldir for reldir, when in later.items() if when <= now}
+            for reldir in due:
+                del later[reldir]
+            if min_age:
+                when = now + min_age
+                if changed is None:
+                    later[None] = when
+                else:
+                    later.update(dict.fromkeys(changed, when))
+                if len(later) > MAX_PENDING_DIRS:
+                    later = {None: when}
+            if changed is not None:
+                changed = None if None in due else changed | due
+            if changed is not None and not changed:
+                continue
+            try:
+                try:
+                    synchronize_directories(source, dest, only_dirs=changed, log_func=log_func, **options)
+                except PurgeDeferred as e:
+                    log_func(f"{e}; running a full sync")
+                    synchronize_directories(source, dest, log_func=log_func, **options)
+            except (SyncError, PurgeRefused) as e:
+                log_func(str(e))
+    finally:
+        for watcher in watchers:
+            watcher.close()
+
+
+def option_value(argv, name, default=None):
+    if name in argv:
+        index = argv.index(name)
+        if index + 1 < len(argv):
+            return argv[index + 1]
+    return default
+
+
+def filter_rules(argv):
+    # --exclude, --include and --filter-from in the order given, as the
+    # last rule that matches a path wins.
+    rules = []
+    for index, arg in enumerate(argv[:-1]):
+        value = argv[index + 1]
+        if arg == '--exclude':
+            rules.append('\\' + value if value.startswith('!') else value)
+        elif arg == '--include':
+            rules.append('!' + value)
+        elif arg == '--filter-from':
+            rules.extend(read_rules(value))
+    return rules
 
 
-# Example usage
 if __name__ == "__main__":
-	synchronize_directories('/storage/emulated/0/t/source', '/storage/emulated/0/t/destination', verbose=True, use_content=True, purge=True, hverify=True)
-#    if len(sys.argv) < 3:
-#        print("Usage: python sync.py <source_directory> <destination_directory> [options]")
-#        sys.exit(1)
-
-#    source_directory = sys.argv[1]
-#    destination_directory = sys.argv[2]
-#    verbose_mode = '--verbose' in sys.argv
-#    purge_mode = '--purge' in sys.argv
-#    forcecopy_mode = '--forcecopy' in sys.argv
-#    use_ctime_mode = '--use-ctime' in sys.argv
-#    use_content_mode = '--use-content' in sys.argv
-#    two_way_sync = '--2sync' in sys.argv
-#    hverify_mode = '--hverify' in sys.argv
-
-#    synchronize_directories(
-#        source_directory,
-#        destination_directory,
-#        verbose=verbose_mode,
-#        purge=purge_mode,
-#        forcecopy=forcecopy_mode,
-#        use_ctime=use_ctime_mode,
-#        use_content=use_content_mode,
-#        two_way=two_way_sync,
-#        hverify=hverify_mode
-#    )
\ No newline at end of file
+    if len(sys.argv) < 3 or sys.argv[2].startswith('--'):
+        print("Usage: python sync.py <source_directory> <destination_directory> [<destination_directory> ...] [options]")
+        sys.exit(1)
+
+    source_directory = sys.argv[1]
+    # Every argument up to the first option is a destination.
+    destinations = []
+    for arg in sys.argv[2:]:
+        if arg.startswith('--'):
+            break
+        destinations.append(arg)
+    destination_directory = destinations[0] if len(destinations) == 1 else destinations
+    verbose_mode = '--verbose' in sys.argv
+    purge_mode = '--purge' in sys.argv
+    forcecopy_mode = '--forcecopy' in sys.argv
+    use_ctime_mode = '--use-ctime' in sys.argv
+    use_content_mode = '--use-content' in sys.argv
+    two_way_sync = '--2sync' in sys.argv
+    hverify_mode = '--hverify' in sys.argv
+    jobs = int(option_value(sys.argv, '--jobs', 1))
+    no_cache_mode = '--no-cache' in sys.argv
+    rehash_mode = '--rehash' in sys.argv
+    cache_size = int(option_value(sys.argv, '--cache-size', DEFAULT_MAX_ENTRIES))
+    trust_copy_mode = '--trust-copy' in sys.argv
+    incremental_mode = '--incremental' in sys.argv
+    rescan_mode = '--rescan' in sys.argv
+    hash_algo = option_value(sys.argv, '--hash', 'md5')
+    hash_jobs = int(option_value(sys.argv, '--hash-jobs', 0))
+    hash_bufsize = int(option_value(sys.argv, '--hash-buffer', HASH_BUFSIZE // (1024 * 1024))) * 1024 * 1024
+    conflict = option_value(sys.argv, '--conflict', 'newer')
+    watch_mode = '--watch' in sys.argv
+    debounce = float(option_value(sys.argv, '--debounce', 0.2))
+    poll_interval = option_value(sys.argv, '--poll')
+    delta_mode = '--delta' in sys.argv
+    delta_threshold = int(option_value(sys.argv, '--delta-threshold', DELTA_THRESHOLD // (1024 * 1024))) * 1024 * 1024
+    block_size = int(option_value(sys.argv, '--block-size', DELTA_BLOCK_SIZE // 1024)) * 1024
+    hard_links_mode = '--hard-links' in sys.argv
+    resume_mode = '--resume' in sys.argv
+    report_path = option_value(sys.argv, '--report')
+    profile_path = option_value(sys.argv, '--profile')
+    tracemalloc_mode = '--tracemalloc' in sys.argv
+    dry_run_mode = '--dry-run' in sys.argv
+    plan_out = option_value(sys.argv, '--plan-out')
+    run_plan = option_value(sys.argv, '--run-plan')
+    plan_part_arg = option_value(sys.argv, '--plan-part')
+    compare_arg = option_value(sys.argv, '--compare')
+    mtime_window = float(option_value(sys.argv, '--mtime-window', 0))
+    io_depth = int(option_value(sys.argv, '--io-depth', 0))
+    detect_moves_mode = '--detect-moves' in sys.argv
+    dedupe = option_value(sys.argv, '--dedupe')
+    min_size = option_value(sys.argv, '--min-size')
+    max_size = option_value(sys.argv, '--max-size')
+    min_age = option_value(sys.argv, '--min-age')
+    max_age = option_value(sys.argv, '--max-age')
+    idle_io_mode = '--idle-io' in sys.argv
+    max_delete = option_value(sys.argv, '--max-delete')
+    trash_mode = '--trash' in sys.argv
+    purge_jobs = int(option_value(sys.argv, '--purge-jobs', PURGE_JOBS))
+    throttle_file = option_value(sys.argv, '--throttle-file')
+
+    if hash_algo not in HASH_ALGORITHMS:
+        print(f"Unknown hash algorithm: {hash_algo} (choose from {', '.join(HASH_ALGORITHMS)})")
+        sys.exit(1)
+
+    if conflict not in CONFLICT_POLICIES:
+        print(f"Unknown conflict policy: {conflict} (choose from {', '.join(CONFLICT_POLICIES)})")
+        sys.exit(1)
+
+    if dedupe is not None and dedupe not in DEDUPE_MODES:
+        print(f"Unknown dedupe mode: {dedupe} (choose from {', '.join(DEDUPE_MODES)})")
+        sys.exit(1)
+
+    if len(destinations) > 1 and (two_way_sync or run_plan or plan_out):
+        print("--2sync, --run-plan and --plan-out work with one destination only")
+        sys.exit(1)
+
+    path_filter = None
+    try:
+        rules = filter_rules(sys.argv)
+        if rules or any(limit is not None for limit in (min_size, max_size, min_age, max_age)):
+            path_filter = PathFilter(rules,
+                                     min_size=parse_size(min_size) if min_size is not None else None,
+                                     max_size=parse_size(max_size) if max_size is not None else None,
+                                     min_age=parse_age(min_age) if min_age is not None else None,
+                                     max_age=parse_age(max_age) if max_age is not None else None)
+    except (OSError, ValueError) as e:
+        print(f"Bad filter: {e}")
+        sys.exit(1)
+
+    throttle = None
+    try:
+        bwlimit = option_value(sys.argv, '--bwlimit', '0')
+        iops = option_value(sys.argv, '--iops', '0')
+        limits = dict(read_rate=parse_size(option_value(sys.argv, '--read-limit', bwlimit)),
+                      write_rate=parse_size(option_value(sys.argv, '--write-limit', bwlimit)),
+                      read_iops=int(option_value(sys.argv, '--read-iops', iops)),
+                      write_iops=int(option_value(sys.argv, '--write-iops', iops)))
+    except ValueError as e:
+        print(f"Bad limit: {e}")
+        sys.exit(1)
+    if any(limits.values()) or idle_io_mode or throttle_file:
+        # The limits can be changed while the sync runs by editing
+        # throttle_file.
+        throttle = Throttle(idle=idle_io_mode, control_path=throttle_file, **limits)
+
+    compare_tiers = None
+    if compare_arg:
+        try:
+            compare_tiers = parse_tiers(compare_arg)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+    options = dict(
+        verbose=verbose_mode,
+        purge=purge_mode,
+        forcecopy=forcecopy_mode,
+        use_ctime=use_ctime_mode,
+        use_content=use_content_mode,
+        two_way=two_way_sync,
+        hverify=hverify_mode,
+        jobs=jobs,
+        cache=not no_cache_mode,
+        rehash=rehash_mode,
+        cache_size=cache_size,
+        trust_copy=trust_copy_mode,
+        hash_algo=hash_algo,
+        hash_jobs=hash_jobs,
+        hash_bufsize=hash_bufsize,
+        incremental=incremental_mode,
+        rescan=rescan_mode,
+        conflict=conflict,
+        delta=delta_mode,
+        delta_threshold=delta_threshold,
+        block_size=block_size,
+        hard_links=hard_links_mode,
+        compare_tiers=compare_tiers,
+        mtime_window=mtime_window,
+        io_depth=io_depth,
+        detect_moves=detect_moves_mode,
+        dedupe=dedupe,
+        path_filter=path_filter,
+        throttle=throttle,
+        max_delete=float(max_delete) if max_delete is not None else None,
+        trash=trash_mode,
+        purge_jobs=purge_jobs,
+        dry_run=dry_run_mode,
+        plan_out=plan_out,
+        resume=resume_mode,
+        stats=RunStats() if report_path or tracemalloc_mode else None
+    )
+
+    instrumented = instrument(options['stats'], report_path, profile_path, tracemalloc_mode)
+
+    if watch_mode:
+        try:
+            with instrumented:
+                watch_directories(source_directory, destination_directory, debounce=debounce,
+                                  poll_interval=float(poll_interval) if poll_interval else None, **options)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if run_plan:
+        # The plan is run as saved, against the trees it was made for.
+        ops = read_plan(run_plan)
+        try:
+            header = next(ops)
+        except (OSError, ValueError) as e:
+            print(f"Cannot read plan {run_plan}: {e}")
+            sys.exit(1)
+        source_directory, destination_directory = header['source'], header['dest']
+        if plan_part_arg:
+            index, count = (int(n) for n in plan_part_arg.split('/'))
+            ops = plan_part(ops, index - 1, count)
+        options['plan'] = ops
+
+    try:
+        with instrumented:
+            synchronize_directories(source_directory, destination_directory, **options)
+    except (SyncError, PurgeRefused) as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        if tracemalloc_mode and not report_path:
+            print(f"Peak traced memory: {options['stats'].extra['memory']['peak_bytes']} bytes")
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+import sync
+from compare import same_contents
+from events import CancelToken, SyncCancelled
+
+
+@pytest.fixture
+def big(tmp_path, monkeypatch):
+    # Several blocks and chunks long, with both made small.
+    monkeypatch.setattr(sync, 'COPY_BUFSIZE', 4096)
+    monkeypatch.setattr(sync, 'COPY_RANGE_CHUNK', 4096)
+    path = tmp_path / 'big'
+    path.write_bytes(os.urandom(64 * 1024))
+    return str(path)
+
+
+@pytest.fixture
+def cancelled():
+    token = CancelToken()
+    token.cancel()
+    return token
+
+
+def test_hashing_stops(big, cancelled):
+    with pytest.raises(SyncCancelled):
+        sync.compute_file_digest(big, bufsize=4096, cancel=cancelled)
+
+
+@pytest.mark.parametrize('copy', [
+    lambda src, dst, cancel: sync.copy_file_hashed(src, dst, 'md5', 4096, cancel=cancel),
+    lambda src, dst, cancel: sync.clone_file(src, dst, {'ficlone'}, cancel=cancel),
+    lambda src, dst, cancel: sync.clone_file(src, dst, {'ficlone', 'copy_file_range'}, cancel=cancel),
+    lambda src, dst, cancel: sync.send_file(src, dst, cancel),
+])
+def test_copying_stops(big, cancelled, copy):
+    dst = big + '.copy'
+    with pytest.raises(SyncCancelled):
+        copy(big, dst, cancelled)
+    assert os.path.getsize(dst) < os.path.getsize(big)
+
+
+def test_delta_update_stops(big, cancelled):
+    dst = big + '.old'
+    with open(dst, 'wb') as f:
+        f.write(b'\0' * os.path.getsize(big))
+    with pytest.raises(SyncCancelled):
+        sync.delta_copy(big, dst, 4096, cancel=cancelled)
+
+
+def test_comparing_stops(big, cancelled):
+    with pytest.raises(SyncCancelled):
+        same_contents(big, big, cancel=cancelled)
+
+
+def test_send_file_copies(big):
+    dst = big + '.copy'
+    sync.send_file(big, dst, CancelToken())
+    with open(big, 'rb') as f1, open(dst, 'rb') as f2:
+        assert f1.read() == f2.read()
+    assert os.stat(dst).st_mtime_ns == os.stat(big).st_mtime_ns
@@ -0,0 +1,81 @@
+import os
+import time
+import threading
+
+import sync
+from filters import PathFilter
+from manifest import ManifestEntry
+
+
+def write(path, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('x')
+    os.utime(path, (mtime, mtime))
+
+
+def test_rules():
+    path_filter = PathFilter(['*.log', '!keep.log', 'build/', '/top'])
+    assert path_filter.excluded('a/b.log', False)
+    assert not path_filter.excluded('a/keep.log', False)
+    assert path_filter.excluded('a/build', True)
+    assert not path_filter.excluded('a/build', False)
+    assert path_filter.excluded('top', False)
+    assert not path_filter.excluded('a/top', False)
+
+
+def test_ages_are_counted_from_now():
+    path_filter = PathFilter(min_age=60, now=1000)
+    assert path_filter.at(2000).skipped(ManifestEntry('f', 'f', 1, 1990 * 10 ** 9, 0, 0))
+    assert not path_filter.at(2000).skipped(ManifestEntry('f', 'f', 1, 1500 * 10 ** 9, 0, 0))
+    # at() leaves the original alone.
+    assert not path_filter.skipped(ManifestEntry('f', 'f', 1, 900 * 10 ** 9, 0, 0))
+
+
+def test_age_limits_are_taken_at_each_run(tmp_path):
+    # A filter built a while ago, as in a watch session.
+    now = time.time()
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    write(str(src / 'settled'), now - 10)
+    write(str(src / 'stale'), now - 80)
+    path_filter = PathFilter(min_age=1, max_age=60, now=now - 100)
+    sync.synchronize_directories(str(src), str(dst), path_filter=path_filter, log_func=lambda message: None)
+    assert os.path.exists(dst / 'settled')
+    assert not os.path.exists(dst / 'stale')
+
+
+class Stop(Exception):
+    pass
+
+
+def test_watch_copies_files_once_old_enough(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    os.makedirs(src)
+    stop = threading.Event()
+
+    def log(message):
+        if stop.is_set():
+            raise Stop
+
+    def watch():
+        try:
+            sync.watch_directories(str(src), str(dst), debounce=0.1, poll_interval=0.1, verbose=True,
+                                   path_filter=PathFilter(min_age=1), log_func=log)
+        except Stop:
+            pass
+
+    thread = threading.Thread(target=watch, daemon=True)
+    thread.start()
+    try:
+        time.sleep(0.5)
+        write(str(src / 'new.txt'), time.time())
+        deadline = time.monotonic() + 10
+        while not os.path.exists(dst / 'new.txt') and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert os.path.exists(dst / 'new.txt')
+    finally:
+        stop.set()
+        write(str(src / 'stop.txt'), time.time())
+        thread.join(10)
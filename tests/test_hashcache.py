@@ -0,0 +1,34 @@
+import os
+import sqlite3
+
+import hashcache
+from hashcache import HashCache
+
+
+def test_hits_are_flushed_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(hashcache, 'COMMIT_EVERY', 10)
+    path = str(tmp_path / 'hashes.db')
+    (tmp_path / 'f').write_text('x')
+    st = os.stat(tmp_path / 'f')
+    cache = HashCache(path)
+    cache.put(st, 'md5', 'abc')
+    cache.close()
+
+    cache = HashCache(path)
+    for _ in range(25):
+        assert cache.get(st, 'md5') == 'abc'
+        assert len(cache.hits) < 10
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT used FROM digests").fetchone()[0] == cache.stamp
+    conn.close()
+    cache.close()
+
+
+def test_changed_file_is_not_trusted(tmp_path):
+    cache = HashCache(str(tmp_path / 'hashes.db'))
+    (tmp_path / 'f').write_text('x')
+    st = os.stat(tmp_path / 'f')
+    cache.put(st, 'md5', 'abc')
+    (tmp_path / 'f').write_text('yy')
+    assert cache.get(os.stat(tmp_path / 'f'), 'md5') is None
+    cache.close()
@@ -0,0 +1,49 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from purge import remove_tree, DeleteBudget, PurgeDeferred
+
+
+def write(path, data='x'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def test_remove_tree(tmp_path):
+    for i in range(40):
+        write(str(tmp_path / 'tree' / f"d{i % 5}" / f"e{i % 3}" / f"f{i}"))
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        remove_tree(str(tmp_path / 'tree'), pool, 2)
+    assert not os.path.exists(tmp_path / 'tree')
+
+
+def test_remove_tree_unlinks_symlinked_root(tmp_path):
+    write(str(tmp_path / 'elsewhere' / 'sub' / 'precious'))
+    os.symlink(tmp_path / 'elsewhere', tmp_path / 'tree')
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        remove_tree(str(tmp_path / 'tree'), pool, 2)
+    assert not os.path.lexists(tmp_path / 'tree')
+    assert os.path.exists(tmp_path / 'elsewhere' / 'sub' / 'precious')
+
+
+def test_remove_tree_does_not_follow_symlinks_inside(tmp_path):
+    write(str(tmp_path / 'elsewhere' / 'precious'))
+    write(str(tmp_path / 'tree' / 'sub' / 'file'))
+    os.symlink(tmp_path / 'elsewhere', tmp_path / 'tree' / 'sub' / 'link')
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        remove_tree(str(tmp_path / 'tree'), pool, 2)
+    assert not os.path.exists(tmp_path / 'tree')
+    assert os.path.exists(tmp_path / 'elsewhere' / 'precious')
+
+
+def test_delete_budget():
+    budget = DeleteBudget()
+    with pytest.raises(PurgeDeferred):
+        budget.check(1, 10, 'dst')
+    budget.reset('dst', 100)
+    budget.check(6, 10, 'dst')
+    with pytest.raises(PurgeDeferred):
+        budget.check(5, 10, 'dst')
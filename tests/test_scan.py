@@ -0,0 +1,70 @@
+import os
+import sqlite3
+
+import sync
+from filters import PathFilter
+from snapshot import TreeSnapshot, snapshot_path
+
+
+def write(path, data='x'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def quiet(message):
+    pass
+
+
+def test_dircmp_ignores_are_synced(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    names = [os.path.join('proj', '.git', 'HEAD'), os.path.join('proj', 'tags'),
+             os.path.join('proj', '__pycache__', 'mod.pyc'), os.path.join('proj', 'CVS', 'Root')]
+    for name in names:
+        write(str(src / name))
+    sync.synchronize_directories(str(src), str(dst), log_func=quiet)
+    for name in names:
+        assert os.path.exists(dst / name)
+
+
+def test_exclude_leaves_them_out(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    write(str(src / '.git' / 'HEAD'))
+    write(str(src / 'tags'))
+    sync.synchronize_directories(str(src), str(dst), path_filter=PathFilter(['.git/']), log_func=quiet)
+    assert not os.path.exists(dst / '.git')
+    assert os.path.exists(dst / 'tags')
+
+
+def test_meta_dir_is_never_synced(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    write(str(src / sync.META_DIR / 'marker'))
+    write(str(dst / 'old'))
+    sync.synchronize_directories(str(src), str(dst), purge=True, log_func=quiet)
+    assert not os.path.exists(dst / sync.META_DIR / 'marker')
+    assert not os.path.exists(dst / 'old')
+
+
+def test_snapshot_of_other_version_is_not_used(tmp_path):
+    root = tmp_path / 'tree'
+    write(str(root / 'a'))
+    path = snapshot_path(str(tmp_path), str(root))
+    snapshot = TreeSnapshot(path)
+    snapshot.record('', 1, [('a', 'f', 1, 1, 1, 1)])
+    snapshot.save()
+
+    def lookup():
+        snapshot = TreeSnapshot(path, readonly=True)
+        try:
+            return snapshot.lookup('', 1)
+        finally:
+            snapshot.close()
+
+    assert lookup() == [('a', 'f', 1, 1, 1, 1)]
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA user_version = 1")
+    conn.close()
+    assert lookup() is None
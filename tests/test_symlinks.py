@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+import sync
+from filters import PathFilter
+from purge import remove_entry
+
+
+def write(path, data='x'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def trees(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    elsewhere = tmp_path / 'elsewhere'
+    write(str(src / 'keep.txt'))
+    write(str(elsewhere / 'precious'))
+    os.makedirs(dst)
+    os.symlink(elsewhere, dst / 'link')
+    return str(src), str(dst), str(elsewhere)
+
+
+@pytest.mark.parametrize('rules', [[], ['*.tmp']])
+@pytest.mark.parametrize('io_depth', [0, 4])
+def test_purge_removes_link_not_its_target(trees, rules, io_depth):
+    src, dst, elsewhere = trees
+    sync.synchronize_directories(src, dst, purge=True, path_filter=PathFilter(rules), io_depth=io_depth,
+                                 log_func=lambda message: None)
+    assert os.path.exists(os.path.join(elsewhere, 'precious'))
+    assert not os.path.lexists(os.path.join(dst, 'link'))
+    assert os.path.exists(os.path.join(dst, 'keep.txt'))
+
+
+def test_symlink_is_copied_as_link(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    write(str(tmp_path / 'outside' / 'big'))
+    os.makedirs(src)
+    os.symlink(tmp_path / 'outside', src / 'dirlink')
+    os.symlink('missing', src / 'dangling')
+    sync.synchronize_directories(str(src), str(dst), log_func=lambda message: None)
+    assert os.readlink(dst / 'dirlink') == str(tmp_path / 'outside')
+    assert os.readlink(dst / 'dangling') == 'missing'
+
+    os.remove(src / 'dangling')
+    os.symlink('elsewhere', src / 'dangling')
+    sync.synchronize_directories(str(src), str(dst), log_func=lambda message: None)
+    assert os.readlink(dst / 'dangling') == 'elsewhere'
+
+
+def test_nothing_is_copied_through_a_symlinked_directory(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    write(str(src / 'sub' / 'new.txt'))
+    os.makedirs(dst)
+    os.makedirs(tmp_path / 'elsewhere')
+    os.symlink(tmp_path / 'elsewhere', dst / 'sub')
+    sync.synchronize_directories(str(src), str(dst), purge=True, log_func=lambda message: None)
+    assert os.listdir(tmp_path / 'elsewhere') == []
+
+
+def test_remove_entry_does_not_walk_through_swapped_directory(tmp_path):
+    root = tmp_path / 'root'
+    write(str(tmp_path / 'elsewhere' / 'precious'))
+    os.makedirs(root)
+    # The scan saw root/dir/precious; dir has since become a symlink.
+    os.symlink(tmp_path / 'elsewhere', root / 'dir')
+    with pytest.raises(OSError):
+        remove_entry(str(root), os.path.join('dir', 'precious'))
+    assert os.path.exists(tmp_path / 'elsewhere' / 'precious')
+
+
+def test_two_way_purge_keeps_link_target(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    write(str(tmp_path / 'elsewhere' / 'precious'))
+    os.makedirs(src)
+    os.symlink(tmp_path / 'elsewhere', src / 'link')
+    sync.synchronize_directories(str(src), str(dst), two_way=True, purge=True, log_func=lambda message: None)
+    assert os.readlink(dst / 'link') == str(tmp_path / 'elsewhere')
+
+    os.remove(dst / 'link')
+    sync.synchronize_directories(str(src), str(dst), two_way=True, purge=True, log_func=lambda message: None)
+    assert not os.path.lexists(src / 'link')
+    assert os.path.exists(tmp_path / 'elsewhere' / 'precious')
+
+
+def test_two_way_leaves_directory_against_symlink_alone(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    write(str(tmp_path / 'elsewhere' / 'a'))
+    write(str(tmp_path / 'elsewhere' / 'b'))
+    write(str(dst / 'dir' / 'a'))
+    os.makedirs(src)
+    os.symlink(tmp_path / 'elsewhere', src / 'dir')
+    for _ in range(2):
+        sync.synchronize_directories(str(src), str(dst), two_way=True, purge=True, log_func=lambda message: None)
+    os.remove(dst / 'dir' / 'a')
+    sync.synchronize_directories(str(src), str(dst), two_way=True, purge=True, log_func=lambda message: None)
+    assert sorted(os.listdir(tmp_path / 'elsewhere')) == ['a', 'b']
+    assert os.path.islink(src / 'dir')
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+import sync
+from fanout import FanOut
+from hashcache import HashCache
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def other_fs(tmp_path):
+    # A destination on another filesystem: within one, files are cloned
+    # instead of copied through Python, so nothing is hashed on the way.
+    if not os.path.isdir('/dev/shm') or os.stat('/dev/shm').st_dev == os.stat(tmp_path).st_dev:
+        pytest.skip("needs a second filesystem")
+    path = tempfile.mkdtemp(dir='/dev/shm')
+    yield os.path.join(path, 'dst')
+    shutil.rmtree(path)
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    # Paths that verify_md5 had to read.
+    paths = []
+    compute = sync.compute_file_digest
+
+    def counting(file_path, *args, **kwargs):
+        paths.append(file_path)
+        return compute(file_path, *args, **kwargs)
+
+    monkeypatch.setattr(sync, 'compute_file_digest', counting)
+    return paths
+
+
+@pytest.mark.parametrize('trust_copy', [False, True])
+def test_copied_files_are_not_hashed_again(tmp_path, other_fs, hashed, trust_copy):
+    src = tmp_path / 'src'
+    dst = other_fs
+    for i in range(3):
+        write(str(src / f"f{i}"), str(i) * 100)
+    lines = []
+    sync.synchronize_directories(str(src), str(dst), hverify=True, trust_copy=trust_copy, log_func=lines.append)
+    assert "All files are synchronized (MD5 hashes match)." in lines
+    expected = [] if trust_copy else [os.path.join(dst, f"f{i}") for i in range(3)]
+    assert sorted(hashed) == expected
+
+
+def test_verify_without_cache_reads_both_sides(tmp_path, hashed):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    write(str(src / 'f'), 'data')
+    lines = []
+    sync.synchronize_directories(str(src), str(dst), hverify=True, cache=False, log_func=lines.append)
+    assert "All files are synchronized (MD5 hashes match)." in lines
+    assert sorted(hashed) == [str(dst / 'f'), str(src / 'f')]
+
+
+def test_fanout_shares_source_digests_through_caches(tmp_path):
+    caches = [HashCache(str(tmp_path / f"cache{i}.db")) for i in range(3)]
+    fanout = FanOut(3, 1024, 1024)
+    members = [fanout.member(i) for i in range(3)]
+    for member, cache in zip(members, caches):
+        member.add_cache(cache)
+    write(str(tmp_path / 'f'), 'data')
+    st = os.stat(tmp_path / 'f')
+    members[0].put_digest(st, 'md5', 'abc')
+    assert [cache.get(st, 'md5') for cache in caches] == ['abc'] * 3
+    members[1].remove_cache()
+    caches[1].close()
+    members[0].put_digest(st, 'sha1', 'def')
+    assert caches[2].get(st, 'sha1') == 'def'
+    for cache in caches[::2]:
+        cache.close()
+
+
+def test_several_destinations_verify(tmp_path):
+    src = tmp_path / 'src'
+    dests = [str(tmp_path / f"dst{i}") for i in range(3)]
+    for i in range(5):
+        write(str(src / 'sub' / f"f{i}"), str(i) * 1000)
+    for _ in range(2):
+        lines = []
+        sync.synchronize_directories(str(src), dests, hverify=True, log_func=lines.append)
+        assert lines.count("All files are synchronized (MD5 hashes match).") == 3
@@ -0,0 +1,203 @@
+import os
+import time
+import ctypes
+import platform
+import threading
+
+from filters import parse_size
+
+# A bucket holds this many seconds' worth of its rate, so short bursts go
+# through at full speed while the average stays at the limit.
+BURST_SECONDS = 0.25
+# Longest single wait, so a raised limit takes effect quickly.
+MAX_SLEEP = 0.1
+# How often the control file is looked at while data moves.
+CONTROL_INTERVAL = 1.0
+# In idle mode, cached pages of a file are dropped after this many bytes.
+DROP_BYTES = 16 * 1024 * 1024
+
+LIMITS = ('read_rate', 'write_rate', 'read_iops', 'write_iops')
+# Names in the control file, as the command line options without "--".
+CONTROL_NAMES = {
+    'bwlimit': ('read_rate', 'write_rate'),
+    'read-limit': ('read_rate',),
+    'write-limit': ('write_rate',),
+    'iops': ('read_iops', 'write_iops'),
+    'read-iops': ('read_iops',),
+    'write-iops': ('write_iops',),
+}
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+SYS_IOPRIO_SET = {'x86_64': 251, 'aarch64': 30, 'i386': 289, 'i686': 289, 'armv7l': 314, 'ppc64le': 273,
+                  'riscv64': 30, 's390x': 282}
+
+
+def set_idle_io():
+    # Puts the calling thread in the idle I/O class, so the disk serves it
+    # only when nothing else wants it (Linux, with the BFQ or CFQ
+    # scheduler). Python has no ioprio_set, so this goes through syscall().
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0
+    except (OSError, AttributeError, TypeError):
+        return False
+
+
+def drop_cache(f):
+    # Tells the kernel the file's cached pages will not be needed again.
+    # Pages still waiting to be written are queued for writeback and go on
+    # a later call.
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except (OSError, ValueError):
+            pass
+
+
+class TokenBucket:
+    # rate units per second; 0 is no limit. A request larger than the
+    # bucket goes through once the bucket is full and leaves it in debt.
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.capacity = max(rate * BURST_SECONDS, 1)
+            self.tokens = self.capacity
+            self.stamp = time.monotonic()
+
+    def take(self, amount):
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= min(amount, self.capacity):
+                    self.tokens -= amount
+                    return
+                wait = (min(amount, self.capacity) - self.tokens) / self.rate
+            time.sleep(min(wait, MAX_SLEEP))
+
+
+class Throttle:
+    # Limits on bytes and operations per second for reads and writes,
+    # shared by every thread of a sync. The copy and hash loops report each
+    # block after moving it and wait here while they are over a limit.
+    # set_limits can be called from any thread while the sync runs (a GUI
+    # control), and with control_path the limits are also read from that
+    # file whenever it changes, one "name value" line per limit with the
+    # names of the command line options (bwlimit 20M, write-iops 200, ...).
+    #
+    # With idle, every thread that does I/O moves to the idle I/O class and
+    # the page cache is told to drop what the sync read and wrote, so it
+    # does not push out the cache of other programs on the host.
+    def __init__(self, read_rate=0, write_rate=0, read_iops=0, write_iops=0, idle=False, control_path=None):
+        self.buckets = {name: TokenBucket() for name in LIMITS}
+        self.set_limits(read_rate=read_rate, write_rate=write_rate, read_iops=read_iops, write_iops=write_iops)
+        self.idle = idle
+        self.control_path = control_path
+        self.control_mtime = None
+        self.next_check = 0
+        self.control_lock = threading.Lock()
+        self.local = threading.local()
+
+    def set_limits(self, **limits):
+        for name, rate in limits.items():
+            if name not in LIMITS:
+                raise ValueError(f"Unknown limit: {name}")
+            if rate is not None:
+                self.buckets[name].set_rate(rate)
+
+    def limits(self):
+        return {name: bucket.rate for name, bucket in self.buckets.items()}
+
+    @property
+    def active(self):
+        return self.idle or self.control_path is not None or any(self.limits().values())
+
+    def check_control(self):
+        now = time.monotonic()
+        if self.control_path is None or now < self.next_check:
+            return
+        with self.control_lock:
+            if now < self.next_check:
+                return
+            self.next_check = now + CONTROL_INTERVAL
+            try:
+                mtime = os.stat(self.control_path).st_mtime_ns
+                if mtime == self.control_mtime:
+                    return
+                self.control_mtime = mtime
+                with open(self.control_path, encoding='utf-8') as f:
+                    lines = f.read().splitlines()
+            except OSError:
+                return
+            self.set_limits(**read_control(lines))
+
+    def enter(self):
+        if self.idle and not getattr(self.local, 'idle', False):
+            self.local.idle = True
+            set_idle_io()
+        self.check_control()
+
+    def read(self, nbytes, f=None):
+        self.enter()
+        self.buckets['read_iops'].take(1)
+        self.buckets['read_rate'].take(nbytes)
+        self.pending('read_pending', nbytes, f)
+
+    def write(self, nbytes, f=None):
+        self.enter()
+        self.buckets['write_iops'].take(1)
+        self.buckets['write_rate'].take(nbytes)
+        self.pending('write_pending', nbytes, f)
+
+    def pending(self, name, nbytes, f):
+        if not self.idle or f is None:
+            return
+        total = getattr(self.local, name, 0) + nbytes
+        if total >= DROP_BYTES:
+            drop_cache(f)
+            total = 0
+        setattr(self.local, name, total)
+
+    def done(self, *files):
+        # A file is finished with; in idle mode, drop what is left of it.
+        if self.idle:
+            for f in files:
+                drop_cache(f)
+
+
+def engaged(throttle):
+    # throttle if it limits anything right now, otherwise None, so a file
+    # with no limit to keep goes the fast way (copy2/sendfile, large
+    # copy_file_range chunks, no per-block accounting). Asked once per file,
+    # so a limit set while a run goes on applies from the next file.
+    return throttle if throttle is not None and throttle.active else None
+
+
+def read_control(lines):
+    # Limits from control file lines. A line that cannot be read is
+    # skipped, so a half-edited file leaves the limits it names as they are.
+    limits = {}
+    for line in lines:
+        parts = line.split('#', 1)[0].split()
+        if len(parts) != 2 or parts[0] not in CONTROL_NAMES:
+            continue
+        name, value = parts
+        try:
+            rate = parse_size(value) if 'iops' not in name else int(value)
+        except ValueError:
+            continue
+        for limit in CONTROL_NAMES[name]:
+            limits[limit] = rate
+    return limits
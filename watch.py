@@ -0,0 +1,192 @@
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# IN_MODIFY is left out on purpose: it fires on every write(), while
+# IN_CLOSE_WRITE fires once when the writer is done with the file.
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# Past this many changed directories in one batch, a full resync is cheaper
+# than tracking them, and it keeps the pending set bounded.
+MAX_PENDING_DIRS = 10000
+
+
+class WatchOverflow(Exception):
+    pass
+
+
+class InotifyWatcher:
+    # Reports the relative directories in which something was created,
+    # deleted, moved or finished writing. One inotify watch per directory.
+    def __init__(self, root, ignore=()):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.root = root
+        self.ignore = set(ignore)
+        self.paths = {}
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        try:
+            self.add_tree('')
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_tree(self, reldir):
+        stack = [reldir]
+        while stack:
+            reldir = stack.pop()
+            path = os.path.join(self.root, reldir) if reldir else self.root
+            wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(err, os.strerror(err), path)
+            self.paths[wd] = reldir
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.name not in self.ignore and entry.is_dir(follow_symlinks=False):
+                            stack.append(os.path.join(reldir, entry.name) if reldir else entry.name)
+            except OSError:
+                continue
+
+    def remove_tree(self, reldir):
+        prefix = reldir + os.sep
+        for wd, path in list(self.paths.items()):
+            if path == reldir or path.startswith(prefix):
+                self._rm_watch(self.fd, wd)
+                del self.paths[wd]
+
+    def poll(self, timeout):
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, possibly including new directories
+                    # that still need a watch.
+                    self.add_tree('')
+                    raise WatchOverflow()
+                reldir = self.paths.get(wd)
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    continue
+                if reldir is None or name in self.ignore:
+                    continue
+                changed.add(reldir)
+                if mask & IN_ISDIR:
+                    child = os.path.join(reldir, name) if reldir else name
+                    if mask & IN_MOVED_FROM:
+                        self.remove_tree(child)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        self.add_tree(child)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    # Fallback for platforms without inotify (or out of watches): rescans the
+    # tree every interval seconds and reports the directories that differ.
+    def __init__(self, root, scan, diff, interval=2.0):
+        self.root = root
+        self.scan = scan
+        self.diff = diff
+        self.interval = interval
+        self.manifest = scan(root)
+        self.last = time.monotonic()
+
+    def poll(self, timeout):
+        changed = set()
+        wait = self.last + self.interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return changed
+        time.sleep(max(0, wait))
+        manifest = self.scan(self.root)
+        self.last = time.monotonic()
+        for old, new in self.diff(self.manifest, manifest):
+            if old is None or new is None or old[1:4] != new[1:4]:
+                changed.add(os.path.dirname((old or new).relpath))
+        self.manifest = manifest
+        return changed
+
+    def close(self):
+        pass
+
+
+def make_watcher(root, ignore, scan, diff, poll_interval=None, log_func=print):
+    if poll_interval is None and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root, ignore)
+        except (OSError, AttributeError) as e:
+            log_func(f"inotify not available for {root} ({e}), falling back to polling")
+    return PollingWatcher(root, scan, diff, poll_interval or 2.0)
+
+
+def wait_for_changes(watchers, debounce=0.2, max_delay=5.0, until=None):
+    # Blocks until something changed, then keeps collecting until nothing new
+    # arrived for debounce seconds (or max_delay passed since the first
+    # event). Returns the changed directories, or None for "resync all".
+    # With until (a time.monotonic() value), returns an empty set if nothing
+    # happened by then.
+    changed = set()
+    full = False
+    first = last = None
+    while True:
+        for watcher in watchers:
+            try:
+                dirs = watcher.poll(debounce / len(watchers))
+            except WatchOverflow:
+                dirs = None
+                full = True
+            if dirs is None or dirs:
+                last = time.monotonic()
+                first = first or last
+                if dirs:
+                    changed.update(dirs)
+        if len(changed) > MAX_PENDING_DIRS:
+            full = True
+        if full:
+            changed.clear()
+        now = time.monotonic()
+        if first is not None:
+            if now - last >= debounce or now - first >= max_delay:
+                return None if full else changed
+        elif until is not None and now >= until:
+            return changed
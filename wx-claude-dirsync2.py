@@ -1,11 +1,10 @@
 #Debugged with Claude AI Engine
 #
 import os
-import filecmp
-import shutil
-import hashlib
 import wx
 import threading
+import sync
+from progress import ProgressLog, FLUSH_INTERVAL_MS, LOG_VIEW_LINES
 
 class SyncFrame(wx.Frame):
     def __init__(self):
@@ -27,9 +26,26 @@ class SyncFrame(wx.Frame):
         self.two_way_check = wx.CheckBox(panel, label="Two-Way Sync")
         self.hverify_check = wx.CheckBox(panel, label="Hash Verify")
         
+        # Limits can be changed while a sync runs; 0 is no limit.
+        self.limit_label = wx.StaticText(panel, label="Limit MB/s:")
+        self.limit_spin = wx.SpinCtrl(panel, min=0, max=100000, initial=0)
+        self.iops_label = wx.StaticText(panel, label="Ops/s:")
+        self.iops_spin = wx.SpinCtrl(panel, min=0, max=1000000, initial=0)
+        self.idle_check = wx.CheckBox(panel, label="Idle I/O")
+        self.throttle = None
+        
         self.sync_button = wx.Button(panel, label="Synchronize")
+        self.cancel_button = wx.Button(panel, label="Cancel")
+        self.cancel_button.Disable()
+        self.cancel = None
         
+        self.progress_gauge = wx.Gauge(panel, range=1000)
+        self.status_text = wx.StaticText(panel, label="")
         self.progress_text = wx.TextCtrl(panel, style=wx.TE_MULTILINE | wx.TE_READONLY)
+        self.log_lines = 0
+        
+        self.progress = None
+        self.progress_timer = wx.Timer(self)
         
         # Sizers
         main_sizer = wx.BoxSizer(wx.VERTICAL)
@@ -52,10 +68,23 @@ class SyncFrame(wx.Frame):
         options_sizer.Add(self.two_way_check, 0, wx.ALL, 5)
         options_sizer.Add(self.hverify_check, 0, wx.ALL, 5)
         
+        throttle_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        throttle_sizer.Add(self.limit_label, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        throttle_sizer.Add(self.limit_spin, 0, wx.ALL, 5)
+        throttle_sizer.Add(self.iops_label, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        throttle_sizer.Add(self.iops_spin, 0, wx.ALL, 5)
+        throttle_sizer.Add(self.idle_check, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        
         main_sizer.Add(source_sizer, 0, wx.EXPAND)
         main_sizer.Add(dest_sizer, 0, wx.EXPAND)
         main_sizer.Add(options_sizer, 0, wx.EXPAND)
-        main_sizer.Add(self.sync_button, 0, wx.ALL | wx.CENTER, 5)
+        main_sizer.Add(throttle_sizer, 0, wx.EXPAND)
+        buttons_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        buttons_sizer.Add(self.sync_button, 0, wx.ALL, 5)
+        buttons_sizer.Add(self.cancel_button, 0, wx.ALL, 5)
+        main_sizer.Add(buttons_sizer, 0, wx.CENTER)
+        main_sizer.Add(self.progress_gauge, 0, wx.ALL | wx.EXPAND, 5)
+        main_sizer.Add(self.status_text, 0, wx.ALL | wx.EXPAND, 5)
         main_sizer.Add(self.progress_text, 1, wx.ALL | wx.EXPAND, 5)
         
         panel.SetSizer(main_sizer)
@@ -64,6 +93,10 @@ class SyncFrame(wx.Frame):
         self.source_button.Bind(wx.EVT_BUTTON, self.on_browse_source)
         self.dest_button.Bind(wx.EVT_BUTTON, self.on_browse_dest)
         self.sync_button.Bind(wx.EVT_BUTTON, self.on_sync)
+        self.cancel_button.Bind(wx.EVT_BUTTON, self.on_cancel)
+        self.limit_spin.Bind(wx.EVT_SPINCTRL, self.on_limits)
+        self.iops_spin.Bind(wx.EVT_SPINCTRL, self.on_limits)
+        self.Bind(wx.EVT_TIMER, self.on_timer, self.progress_timer)
         
         self.Show()
     
@@ -93,132 +126,96 @@ class SyncFrame(wx.Frame):
             wx.MessageBox("Please select both source and destination directories.", "Error", wx.OK | wx.ICON_ERROR)
             return
         
+        try:
+            log_dir = os.path.join(dest, sync.META_DIR)
+            os.makedirs(log_dir, exist_ok=True)
+            self.progress = ProgressLog(os.path.join(log_dir, 'sync.log'))
+        except OSError as e:
+            wx.MessageBox(f"Cannot write to the destination directory: {e}", "Error", wx.OK | wx.ICON_ERROR)
+            return
+        
         self.progress_text.Clear()
+        self.log_lines = 0
+        self.progress_gauge.SetValue(0)
         self.sync_button.Disable()
         
-        thread = threading.Thread(target=self.run_sync, args=(source, dest, verbose, purge, forcecopy, use_content, two_way, hverify))
+        self.cancel = sync.CancelToken()
+        self.throttle = sync.Throttle(idle=self.idle_check.GetValue(), **self.limits())
+        thread = threading.Thread(target=self.run_sync, args=(source, dest, verbose, purge, forcecopy, use_content, two_way, hverify, self.progress, self.cancel, self.throttle))
         thread.start()
+        self.progress_timer.Start(FLUSH_INTERVAL_MS)
+        self.cancel_button.Enable()
     
-    def run_sync(self, source, dest, verbose, purge, forcecopy, use_content, two_way, hverify):
-        def log(message):
-            wx.CallAfter(self.progress_text.AppendText, message + "\n")
-        
+    def limits(self):
+        rate = self.limit_spin.GetValue() * 1024 * 1024
+        iops = self.iops_spin.GetValue()
+        return dict(read_rate=rate, write_rate=rate, read_iops=iops, write_iops=iops)
+    
+    def on_limits(self, event):
+        # Takes effect at the next block the running sync moves.
+        if self.throttle is not None:
+            self.throttle.set_limits(**self.limits())
+    
+    def on_cancel(self, event):
+        # Stops at the next file or block; what was copied so far stays.
+        self.cancel_button.Disable()
+        self.cancel.cancel()
+    
+    def run_sync(self, source, dest, verbose, purge, forcecopy, use_content, two_way, hverify, progress, cancel, throttle):
+        # Log lines and events go into progress, which on_timer drains a
+        # few times per second; no wx.CallAfter per file.
         try:
-            self.synchronize_directories(source, dest, verbose, purge, forcecopy, False, use_content, two_way, hverify, log)
+            self.synchronize_directories(source, dest, verbose, purge, forcecopy, False, use_content, two_way, hverify, progress.log, progress.event, cancel, throttle)
             wx.CallAfter(self.show_success)
+        except sync.SyncCancelled:
+            wx.CallAfter(self.show_cancelled)
         except Exception as e:
             wx.CallAfter(self.show_error, str(e))
         finally:
+            progress.close()
             wx.CallAfter(self.sync_button.Enable)
     
+    def on_timer(self, event):
+        self.flush_progress()
+    
+    def flush_progress(self):
+        lines = self.progress.drain()
+        if lines:
+            self.progress_text.AppendText("\n".join(lines) + "\n")
+            self.log_lines += len(lines)
+            if self.log_lines > LOG_VIEW_LINES:
+                # Only the last LOG_VIEW_LINES lines stay in the view; the
+                # full log is in the log file.
+                excess = self.log_lines - LOG_VIEW_LINES
+                self.progress_text.Remove(0, self.progress_text.XYToPosition(0, excess))
+                self.log_lines = LOG_VIEW_LINES
+        fraction, text = self.progress.status()
+        self.progress_gauge.SetValue(int(fraction * 1000))
+        self.status_text.SetLabel(text)
+    
+    def finish_progress(self):
+        self.cancel_button.Disable()
+        self.progress_timer.Stop()
+        self.flush_progress()
+        self.status_text.SetLabel(f"{self.status_text.GetLabel()}. Full log: {self.progress.log_path}")
+    
     def show_success(self):
+        self.finish_progress()
         wx.MessageBox("Synchronization completed successfully!", "Success", wx.OK | wx.ICON_INFORMATION)
     
+    def show_cancelled(self):
+        self.finish_progress()
+        wx.MessageBox("Synchronization was cancelled.", "Cancelled", wx.OK | wx.ICON_INFORMATION)
+    
     def show_error(self, message):
+        self.finish_progress()
         wx.MessageBox(f"An error occurred: {message}", "Error", wx.OK | wx.ICON_ERROR)
     
-    def synchronize_directories(self, source, dest, verbose, purge, forcecopy, use_ctime, use_content, two_way, hverify, log_func):
-        if not os.path.exists(dest):
-            os.makedirs(dest)
-            if verbose:
-                log_func(f"Created target directory: {dest}")
-
-        def compare_and_copy(src, dst, reverse=False):
-            comparison = filecmp.dircmp(src, dst)
-            copy_files(comparison, src, dst, reverse)
-            if purge:
-                delete_files(comparison, dst)
-
-        def copy_files(comp, src, dst, reverse):
-            for name in comp.left_only:
-                srcpath = os.path.join(src, name)
-                dstpath = os.path.join(dst, name)
-                if os.path.isdir(srcpath):
-                    shutil.copytree(srcpath, dstpath)
-                    if verbose:
-                        log_func(f"Copied directory: {srcpath} to {dstpath}")
-                else:
-                    shutil.copy2(srcpath, dstpath)
-                    if verbose:
-                        log_func(f"Copied file: {srcpath} to {dstpath}")
-
-            for name in comp.common_files:
-                srcpath = os.path.join(src, name)
-                dstpath = os.path.join(dst, name)
-                if forcecopy or not filecmp.cmp(srcpath, dstpath, shallow=not use_content):
-                    if reverse:
-                        shutil.copy2(dstpath, srcpath)
-                        if verbose:
-                            log_func(f"Updated file: {dstpath} to {srcpath}")
-                    else:
-                        shutil.copy2(srcpath, dstpath)
-                        if verbose:
-                            log_func(f"Updated file: {srcpath} to {dstpath}")
-
-            for subdir in comp.common_dirs:
-                compare_and_copy(os.path.join(src, subdir), os.path.join(dst, subdir), reverse)
-
-        def delete_files(comp, dst):
-            for name in comp.right_only:
-                dstpath = os.path.join(dst, name)
-                if os.path.isdir(dstpath):
-                    shutil.rmtree(dstpath)
-                    if verbose:
-                        log_func(f"Deleted directory: {dstpath}")
-                else:
-                    os.remove(dstpath)
-                    if verbose:
-                        log_func(f"Deleted file: {dstpath}")
-
-        def compute_file_md5(file_path):
-            md5_hash = hashlib.md5()
-            with open(file_path, 'rb') as f:
-                while chunk := f.read(8192):
-                    md5_hash.update(chunk)
-            return md5_hash.hexdigest()
-
-        def verify_md5(src, dst):
-            src_files = []
-            dst_files = []
-
-            for root, _, files in os.walk(src):
-                for name in files:
-                    src_files.append(os.path.relpath(os.path.join(root, name), src))
-
-            for root, _, files in os.walk(dst):
-                for name in files:
-                    dst_files.append(os.path.relpath(os.path.join(root, name), dst))
-
-            all_files = set(src_files + dst_files)
-            match = True
-
-            for file in all_files:
-                src_file = os.path.join(src, file)
-                dst_file = os.path.join(dst, file)
-
-                if os.path.exists(src_file) and os.path.exists(dst_file):
-                    src_md5 = compute_file_md5(src_file)
-                    dst_md5 = compute_file_md5(dst_file)
-                    if src_md5 != dst_md5:
-                        match = False
-                        log_func(f"MD5 mismatch for {file}: {src_md5} (source) vs {dst_md5} (destination)")
-                    else: 
-                        log_func(f"MD5 match for {file}: {src_md5}")
-                else:
-                    match = False
-                    log_func(f"File {file} is not present in both source and destination")
-
-            if match:
-                log_func("All files are synchronized (MD5 hashes match).")
-            else:
-                log_func("Some files are not synchronized (MD5 hashes do not match).")
-
-        compare_and_copy(source, dest)
-        if two_way:
-            compare_and_copy(dest, source, reverse=True)
+    def synchronize_directories(self, source, dest, verbose, purge, forcecopy, use_ctime, use_content, two_way, hverify, log_func, events=None, cancel=None, throttle=None):
+        sync.synchronize_directories(source, dest, verbose=verbose, purge=purge, forcecopy=forcecopy, use_ctime=use_ctime,
+                                     use_content=use_content, two_way=two_way, hverify=hverify, events=events, cancel=cancel,
+                                     throttle=throttle, log_func=log_func)
 
-        if hverify:
-            verify_md5(source, dest)
 
 if __name__ == '__main__':
     app = wx.App()